@@ -0,0 +1,232 @@
+"""Benchmark the stages of converting rm files.
+
+Times parsing, anchor positions, bounding box, the pen calculations and each
+exporter, for each file in tests/rm and for synthetic pages with many points:
+
+    python benchmark.py run -o results.json
+
+Compare two sets of results, failing if any stage has become slower by more
+than the threshold:
+
+    python benchmark.py compare baseline.json results.json --threshold 0.2
+
+Check that the command line tool doesn't import the exporters at start-up,
+and report how long importing it takes:
+
+    python benchmark.py startup
+"""
+
+import io
+import json
+import logging
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import typing as tp
+from pathlib import Path
+
+import click
+import numpy as np
+
+from rmscene import read_tree
+
+from rmc.cache import rmc_version
+from rmc.exporters.markdown import tree_to_markdown
+from rmc.exporters.pdf import tree_to_pdf
+from rmc.exporters.png import tree_to_png
+from rmc.exporters.layout import build_anchor_pos, get_bounding_box, pack_lines
+from rmc.exporters.svg import tree_to_svg
+from rmc.exporters.writing_tools import Pen, segment_indices
+from rmc.generate import generate_page, split_points
+
+TEST_FILES = sorted(Path(__file__).parent.glob("tests/rm/*.rm"))
+
+# Modules which should not be imported just to start the command line tool
+STARTUP_HEAVY_MODULES = ["numpy", "rmscene", "rmc.exporters.svg", "rmc.exporters.pdf", "rmc.exporters.png",
+                         "rmc.exporters.markdown", "rmc.generate", "rmc.server", "http.server",
+                         "concurrent.futures.process"]
+
+
+def synthetic_page(n_points: int, points_per_line: int = 200, seed: int = 0) -> bytes:
+    """An rm file with `n_points` points of handwriting-like lines."""
+    lines, last_line_points = split_points(n_points, points_per_line)
+    return generate_page(lines, points_per_line=points_per_line, seed=seed, last_line_points=last_line_points)
+
+
+def pen_segments(lines):
+    """The `Pen` calculations for every line packed in `lines`, without drawing anything."""
+    for item in lines.lines:
+        pen = Pen.create(item.tool.value, item.color.value, item.thickness_scale)
+        for _ in segment_indices(pen, lines.geometry(item)):
+            pass
+
+
+def stages(data: bytes) -> tp.Dict[str, tp.Callable[[], tp.Any]]:
+    """Functions to time for the rm file `data`."""
+    tree = read_tree(io.BytesIO(data))
+    anchor_pos = build_anchor_pos(tree.root_text)
+    lines = pack_lines(tree.root, anchor_pos)
+    return {
+        "parse": lambda: read_tree(io.BytesIO(data)),
+        "anchors": lambda: build_anchor_pos(tree.root_text),
+        "pack": lambda: pack_lines(tree.root, anchor_pos),
+        "bounding_box": lambda: get_bounding_box(tree.root, anchor_pos),
+        "pen": lambda: pen_segments(lines),
+        "svg": lambda: tree_to_svg(tree, io.StringIO()),
+        "markdown": lambda: tree_to_markdown(tree, io.StringIO()),
+        "pdf": lambda: tree_to_pdf(tree, io.BytesIO()),
+        "png": lambda: tree_to_png(tree, io.BytesIO()),
+    }
+
+
+def time_stage(func, repeat: int) -> dict:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return {"min": min(times), "median": statistics.median(times), "repeat": repeat}
+
+
+def run_benchmarks(cases: tp.Dict[str, bytes], repeat: int, only: tp.Sequence[str] = ()) -> dict:
+    results = {}
+    for name, data in cases.items():
+        results[name] = {}
+        for stage, func in stages(data).items():
+            if only and stage not in only:
+                continue
+            results[name][stage] = time_stage(func, repeat)
+            click.echo(f"{name:45s} {stage:14s} {results[name][stage]['min'] * 1000:9.2f} ms", err=True)
+    return {
+        "version": 1,
+        "meta": {
+            "rmc": rmc_version(),
+            "python": sys.version.split()[0],
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        },
+        "results": results,
+    }
+
+
+def startup_time(code: str, repeat: int) -> float:
+    """Fastest time to run `code` in a new Python process."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], check=True)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def compare_results(baseline: dict, current: dict, threshold: float, min_time: float) \
+        -> tp.Tuple[tp.List[str], tp.List[str]]:
+    """Compare the minimum time of each stage in `current` with `baseline`.
+
+    Returns lines of a report, and the names of the stages which are more
+    than `threshold` (as a fraction) slower. Stages faster than `min_time`
+    seconds in both are too noisy to count as regressions.
+    """
+    lines = []
+    regressions = []
+    for name, stage_results in current["results"].items():
+        for stage, result in stage_results.items():
+            base = baseline["results"].get(name, {}).get(stage)
+            if base is None:
+                lines.append(f"{name:45s} {stage:14s} {result['min'] * 1000:9.2f} ms  (new)")
+                continue
+            change = result["min"] / base["min"] - 1 if base["min"] > 0 else 0.0
+            flag = ""
+            if change > threshold and max(result["min"], base["min"]) >= min_time:
+                regressions.append(f"{name}:{stage}")
+                flag = "  REGRESSION"
+            lines.append(f"{name:45s} {stage:14s} {base['min'] * 1000:9.2f} -> {result['min'] * 1000:9.2f} ms"
+                         f" ({change:+.1%}){flag}")
+    return lines, regressions
+
+
+@click.group()
+def cli():
+    logging.basicConfig(level=logging.ERROR)
+
+
+@cli.command()
+@click.option("-o", "--output", type=click.Path(dir_okay=False), help="Write results as JSON to this file")
+@click.option("-r", "--repeat", type=click.IntRange(min=1), default=5, show_default=True,
+              help="Number of times to run each stage (the fastest is used)")
+@click.option("--synthetic-points", type=click.IntRange(min=0), multiple=True, default=[100_000],
+              show_default=True, help="Also benchmark a synthetic page with this many points (0 for none)")
+@click.option("--stage", "only", multiple=True, help="Only run this stage (can be repeated)")
+@click.argument("files", nargs=-1, type=click.Path(exists=True, dir_okay=False))
+def run(output, repeat, synthetic_points, only, files):
+    """Time each stage for FILES (default: tests/rm/*.rm)."""
+    paths = [Path(f) for f in files] or TEST_FILES
+    cases = {path.name: path.read_bytes() for path in paths}
+    for n in synthetic_points:
+        if n > 0:
+            cases[f"synthetic-{n}"] = synthetic_page(n)
+
+    results = run_benchmarks(cases, repeat, only)
+    if output is not None:
+        Path(output).write_text(json.dumps(results, indent=2) + "\n")
+    else:
+        click.echo(json.dumps(results, indent=2))
+
+
+@cli.command()
+@click.argument("baseline", type=click.Path(exists=True, dir_okay=False))
+@click.argument("current", type=click.Path(exists=True, dir_okay=False))
+@click.option("--threshold", type=float, default=0.2, show_default=True,
+              help="Fail if a stage is slower than this fraction over the baseline")
+@click.option("--min-time", type=float, default=0.001, show_default=True,
+              help="Ignore stages taking less than this many seconds")
+def compare(baseline, current, threshold, min_time):
+    """Compare CURRENT results with BASELINE, failing on regressions."""
+    lines, regressions = compare_results(json.loads(Path(baseline).read_text()),
+                                         json.loads(Path(current).read_text()),
+                                         threshold, min_time)
+    for line in lines:
+        click.echo(line)
+    if regressions:
+        click.echo(f"{len(regressions)} stage(s) regressed by more than {threshold:.0%}: "
+                   + ", ".join(regressions), err=True)
+        sys.exit(1)
+    click.echo("No regressions", err=True)
+
+
+@cli.command()
+@click.option("-r", "--repeat", type=click.IntRange(min=1), default=10, show_default=True,
+              help="Number of times to start Python (the fastest is used)")
+@click.option("--budget", type=float,
+              help="Also fail if importing rmc.cli takes longer than this many seconds")
+def startup(repeat, budget):
+    """Check that starting the command line tool stays quick.
+
+    Fails if importing `rmc.cli` imports modules which are only needed for
+    conversions. The time to import it (on top of starting Python) is only
+    reported, as it depends on the machine, unless a `--budget` is given.
+    """
+    loaded = subprocess.run([sys.executable, "-c", "import sys, rmc.cli; print(*sys.modules)"],
+                            check=True, capture_output=True, text=True).stdout.split()
+    heavy = [name for name in STARTUP_HEAVY_MODULES if name in loaded]
+
+    python_time = startup_time("pass", repeat)
+    import_time = startup_time("import rmc.cli", repeat) - python_time
+    click.echo(f"Python start-up {python_time * 1000:.1f} ms, importing rmc.cli {import_time * 1000:.1f} ms"
+               + (f" (budget {budget * 1000:.0f} ms)" if budget is not None else ""))
+
+    failed = False
+    if heavy:
+        click.echo("rmc.cli imports " + ", ".join(heavy) + " at start-up", err=True)
+        failed = True
+    if budget is not None and import_time > budget:
+        click.echo("Importing rmc.cli is over budget", err=True)
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    cli()
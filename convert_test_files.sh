@@ -12,12 +12,9 @@ if [ ! -d "$TEST_DIR" ]; then
     exit 1
 fi
 
-if [ ! -d "$OUTPUT_DIR" ]; then
-    mkdir -p "$OUTPUT_DIR"
-    mkdir -p "$OUTPUT_DIR/markdown"
-    mkdir -p "$OUTPUT_DIR/svg"
-    mkdir -p "$OUTPUT_DIR/pdf"
-fi
+for dir in markdown svg pdf png json; do
+    mkdir -p "$OUTPUT_DIR/$dir"
+done
 
 # Iterate through all .rm files in the directory
 for file in "$TEST_DIR"/*.rm; do
@@ -38,8 +35,50 @@ for file in "$TEST_DIR"/*.rm; do
         echo "Running test pdf..."
         rmc -t pdf "$file" -o "$OUTPUT_DIR/pdf/$file_name.pdf"
 
+        echo "Running test png..."
+        rmc -t png "$file" -o "$OUTPUT_DIR/png/$file_name.png"
+
+        echo "Running test blocks-json and tree-json..."
+        rmc -t blocks-json "$file" -o "$OUTPUT_DIR/json/$file_name.blocks.jsonl"
+        rmc -t tree-json --points summary "$file" -o "$OUTPUT_DIR/json/$file_name.tree.jsonl"
+        python -c "import json, sys; [json.loads(line) for f in sys.argv[1:] for line in open(f, encoding='utf-8')]" \
+            "$OUTPUT_DIR/json/$file_name.blocks.jsonl" "$OUTPUT_DIR/json/$file_name.tree.jsonl"
+
         echo "----------------------------------------"
     fi
 done
 
+echo "Running test batch mode..."
+rmc -t svg,markdown,png -d "$OUTPUT_DIR/batch" -j 2 "$TEST_DIR"/*.rm
+
+echo "Running test tiles..."
+# As in the README, into a directory which doesn't exist yet
+(cd "$OUTPUT_DIR" && rmc --tile-size 400,400 -o "tiles/page-{row}-{col}.png" "../$TEST_DIR/writing_tools.rm")
+ls "$OUTPUT_DIR"/tiles/page-0-0.png > /dev/null
+
+echo "Running test svg --stream..."
+# A page with one long line, which is only written once it has all been drawn,
+# so the header must be sent before the line to arrive first
+rmc generate -o "$OUTPUT_DIR/stream.rm" -n 400000 --points-per-line 400000
+python - "$OUTPUT_DIR/stream.rm" <<'PYTHON'
+import os, subprocess, sys, time
+env = {name: value for name, value in os.environ.items() if name != "PYTHONUNBUFFERED"}
+proc = subprocess.Popen(["rmc", "-t", "svg", "--stream", sys.argv[1]], stdout=subprocess.PIPE,
+                        stderr=subprocess.DEVNULL, env=env)
+header = proc.stdout.read(5)
+header_time = time.perf_counter()
+proc.stdout.read(1 << 20)
+wait = time.perf_counter() - header_time
+proc.stdout.read()
+if proc.wait() != 0 or header != b"<?xml":
+    sys.exit("rmc --stream failed")
+if wait < 0.1:
+    sys.exit(f"SVG header only arrived with the strokes ({wait:.2f} s before them)")
+print(f"SVG header arrived {wait:.2f} s before the strokes")
+PYTHON
+
+echo "Checking start-up imports..."
+# Importing rmc.cli takes under 0.1 s; the budget leaves room for slow machines
+python benchmark.py startup --budget 0.5
+
 echo "All tests completed"
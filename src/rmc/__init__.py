@@ -1,2 +1,32 @@
-from .exporters.svg import tree_to_svg, rm_to_svg
-from .exporters.pdf import rm_to_pdf
+"""Convert to/from reMarkable v6 files.
+
+The exporters are imported when first used, so that importing `rmc` is quick.
+"""
+
+import importlib
+
+_EXPORTS = {
+    "tree_to_svg": ".exporters.svg",
+    "rm_to_svg": ".exporters.svg",
+    "rm_to_pdf": ".exporters.pdf",
+    "tree_to_pdf": ".exporters.pdf",
+    "trees_to_pdf": ".exporters.pdf",
+    "rm_to_png": ".exporters.png",
+    "tree_to_png": ".exporters.png",
+    "aconvert": ".aio",
+    "aconvert_chunked": ".aio",
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name):
+    if name in _EXPORTS:
+        value = getattr(importlib.import_module(_EXPORTS[name], __name__), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted([*globals(), *_EXPORTS])
@@ -0,0 +1,277 @@
+"""Convert rm files from asyncio code, without blocking the event loop.
+
+    svg = await rmc.aconvert(data, "svg")
+
+    async for chunk in rmc.aconvert_chunked(data, "svg", stream=True):
+        await response.write(chunk)
+
+Conversions run in a pool of worker processes (see `AsyncConverter`), so
+many can run at once while the event loop carries on. Only a limited number
+of conversions are handed to the pool at a time; beyond that, callers wait
+for a free slot, so that a burst of requests can't queue up unbounded work.
+
+Cancelling a call, or reaching its timeout, cancels its conversion if it
+hasn't started yet. A conversion which has already started runs to the end in
+its worker, keeping its slot until then, but its result is dropped.
+
+The workers are started by spawning new Python processes (see
+`rmc.batch.WorkerPool`), so as for `multiprocessing`, a script using this
+module must only start converting from within `if __name__ == "__main__":`.
+"""
+
+import asyncio
+import atexit
+import io
+import multiprocessing
+import threading
+import typing as tp
+import weakref
+from concurrent.futures import Executor
+from concurrent.futures.process import BrokenProcessPool
+
+from .batch import WorkerPool
+from .cli import BINARY_FORMATS, RM_FORMATS, convert_rm_data, convert_rm_to_bytes
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+# Seconds between checks of whether a streamed conversion has finished, while
+# no output is arriving
+RECEIVE_POLL = 0.1
+
+
+class AsyncConverter:
+    """Run conversions for asyncio code in a pool of `workers` processes (default: number of CPUs).
+
+    Up to `queue_size` conversions (default: 2 per worker) can wait for a
+    worker; beyond that, calls wait before handing their conversion to the
+    pool. `timeout` is the default number of seconds to wait for each
+    conversion, including any time spent waiting for a slot.
+
+    Conversions can be run in another `executor` instead, which is not shut
+    down by `close`.
+
+    Can be used as an async context manager, to shut the workers down at the
+    end.
+    """
+
+    def __init__(self, workers: int | None = None, queue_size: int | None = None,
+                 timeout: float | None = None, executor: Executor | None = None):
+        self._pool = WorkerPool(workers, queue_size, executor)
+        self.workers = self._pool.workers
+        self.queue_size = self._pool.queue_size
+        self.timeout = timeout
+        # asyncio semaphores can only be used in one event loop, so there is
+        # one for each loop the converter is used from
+        self._slots: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]" = \
+            weakref.WeakKeyDictionary()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.aclose()
+
+    def _slots_for(self, loop: asyncio.AbstractEventLoop) -> asyncio.Semaphore:
+        slots = self._slots.get(loop)
+        if slots is None:
+            slots = self._slots[loop] = asyncio.Semaphore(self._pool.max_pending)
+        return slots
+
+    async def convert(self, data: bytes, to: str, timeout: float | None = None, **options) -> bytes:
+        """Convert rm file contents `data` to format `to`, returning the output as bytes.
+
+        `options` are passed on to `convert_rm_data`. Raises
+        `asyncio.TimeoutError` if the conversion isn't finished within
+        `timeout` seconds (by default, the converter's `timeout`), or the
+        conversion's exception if it fails.
+        """
+        if to not in RM_FORMATS:
+            raise ValueError(f"Unknown format {to!r}")
+        if timeout is None:
+            timeout = self.timeout
+        return await asyncio.wait_for(self._run(data, to, options), timeout)
+
+    async def _run(self, data: bytes, to: str, options: dict) -> bytes:
+        executor, future = await self._submit(convert_rm_to_bytes, data, to, **options)
+        return await self._result(executor, future)
+
+    async def _submit(self, fn, *args, **kwargs):
+        """Wait for a slot, then hand `fn(*args, **kwargs)` to the pool; return the executor and future."""
+        loop = asyncio.get_running_loop()
+        slots = self._slots_for(loop)
+        await slots.acquire()
+        executor = self._pool.executor()
+        try:
+            future = executor.submit(fn, *args, **kwargs)
+        except BaseException:
+            slots.release()
+            raise
+        # Keep the slot until the worker has finished, even if we stop waiting
+        future.add_done_callback(lambda _: _release(loop, slots))
+        return executor, future
+
+    async def _result(self, executor, future):
+        try:
+            return await asyncio.wrap_future(future)
+        except BrokenProcessPool:
+            # Later conversions start new workers
+            self._pool.replace(executor)
+            raise
+
+    async def convert_chunked(self, data: bytes, to: str, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                              timeout: float | None = None, **options) -> tp.AsyncIterator[bytes]:
+        """Convert `data` as for `convert`, yielding the output in chunks of up to `chunk_size` bytes as it is made.
+
+        The worker sends its output through a pipe as it is written, so the
+        first chunks can be passed on while the rest of the page is drawn --
+        for SVG output with `stream=True`, before the size of the page is
+        known. The conversion's exception is raised once the chunks written
+        before it failed have been yielded. The conversion must be finished
+        within `timeout` seconds, including the time spent between chunks.
+        Stopping early drops the rest of the output.
+        """
+        if to not in RM_FORMATS:
+            raise ValueError(f"Unknown format {to!r}")
+        if timeout is None:
+            timeout = self.timeout
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+
+        reader, writer = multiprocessing.Pipe(duplex=False)
+        try:
+            executor, future = await _within(
+                self._submit(_convert_to_connection, data, to, writer, chunk_size, **options), deadline)
+        except BaseException:
+            reader.close()
+            writer.close()
+            raise
+        # Once the worker has its end of the pipe, this one is no longer needed
+        future.add_done_callback(lambda _: writer.close())
+
+        chunks: asyncio.Queue = asyncio.Queue()
+        stopped = threading.Event()
+
+        def put(chunk: tp.Optional[bytes]):
+            if not stopped.is_set():
+                try:
+                    loop.call_soon_threadsafe(chunks.put_nowait, chunk)
+                except RuntimeError:
+                    # The event loop has been closed
+                    stopped.set()
+
+        threading.Thread(target=_receive, args=(reader, future, put, stopped), daemon=True).start()
+        try:
+            while True:
+                chunk = await _within(chunks.get(), deadline)
+                if chunk is None:
+                    break
+                yield chunk
+            await self._result(executor, future)
+        finally:
+            stopped.set()
+            future.cancel()
+
+    def close(self):
+        """Shut down the worker processes, waiting for conversions which have started."""
+        self._pool.close()
+
+    async def aclose(self):
+        """As for `close`, without blocking the event loop."""
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
+
+
+class _ConnectionWriter(io.RawIOBase):
+    """Binary stream sending what is written through a `multiprocessing` connection, in chunks."""
+
+    def __init__(self, connection, chunk_size: int):
+        self.connection = connection
+        self.chunk_size = chunk_size
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        view = memoryview(data)
+        for start in range(0, len(view), self.chunk_size):
+            self.connection.send_bytes(view[start:start + self.chunk_size])
+        return len(view)
+
+
+def _convert_to_connection(data: bytes, to: str, connection, chunk_size: int, **options):
+    """Convert `data` to format `to`, sending the output through `connection` as it is written, in a worker.
+
+    Text output is encoded as UTF-8. `options` are passed on to `convert_rm_data`.
+    """
+    with connection:
+        output = io.BufferedWriter(_ConnectionWriter(connection, chunk_size), chunk_size)
+        if to not in BINARY_FORMATS:
+            output = io.TextIOWrapper(output, encoding="utf-8", newline="")
+        convert_rm_data(data, [(to, output)], **options)
+        output.flush()
+
+
+def _receive(reader, future, put, stopped: threading.Event):
+    """Pass on each chunk sent through `reader` for conversion `future`, then None once it has finished.
+
+    If `stopped` is set, the pipe is closed, so that the worker stops too.
+    """
+    try:
+        while not stopped.is_set():
+            if reader.poll(RECEIVE_POLL):
+                try:
+                    put(reader.recv_bytes())
+                except EOFError:
+                    break
+            elif future.done() and not reader.poll():
+                # All the output is sent before the conversion finishes
+                break
+    finally:
+        reader.close()
+        put(None)
+
+
+async def _within(awaitable, deadline: float | None):
+    """Await `awaitable`, raising `asyncio.TimeoutError` if it isn't finished by `deadline` (in loop time)."""
+    if deadline is None:
+        return await awaitable
+    return await asyncio.wait_for(awaitable, max(deadline - asyncio.get_running_loop().time(), 0))
+
+
+def _release(loop: asyncio.AbstractEventLoop, slots: asyncio.Semaphore):
+    # Called from the executor's thread when a conversion finishes
+    try:
+        loop.call_soon_threadsafe(slots.release)
+    except RuntimeError:
+        # The event loop has been closed
+        pass
+
+
+_default_converter: AsyncConverter | None = None
+_default_converter_lock = threading.Lock()
+
+
+def default_converter() -> AsyncConverter:
+    """Return the `AsyncConverter` shared within this process, creating it if needed."""
+    global _default_converter
+    with _default_converter_lock:
+        if _default_converter is None:
+            _default_converter = AsyncConverter()
+            atexit.register(_default_converter.close)
+        return _default_converter
+
+
+async def aconvert(data: bytes, to: str, timeout: float | None = None, **options) -> bytes:
+    """Convert rm file contents `data` to format `to` using the default converter.
+
+    See `AsyncConverter.convert`.
+    """
+    return await default_converter().convert(data, to, timeout, **options)
+
+
+def aconvert_chunked(data: bytes, to: str, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                     timeout: float | None = None, **options) -> tp.AsyncIterator[bytes]:
+    """Convert `data` to format `to` using the default converter, yielding the output in chunks as it is made.
+
+    See `AsyncConverter.convert_chunked`.
+    """
+    return default_converter().convert_chunked(data, to, chunk_size, timeout, **options)
@@ -0,0 +1,372 @@
+"""Convert many rm files to separate output files in parallel."""
+
+import logging
+import os
+import string
+import threading
+import time
+import traceback
+import typing as tp
+from contextlib import ExitStack
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from .cache import RenderCache
+from .profile import Profile
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_NAME_TEMPLATE = "{stem}.{ext}"
+
+# Fields of output filename templates; batch mode also has `index`, see `output_path`
+NAME_FIELDS = ("stem", "name", "parent", "ext")
+
+
+class BatchResult(tp.NamedTuple):
+    """Outcome of converting one input file."""
+
+    input: Path
+    outputs: tp.List[Path]
+    error: tp.Optional[str]
+    duration: float
+    input_size: int
+
+    # Stage times and counters, from `Profile.to_dict`, if profiling
+    profile: tp.Optional[dict] = None
+
+
+def output_path(input: Path, output_dir: Path, ext: str, template: str = DEFAULT_NAME_TEMPLATE,
+                index: int = 0) -> Path:
+    """Work out the output filename for `input`.
+
+    `template` is a format string which may use the fields `stem`, `name`,
+    `parent` (name of the directory containing the input), `ext` and `index`.
+    """
+    name = template.format(stem=input.stem,
+                           name=input.name,
+                           parent=input.parent.name,
+                           ext=ext,
+                           index=index)
+    return output_dir / name
+
+
+def template_fields(template: str) -> tp.Set[str]:
+    """Names of the fields used by format string `template`."""
+    return {field.split(".")[0].split("[")[0] for _, field, _, _ in string.Formatter().parse(template)
+            if field is not None}
+
+
+def duplicate_outputs(jobs: tp.Iterable[tp.Tuple[tp.Any, tp.Sequence[tp.Tuple[str, Path]]]]) -> tp.List[Path]:
+    """Outputs which more than one of the targets of `jobs` would be written to."""
+    seen = set()
+    duplicates = []
+    for _, targets in jobs:
+        for _, output in targets:
+            if output in seen and output not in duplicates:
+                duplicates.append(output)
+            seen.add(output)
+    return duplicates
+
+
+def convert_one(input: Path, targets: tp.Sequence[tp.Tuple[str, Path]], profile: bool = False,
+                **options) -> BatchResult:
+    """Convert `input` to each `(to, output)` in `targets`, capturing any error instead of raising.
+
+    The input is only parsed once. `options` are passed on to
+    `convert_rm_targets`. If `profile` is true, the conversion is profiled
+    and the result includes the profile.
+    """
+    from .cli import convert_rm_targets, open_output
+
+    start = time.perf_counter()
+    error = None
+    profiler = Profile() if profile else None
+    try:
+        with ExitStack() as stack:
+            if profiler is not None:
+                stack.enter_context(profiler)
+            files = []
+            for to, output in targets:
+                output.parent.mkdir(parents=True, exist_ok=True)
+                files.append((to, stack.enter_context(open_output(to, output))))
+            convert_rm_targets(input, files, **options)
+    except Exception as e:
+        _logger.debug("Failed to convert %s", input, exc_info=True)
+        error = "".join(traceback.format_exception_only(type(e), e)).strip()
+        # Don't leave truncated files behind
+        for _, output in targets:
+            output.unlink(missing_ok=True)
+    outputs = [output for _, output in targets]
+    return BatchResult(input, outputs, error, time.perf_counter() - start, input.stat().st_size,
+                       profiler.to_dict() if profiler is not None else None)
+
+
+def convert_batch(jobs: tp.Sequence[tp.Tuple[Path, tp.Sequence[tp.Tuple[str, Path]]]],
+                  workers: tp.Optional[int] = None, executor=None, cache: tp.Optional[RenderCache] = None,
+                  profile: bool = False, **options) -> tp.Iterator[BatchResult]:
+    """Convert each `(input, targets)` pair in `jobs`, where `targets` lists `(to, output)`.
+
+    Conversions are spread over a pool of `workers` processes (default: number
+    of CPUs), or run by `executor` if one is given, so that a pool can be
+    reused between batches. Results are yielded in order of completion;
+    failures are reported in the result rather than stopping the batch.
+    `profile` and `options` are passed on to `convert_one`.
+
+    If a `cache` is given, it is used in this process rather than in the
+    workers: cached outputs are written out here, only the rest are
+    converted, and they are added to the cache as they are finished.
+
+    With `pdf_engine="inkscape"`, the workers draw PDF outputs as SVG, and
+    they are converted to PDF here, several at a time (see `InkscapeBatch`).
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    keys: tp.Dict[Path, str] = {}
+    if cache is not None:
+        jobs, cached, keys = _use_cache(jobs, cache, options)
+        yield from cached
+
+    def finished(result: BatchResult) -> BatchResult:
+        if result.error is None:
+            for output in result.outputs:
+                if output in keys:
+                    cache.put(keys[output], output.read_bytes())
+        return result
+
+    with ExitStack() as stack:
+        inkscape = None
+        if options.get("pdf_engine") == "inkscape" and any(to == "pdf" for _, targets in jobs for to, _ in targets):
+            inkscape = InkscapeBatch(Path(stack.enter_context(TemporaryDirectory())))
+            jobs = [(input, inkscape.targets(targets)) for input, targets in jobs]
+
+        for result in _run_jobs(jobs, workers, executor, profile, options):
+            if inkscape is None:
+                yield finished(result)
+            else:
+                yield from map(finished, inkscape.add(result))
+        if inkscape is not None:
+            yield from map(finished, inkscape.flush())
+
+
+def _run_jobs(jobs, workers: int, executor, profile: bool, options: dict) -> tp.Iterator[BatchResult]:
+    if executor is None and (workers <= 1 or len(jobs) <= 1):
+        for input, targets in jobs:
+            yield convert_one(input, targets, profile=profile, **options)
+        return
+
+    # Only imported when needed, as it is slow to import
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    with ExitStack() as stack:
+        if executor is None:
+            executor = stack.enter_context(ProcessPoolExecutor(max_workers=workers))
+        futures = [executor.submit(convert_one, input, targets, profile=profile, **options)
+                   for input, targets in jobs]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+class InkscapeBatch:
+    """Convert the PDF outputs of a batch with Inkscape, several files at a time.
+
+    Inkscape is much quicker at converting a batch of files than the same
+    files one at a time, but each worker process only sees one page at a
+    time. So the workers are asked for SVG files in `directory` in place of
+    the PDF outputs (see `targets`), and the results are held back until
+    `batch_size` files are waiting, which are then converted together.
+    """
+
+    def __init__(self, directory: Path, batch_size: tp.Optional[int] = None):
+        from .exporters.inkscape import BATCH_SIZE
+        self.directory = directory
+        self.batch_size = BATCH_SIZE if batch_size is None else batch_size
+        # PDF output for each SVG file
+        self._pdfs: tp.Dict[Path, Path] = {}
+        self._held: tp.List[tp.Tuple[BatchResult, tp.List[Path]]] = []
+
+    def targets(self, targets: tp.Sequence[tp.Tuple[str, Path]]) -> tp.List[tp.Tuple[str, Path]]:
+        """`targets` with SVG files in place of PDF outputs."""
+        result = []
+        for to, output in targets:
+            if to == "pdf":
+                svg = self.directory / f"{len(self._pdfs)}.svg"
+                self._pdfs[svg] = output
+                to, output = "svg", svg
+            result.append((to, output))
+        return result
+
+    def add(self, result: BatchResult) -> tp.List[BatchResult]:
+        """Hold `result` back until its PDFs are made; return the results which are finished."""
+        svgs = [output for output in result.outputs if output in self._pdfs]
+        result = result._replace(outputs=[self._pdfs.get(output, output) for output in result.outputs])
+        if result.error is not None or not svgs:
+            return [result]
+        self._held.append((result, svgs))
+        if sum(len(svgs) for _, svgs in self._held) < self.batch_size:
+            return []
+        return self.flush()
+
+    def flush(self) -> tp.List[BatchResult]:
+        """Convert the SVG files of the results held back, and return those results."""
+        from .exporters.inkscape import InkscapeError, default_pool
+
+        held, self._held = self._held, []
+        if not held:
+            return []
+        pool = default_pool()
+        for _, svgs in held:
+            for svg in svgs:
+                pdf = self._pdfs[svg]
+                pdf.parent.mkdir(parents=True, exist_ok=True)
+                # So that an old output can't be taken for a new one
+                pdf.unlink(missing_ok=True)
+        try:
+            pool.convert([(str(svg), str(self._pdfs[svg].absolute())) for _, svgs in held for svg in svgs],
+                         self.batch_size)
+            failed = False
+        except (InkscapeError, OSError):
+            _logger.debug("Inkscape batch failed, converting one file at a time", exc_info=True)
+            failed = True
+
+        finished = []
+        for result, svgs in held:
+            if failed:
+                # Find out which files Inkscape can't convert
+                try:
+                    pool.convert([(str(svg), str(self._pdfs[svg].absolute())) for svg in svgs])
+                except (InkscapeError, OSError) as e:
+                    error = "".join(traceback.format_exception_only(type(e), e)).strip()
+                    for output in result.outputs:
+                        output.unlink(missing_ok=True)
+                    result = result._replace(error=error)
+            for svg in svgs:
+                svg.unlink(missing_ok=True)
+            finished.append(result)
+        return finished
+
+
+def _use_cache(jobs, cache: RenderCache, options: dict):
+    """Write out the outputs of `jobs` which are in `cache`.
+
+    Returns the jobs left to convert, the results of inputs with all their
+    outputs cached, and the cache keys of the outputs left to convert.
+    """
+    from .cli import cache_key
+
+    remaining = []
+    cached = []
+    keys = {}
+    for input, targets in jobs:
+        start = time.perf_counter()
+        try:
+            data = input.read_bytes()
+        except OSError:
+            # Leave it to `convert_one` to report
+            remaining.append((input, targets))
+            continue
+        missing = []
+        for to, output in targets:
+            key = cache_key(cache, data, to, **options)
+            result = cache.get(key)
+            if result is None:
+                keys[output] = key
+                missing.append((to, output))
+            else:
+                _logger.info("Using cached %s output for %s", to, input)
+                output.parent.mkdir(parents=True, exist_ok=True)
+                output.write_bytes(result)
+        if missing:
+            remaining.append((input, missing))
+        else:
+            cached.append(BatchResult(input, [output for _, output in targets], None,
+                                      time.perf_counter() - start, len(data)))
+    return remaining, cached, keys
+
+
+class WorkerPool:
+    """A pool of `workers` processes (default: number of CPUs) for conversions, replaced if a worker dies.
+
+    The workers are started from scratch rather than forked, since the program
+    may be running other threads, and import the exporters before they are
+    given any work. Callers should hand at most `max_pending` conversions to
+    the pool at a time: one for each worker, plus `queue_size` (default: 2
+    per worker) waiting for a worker.
+
+    Conversions can be run in another `executor` instead, which is neither
+    replaced nor shut down. Otherwise the workers are started when first
+    needed, or straight away if `eager` is true.
+    """
+
+    def __init__(self, workers: tp.Optional[int] = None, queue_size: tp.Optional[int] = None,
+                 executor=None, eager: bool = False):
+        self.workers = workers or os.cpu_count() or 1
+        self.queue_size = 2 * self.workers if queue_size is None else queue_size
+        self.eager = eager
+        self._executor = executor
+        self._own_executor = executor is None
+        self._lock = threading.Lock()
+        # Held while replacing the workers, so that only one thread does it
+        self._replace_lock = threading.Lock()
+        if eager and executor is None:
+            self._executor = self._start()
+
+    @property
+    def max_pending(self) -> int:
+        return self.workers + self.queue_size
+
+    def _start(self):
+        # Only imported when needed, as they are slow to import
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        from .cli import import_exporters
+
+        executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"),
+                                       initializer=import_exporters)
+        if self.eager:
+            # Start all the workers now, rather than when the first conversions arrive
+            for future in [executor.submit(time.sleep, 0) for _ in range(self.workers)]:
+                future.result()
+        return executor
+
+    def executor(self):
+        """The executor to submit conversions to, starting the workers if needed."""
+        with self._lock:
+            if self._executor is None:
+                self._executor = self._start()
+            return self._executor
+
+    def replace(self, executor):
+        """Replace `executor`, in which a worker process died, unless that has already been done.
+
+        Starting the new workers can take a while, so other threads can carry
+        on using the pool meanwhile.
+        """
+        if not self._own_executor:
+            return
+        with self._replace_lock:
+            if self._executor is not executor:
+                return
+            _logger.warning("Worker process died, restarting workers")
+            executor.shutdown(wait=False, cancel_futures=True)
+            new_executor = self._start() if self.eager else None
+            with self._lock:
+                self._executor = new_executor
+
+    def close(self):
+        """Shut down the worker processes, waiting for conversions which have started."""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None and self._own_executor:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+def format_summary(results: tp.Sequence[BatchResult], elapsed: float) -> str:
+    """Summarise throughput of a finished batch."""
+    n_failed = sum(1 for r in results if r.error is not None)
+    n_ok = len(results) - n_failed
+    total_bytes = sum(r.input_size for r in results)
+    rate = len(results) / elapsed if elapsed > 0 else float("inf")
+    mb_rate = total_bytes / 1e6 / elapsed if elapsed > 0 else float("inf")
+    return (f"Converted {n_ok} of {len(results)} files ({n_failed} failed) "
+            f"in {elapsed:.2f} s: {rate:.1f} files/s, {mb_rate:.2f} MB/s input")
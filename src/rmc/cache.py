@@ -0,0 +1,138 @@
+"""On-disk cache of converted pages.
+
+Entries are keyed on a hash of the `.rm` file contents, the target format, the
+rmc version and any render options, so a page which hasn't changed can be
+returned without parsing it again.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import typing as tp
+from pathlib import Path
+
+from .files import write_atomic
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_SIZE = 1024 * 1024 * 1024
+
+# File in the cache directory holding the estimated total size of the entries
+SIZE_FILE = "size"
+
+
+def rmc_version() -> str:
+    try:
+        from importlib.metadata import version
+        return version("rmc")
+    except Exception:
+        return "unknown"
+
+
+class RenderCache:
+    """Cache of converted outputs in `directory`, limited to `max_size` bytes.
+
+    When the cache grows beyond `max_size`, the least recently used entries
+    are removed. Several processes can share the same directory.
+
+    The total size of the entries is kept in a file in the directory, so that
+    a new process doesn't have to look at every entry to find it. Processes
+    writing at the same moment can make it inexact, so it is only an
+    estimate, which is corrected whenever entries are evicted.
+    """
+
+    def __init__(self, directory: Path, max_size: int = DEFAULT_MAX_SIZE):
+        self.directory = Path(directory)
+        self.max_size = max_size
+        self.version = rmc_version()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, data: bytes, to: str, options: tp.Optional[dict] = None) -> str:
+        """Cache key for converting `data` to format `to` with `options`."""
+        h = hashlib.sha256(data)
+        h.update(json.dumps([to, self.version, options or {}], sort_keys=True, default=str).encode())
+        return h.hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.directory / key[:2] / key
+
+    def get(self, key: str) -> tp.Optional[bytes]:
+        """Return the cached data for `key`, or None."""
+        path = self._path(key)
+        try:
+            data = path.read_bytes()
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        # Mark as recently used
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        self.hits += 1
+        return data
+
+    def put(self, key: str, data: bytes):
+        """Store `data` under `key`, then evict old entries if needed."""
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # An existing entry for the key is replaced, so its size no longer counts
+        try:
+            old_size = path.stat().st_size
+        except FileNotFoundError:
+            old_size = 0
+        write_atomic(path, data)
+
+        size = self._read_size()
+        if size is None:
+            # First use of the directory (or by an older version)
+            size = sum(entry_size for _, entry_size, _ in self.entries())
+        else:
+            size += len(data) - old_size
+        if size > self.max_size:
+            self.evict()
+        else:
+            self._write_size(size)
+
+    def _read_size(self) -> tp.Optional[int]:
+        try:
+            return int((self.directory / SIZE_FILE).read_text())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _write_size(self, size: int):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        write_atomic(self.directory / SIZE_FILE, str(max(size, 0)).encode())
+
+    def entries(self) -> tp.List[tp.Tuple[float, int, Path]]:
+        """List `(last_used, size, path)` of each entry."""
+        result = []
+        for path in self.directory.glob("??/*"):
+            if path.name.startswith(".tmp-"):
+                continue
+            try:
+                st = path.stat()
+            except FileNotFoundError:
+                continue
+            result.append((st.st_mtime, st.st_size, path))
+        return result
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits in `max_size`."""
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        if total > self.max_size:
+            for _, size, path in sorted(entries):
+                _logger.debug("Evicting %s from cache", path.name)
+                path.unlink(missing_ok=True)
+                total -= size
+                if total <= self.max_size:
+                    break
+        self._write_size(total)
+
+    def clear(self):
+        for _, _, path in self.entries():
+            path.unlink(missing_ok=True)
+        self._write_size(0)
@@ -1,61 +1,227 @@
-"""CLI for converting rm files."""
+"""CLI for converting rm files.
+
+Starting up quickly matters for a command which is often run once per page, so
+rmscene, the exporters (and NumPy) are only imported once a conversion needs
+them, and other commands are only imported when they are run. Check the
+start-up time with `python benchmark.py startup`.
+"""
 
 import os
 import sys
 import io
+import time
+import importlib
+import typing as tp
 from pathlib import Path
 from contextlib import contextmanager
 import click
-from rmscene import read_tree, read_blocks, write_blocks, simple_text_document
-from .exporters.svg import tree_to_svg
-from .exporters.pdf import svg_to_pdf
-from .exporters.markdown import print_text
+from .cache import DEFAULT_MAX_SIZE, RenderCache
+from . import profile
+from .profile import Profile
+from .batch import DEFAULT_NAME_TEMPLATE, convert_batch, duplicate_outputs, output_path, format_summary
+from .exporters.json_options import POINTS_MODES
 
 import logging
 
+if tp.TYPE_CHECKING:
+    from rmscene import SceneTree
+    from .exporters.layout import Extents, PageLayout
+    from .exporters.simplify import Simplifier
+
+_logger = logging.getLogger(__name__)
+
+
+class DefaultGroup(click.Group):
+    """A group of commands which runs `default_command` if no other command is named.
+
+    Commands in `lazy_commands`, a dict of names and "module:attribute"
+    paths, are only imported when they are used.
+    """
 
-@click.command
+    def __init__(self, *args, default_command: str, lazy_commands: tp.Dict[str, str] | None = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.default_command = default_command
+        self.lazy_commands = lazy_commands or {}
+
+    def list_commands(self, ctx):
+        return sorted([*self.commands, *self.lazy_commands])
+
+    def get_command(self, ctx, cmd_name):
+        if cmd_name in self.lazy_commands and cmd_name not in self.commands:
+            module_name, attr = self.lazy_commands[cmd_name].split(":")
+            self.add_command(getattr(importlib.import_module(module_name, __package__), attr), cmd_name)
+        return super().get_command(ctx, cmd_name)
+
+    def parse_args(self, ctx, args):
+        if not args or (args[0] not in self.list_commands(ctx) and args[0] not in ("--help", "--version")):
+            args = [self.default_command, *args]
+        return super().parse_args(ctx, args)
+
+
+@click.group(cls=DefaultGroup, default_command="convert", lazy_commands={
+    "index": ".search:index",
+    "search": ".search:search",
+    "generate": ".generate:generate",
+    "serve": ".server:serve",
+    "watch": ".watch:watch",
+})
 @click.version_option()
+def cli():
+    """Convert to/from reMarkable v6 files.
+
+    `rmc FILE...` is the same as `rmc convert FILE...`; see `rmc convert
+    --help` for the conversion options.
+    """
+
+
+@cli.command()
 @click.option('-v', '--verbose', count=True)
 @click.option("-f", "--from", "from_", metavar="FORMAT", help="Format to convert from (default: guess from filename)")
-@click.option("-t", "--to", metavar="FORMAT", help="Format to convert to (default: guess from filename)")
+@click.option("-t", "--to", metavar="FORMAT",
+              help="Format to convert to (default: guess from filename); several comma-separated "
+              "formats can be given with --output-dir")
 @click.option("-o", "--output", type=click.Path(), help="Output filename (default: write to standard out)")
+@click.option("-d", "--output-dir", type=click.Path(file_okay=False),
+              help="Convert each input to its own file in this directory (batch mode)")
+@click.option("--name-template", default=DEFAULT_NAME_TEMPLATE, show_default=True,
+              help="Output filename template for batch mode; fields: {stem}, {name}, {parent}, {ext}, {index}")
+@click.option("-j", "--jobs", type=click.IntRange(min=1),
+              help="Number of worker processes for batch mode (default: number of CPUs)")
+@click.option("--pdf-engine", type=click.Choice(["native", "inkscape"]), default="native", show_default=True,
+              help="Write PDF directly, or by converting SVG with Inkscape")
+@click.option("--dpi", type=click.FloatRange(min=0, min_open=True),
+              help="Resolution of PNG output (default: 72, one pixel per pt)")
+@click.option("--viewport", callback=lambda ctx, param, value: parse_numbers(value, 4, param),
+              metavar="X,Y,W,H", help="Only draw this part of the page (in pt, as in the SVG viewBox)")
+@click.option("--tile-size", callback=lambda ctx, param, value: parse_numbers(value, 2, param),
+              metavar="W,H", help="Split the page into tiles of this size (in pt), written to files "
+              "named by --output with fields {row}, {col} and {index}")
+@click.option("--stream", is_flag=True,
+              help="Write SVG strokes as they are drawn, before the page size is known")
+@click.option("--simplify", type=click.FloatRange(min=0, min_open=True), metavar="TOL",
+              help="Simplify strokes, dropping points which move them by less than TOL (in pt)")
+@click.option("--points", type=click.Choice(POINTS_MODES), default="all", show_default=True,
+              help="Write the points of lines in blocks-json and tree-json output in full, as their "
+              "count and extents, or not at all")
+@click.option("--cache-dir", type=click.Path(file_okay=False), envvar="RMC_CACHE_DIR",
+              help="Reuse converted pages from this cache directory [env: RMC_CACHE_DIR]")
+@click.option("--no-cache", is_flag=True, help="Don't use the cache, even if a cache directory is set")
+@click.option("--cache-size", type=click.IntRange(min=0), default=DEFAULT_MAX_SIZE // 2**20, show_default=True,
+              help="Maximum size of the cache in MB; least recently used pages are removed")
+@click.option("--profile", "profile_table", is_flag=True,
+              help="Print the time taken by each stage, and counts of what was drawn, to standard error")
+@click.option("--profile-json", type=click.Path(dir_okay=False),
+              help="Write the time taken by each stage, and counts of what was drawn, to this file as JSON")
 @click.argument("input", nargs=-1, type=click.Path(exists=True))
-def cli(verbose, from_, to, output, input):
+@click.pass_context
+def convert(ctx, verbose, from_, to, output, output_dir, name_template, jobs, pdf_engine, dpi, viewport, tile_size,
+        stream, simplify, points, cache_dir, no_cache, cache_size, profile_table, profile_json, input):
     """Convert to/from reMarkable v6 files.
 
     Available FORMATs are: `rm` (reMarkable file), `markdown`, `svg`, `pdf`,
-    `blocks`, `blocks-data`.
+    `png`, `blocks`, `blocks-data`, `tree`, `tree-data`, `blocks-json`,
+    `tree-json`.
 
     Formats `blocks` and `blocks-data` dump the internal structure of the `rm`
-    file, with and without detailed data values respectively.
+    file, with and without detailed data values respectively. `tree` and
+    `tree-data` do the same for the scene tree built from the blocks.
+
+    Formats `blocks-json` and `tree-json` write each block, or each node of
+    the scene tree, as a line of JSON, e.g. to read with `jq`. `--points` sets
+    how the points of lines are written.
+
+    When several inputs are converted to `pdf`, they are combined into one
+    document with a page for each input.
+
+    With `--output-dir`, each input is converted to a separate file, and the
+    conversions are run in parallel. Several formats can be given, e.g. `-t
+    svg,markdown,pdf`, to convert each input to all of them, parsing it once.
+
+    With `--viewport` or `--tile-size`, `svg` and `png` output can be limited
+    to part of the page, e.g. to load a long page one tile at a time.
 
     """
 
-    if verbose >= 2:
-        logging.basicConfig(level=logging.DEBUG)
-    elif verbose >= 1:
-        logging.basicConfig(level=logging.INFO)
-    else:
-        logging.basicConfig(level=logging.WARNING)
+    setup_logging(verbose)
+
+    profiler = None
+    if profile_table or profile_json:
+        profiler = ctx.with_resource(Profile())
+        ctx.call_on_close(lambda: report_profile(profiler, profile_table, profile_json))
 
     input = [Path(p) for p in input]
     if output is not None:
         output = Path(output)
 
+    cache = None
+    if cache_dir is not None and not no_cache:
+        cache = RenderCache(Path(cache_dir), max_size=cache_size * 2**20)
+
     if from_ is None:
         if not input:
             raise click.UsageError("Must specify input filename or --from")
         from_ = guess_format(input[0])
-    if to is None:
+
+    if output_dir is not None:
+        if output is not None:
+            raise click.UsageError("Cannot use both --output and --output-dir")
+        if to is None:
+            raise click.UsageError("Must specify --to with --output-dir")
+    elif to is None:
         if output is None:
             raise click.UsageError("Must specify --output or --to")
         to = guess_format(output)
 
+    formats = to.split(",")
+    if len(formats) > 1 and output_dir is None:
+        raise click.UsageError("Converting to several formats needs --output-dir")
+
+    if viewport is not None or tile_size is not None:
+        if any(f not in ("svg", "png") for f in formats):
+            raise click.UsageError("--viewport and --tile-size only support svg and png output")
+        if from_ != "rm":
+            raise click.UsageError("--viewport and --tile-size only support converting from rm files")
+    if viewport is not None:
+        viewport = viewport_extents(viewport)
+
+    if tile_size is not None:
+        if viewport is not None:
+            raise click.UsageError("Cannot use both --viewport and --tile-size")
+        if len(input) != 1 or output is None:
+            raise click.UsageError("--tile-size needs one input file and --output")
+        from .exporters.layout import SCALE
+        tiles = convert_rm_tiles(input[0], to, str(output), tile_size[0] / SCALE, tile_size[1] / SCALE,
+                                 dpi=dpi, simplifier=make_simplifier(simplify))
+        click.echo(f"Wrote {len(tiles)} tiles", err=True)
+        return
+
+    if output_dir is not None:
+        if from_ != "rm":
+            raise click.UsageError("--output-dir only supports converting from rm files")
+        for f in formats:
+            if f not in RM_FORMATS:
+                raise click.UsageError("Unknown format %s" % f)
+        failed = run_batch(input, formats, Path(output_dir), name_template, jobs, pdf_engine=pdf_engine,
+                           dpi=dpi, viewport=viewport, stream=stream, simplify=simplify, points=points,
+                           cache=cache, profile=profiler is not None)
+        ctx.exit(1 if failed else 0)
+
     if from_ == "rm":
+        if to == "pdf" and len(input) > 1 and pdf_engine != "native":
+            raise click.UsageError("Combining several inputs into one PDF needs --pdf-engine native")
         with open_output(to, output) as fout:
-            for fn in input:
-                convert_rm(Path(fn), to, fout)
+            if to == "pdf" and len(input) > 1:
+                # Combine into one document with a page per input
+                from .exporters.pdf import trees_to_pdf
+                simplifier = make_simplifier(simplify)
+                with profile.stage("pdf"):
+                    trees_to_pdf((read_tree_file(fn) for fn in input), profile.counted_output(fout), simplifier)
+                if simplifier is not None:
+                    click.echo(simplifier.report(), err=True)
+            else:
+                for fn in input:
+                    convert_rm(Path(fn), to, fout, pdf_engine=pdf_engine, dpi=dpi, viewport=viewport,
+                               stream=stream, simplify=simplify, points=points, cache=cache)
     elif from_ == "markdown":
         text = "".join(
             Path(fn).read_text() for fn in input
@@ -66,9 +232,80 @@ def cli(verbose, from_, to, output, input):
         raise click.UsageError("source format %s not implemented yet" % from_)
 
 
+def setup_logging(verbose: int):
+    if verbose >= 2:
+        logging.basicConfig(level=logging.DEBUG)
+    elif verbose >= 1:
+        logging.basicConfig(level=logging.INFO)
+    else:
+        logging.basicConfig(level=logging.WARNING)
+
+
+def viewport_extents(viewport: tp.Tuple[float, float, float, float]) -> "Extents":
+    """Convert `viewport` as (x, y, width, height) in pt to extents in screen units."""
+    from .exporters.layout import SCALE
+    x, y, w, h = (v / SCALE for v in viewport)
+    return (x, x + w, y, y + h)
+
+
+def make_simplifier(simplify: float | None) -> tp.Optional["Simplifier"]:
+    """A `Simplifier` with tolerance `simplify` (in pt), or None if not simplifying."""
+    if not simplify:
+        return None
+    from .exporters.simplify import Simplifier
+    from .exporters.layout import SCALE
+    return Simplifier(simplify / SCALE)
+
+
+def cache_key(cache: RenderCache, data: bytes, to: str, pdf_engine="native", dpi: float | None = None,
+              viewport: tp.Optional["Extents"] = None, stream: bool = False, simplify: float | None = None,
+              points: str = "all") -> str:
+    """Key in `cache` of converting `data` to format `to` with these options, as for `convert_rm_data`.
+
+    This doesn't import the exporters, so that callers can check the cache
+    before handing the conversion to another process.
+    """
+    return cache.key(data, to, dict(pdf_engine=pdf_engine, dpi=dpi, viewport=viewport, stream=stream,
+                                    simplify=simplify, points=points))
+
+
+def run_batch(input, formats, output_dir: Path, name_template, jobs, **options) -> int:
+    """Convert each of `input` to its own file in each of `formats`; return the number of failures."""
+    jobs_list = [(fn, [(to, output_path(fn, output_dir, FORMAT_EXTENSIONS.get(to, to), name_template, i))
+                       for to in formats])
+                 for i, fn in enumerate(input)]
+
+    if duplicate_outputs(jobs_list):
+        raise click.UsageError("--name-template gives the same output filename for several inputs")
+
+    start = time.perf_counter()
+    results = []
+    for result in convert_batch(jobs_list, workers=jobs, **options):
+        results.append(result)
+        if result.profile is not None:
+            # Conversions ran in other processes, so add their profiles to this one
+            profile.active().merge(result.profile)
+        if result.error is not None:
+            click.echo(f"FAILED {result.input}: {result.error}", err=True)
+        else:
+            _logger.info("Converted %s -> %s (%.2f s)", result.input,
+                         ", ".join(map(str, result.outputs)), result.duration)
+    elapsed = time.perf_counter() - start
+
+    click.echo(format_summary(results, elapsed), err=True)
+    return sum(1 for r in results if r.error is not None)
+
+
+def report_profile(profiler: Profile, table: bool, json_path: str | None):
+    if table:
+        click.echo(profiler.format_table(), err=True)
+    if json_path is not None:
+        Path(json_path).write_text(profiler.to_json() + "\n")
+
+
 @contextmanager
 def open_output(to, output):
-    to_binary = to in ("pdf", "rm")
+    to_binary = to in BINARY_FORMATS
     if output is None:
         # Write to stdout
         if to_binary:
@@ -81,6 +318,39 @@ def open_output(to, output):
             yield f
 
 
+# Formats which rm files can be converted to
+RM_FORMATS = ("blocks", "blocks-data", "tree", "tree-data", "blocks-json", "tree-json",
+              "markdown", "svg", "pdf", "png")
+
+# Output formats which are written as bytes rather than text
+BINARY_FORMATS = ("pdf", "png", "rm")
+
+# File extensions used for each output format in batch mode
+FORMAT_EXTENSIONS = {
+    "rm": "rm",
+    "svg": "svg",
+    "pdf": "pdf",
+    "png": "png",
+    "markdown": "md",
+    "blocks-json": "blocks.jsonl",
+    "tree-json": "tree.jsonl",
+}
+
+
+def parse_numbers(value: str | None, n: int, param) -> tp.Optional[tp.Tuple[float, ...]]:
+    """Parse `n` comma-separated numbers for option `param`."""
+    if value is None:
+        return None
+    try:
+        numbers = tuple(float(v) for v in value.split(","))
+    except ValueError:
+        numbers = ()
+    if len(numbers) != n:
+        raise click.BadParameter(f"expected {n} comma-separated numbers" if n > 1 else "expected a number",
+                                 param=param)
+    return numbers
+
+
 def guess_format(p: Path):
     # XXX could be neater
     if p.suffix == ".rm":
@@ -89,14 +359,16 @@ def guess_format(p: Path):
         return "svg"
     elif p.suffix == ".pdf":
         return "pdf"
+    elif p.suffix == ".png":
+        return "png"
     elif p.suffix == ".md" or p.suffix == ".markdown":
         return "markdown"
     else:
         return "blocks"
 
 
-from rmscene import scene_items as si
 def tree_structure(item):
+    from rmscene import scene_items as si
     if isinstance(item, si.Group):
         return (
             item.node_id,
@@ -116,35 +388,208 @@ def tree_structure(item):
         return item
 
 
-def convert_rm(filename: Path, to, fout):
-    with open(filename, "rb") as f:
-        if to == "blocks":
-            pprint_blocks(f, fout)
-        elif to == "blocks-data":
-            pprint_blocks(f, fout, data=False)
-        elif to == "tree":
-            # Experimental dumping of tree structure
-            pprint_tree(f, fout, data=True)
-        elif to == "tree-data":
-            # Experimental dumping of tree structure
-            pprint_tree(f, fout, data=False)
-        elif to == "markdown":
-            print_text(f, fout)
-        elif to == "svg":
-            tree = read_tree(f)
-            tree_to_svg(tree, fout)
-        elif to == "pdf":
-            buf = io.StringIO()
-            tree = read_tree(f)
-            tree_to_svg(tree, buf)
-            buf.seek(0)
-            svg_to_pdf(buf, fout)
-        else:
+def read_tree_file(filename: Path):
+    from rmscene import read_tree
+    with open(filename, "rb") as f, profile.stage("parse"):
+        return read_tree(f)
+
+
+def convert_rm(filename: Path, to, fout, **options):
+    """Convert rm file `filename` to format `to`, writing to `fout`.
+
+    `options` are passed on to `convert_rm_targets`.
+    """
+    convert_rm_targets(filename, [(to, fout)], **options)
+
+
+def convert_rm_targets(filename: Path, targets: tp.Sequence[tp.Tuple[str, tp.Any]], **options):
+    """Convert rm file `filename` to each format `to` in `targets`, a list of `(to, fout)`.
+
+    `options` are passed on to `convert_rm_data`.
+    """
+    convert_rm_data(filename.read_bytes(), targets, name=str(filename), **options)
+
+
+def convert_rm_data(data: bytes, targets: tp.Sequence[tp.Tuple[str, tp.Any]], pdf_engine="native",
+                    dpi: float | None = None, viewport: tp.Optional["Extents"] = None, stream: bool = False,
+                    simplify: float | None = None, points: str = "all", cache: RenderCache | None = None,
+                    name: str = "<data>"):
+    """Convert rm file contents `data` to each format `to` in `targets`, a list of `(to, fout)`.
+
+    The data is only parsed once, and the tree and its layout are shared
+    between the exporters. `name` identifies the data in messages.
+
+    `dpi` sets the resolution of `png` output (by default the exporter's
+    `DEFAULT_DPI`), and `viewport` (in screen units) limits `svg` and `png`
+    output to part of the page. `stream` writes `svg` output as it is drawn
+    (see `tree_to_svg`). If `simplify` is given, strokes are simplified to
+    within this tolerance (in pt), and the number of points dropped is
+    reported. `points` sets how the points of lines are written in
+    `blocks-json` and `tree-json` output (see `POINTS_MODES`). If a `cache` is
+    given, outputs are reused from it if the file hasn't changed.
+    """
+    for to, _ in targets:
+        if to not in RM_FORMATS:
             raise click.UsageError("Unknown format %s" % to)
 
+    profile.count(files=1, input_bytes=len(data))
+    options = dict(pdf_engine=pdf_engine, dpi=dpi, viewport=viewport, stream=stream, points=points)
+    tree = layout = None
+    reported = False
+    for to, fout in targets:
+        to_binary = to in BINARY_FORMATS
+        fout = profile.counted_output(fout)
+
+        key = None
+        if cache is not None:
+            key = cache_key(cache, data, to, simplify=simplify, **options)
+            result = cache.get(key)
+            if result is not None:
+                _logger.info("Using cached %s output for %s", to, name)
+                fout.write(result if to_binary else result.decode())
+                continue
+
+        simplifier = make_simplifier(simplify)
+        out = fout if key is None else (io.BytesIO() if to_binary else io.StringIO())
+        if to in ("blocks", "blocks-data", "blocks-json"):
+            # Blocks are dumped as they are read, without building the tree
+            with profile.stage(to):
+                convert_rm_stream(io.BytesIO(data), to, out, points=points)
+        else:
+            if tree is None:
+                from rmscene import read_tree
+                from .exporters.layout import PageLayout
+                with profile.stage("parse"):
+                    tree = read_tree(io.BytesIO(data))
+                layout = PageLayout(tree)
+            with profile.stage(to):
+                convert_tree(tree, to, out, layout, simplifier=simplifier, **options)
+
+        if key is not None:
+            result = out.getvalue() if to_binary else out.getvalue().encode()
+            cache.put(key, result)
+            fout.write(out.getvalue())
+
+        # The same points are dropped for each format, so only report once
+        if simplifier is not None and simplifier.points_in and not reported:
+            click.echo(f"{name}: {simplifier.report()}", err=True)
+            reported = True
+
+
+def convert_rm_to_bytes(data: bytes, to: str, **options) -> bytes:
+    """Convert rm file contents `data` to format `to`, returning the output as bytes.
+
+    Text output is encoded as UTF-8. `options` are passed on to `convert_rm_data`.
+    """
+    out = io.BytesIO() if to in BINARY_FORMATS else io.StringIO()
+    convert_rm_data(data, [(to, out)], **options)
+    return out.getvalue() if to in BINARY_FORMATS else out.getvalue().encode()
+
+
+def import_exporters():
+    """Import all the exporters, e.g. in a worker process before it is given any work."""
+    from .exporters import markdown, ndjson, pdf, png, svg  # noqa: F401
+
+
+def convert_rm_stream(f, to, fout, **options):
+    """Convert rm data read from binary stream `f` to format `to`.
+
+    `options` are passed on to `convert_tree`.
+    """
+    if to == "blocks":
+        pprint_blocks(f, fout)
+    elif to == "blocks-data":
+        pprint_blocks(f, fout, data=False)
+    elif to == "blocks-json":
+        from .exporters.ndjson import blocks_to_ndjson
+        blocks_to_ndjson(f, fout, points=options.get("points", "all"))
+    elif to in RM_FORMATS:
+        from rmscene import read_tree
+        with profile.stage("parse"):
+            tree = read_tree(f)
+        convert_tree(tree, to, fout, **options)
+    else:
+        raise click.UsageError("Unknown format %s" % to)
+
+
+def convert_tree(tree: "SceneTree", to, fout, layout: tp.Optional["PageLayout"] = None, pdf_engine="native",
+                 dpi: float | None = None, viewport: tp.Optional["Extents"] = None, stream: bool = False,
+                 simplifier: tp.Optional["Simplifier"] = None, points: str = "all"):
+    """Convert `tree` to format `to`, writing to `fout`.
+
+    `layout` can be given to share the text layout, anchor positions and
+    extents between several conversions of the same tree.
+    """
+    if to == "tree":
+        # Experimental dumping of tree structure
+        pprint_tree(tree, fout, data=True)
+    elif to == "tree-data":
+        # Experimental dumping of tree structure
+        pprint_tree(tree, fout, data=False)
+    elif to == "tree-json":
+        from .exporters.ndjson import tree_to_ndjson
+        tree_to_ndjson(tree, fout, points=points)
+    elif to == "markdown":
+        from .exporters.markdown import tree_to_markdown
+        tree_to_markdown(tree, fout, layout)
+    elif to == "svg":
+        from .exporters.svg import tree_to_svg
+        tree_to_svg(tree, fout, simplifier=simplifier, viewport=viewport, layout=layout, stream=stream)
+    elif to == "pdf" and pdf_engine == "native":
+        from .exporters.pdf import tree_to_pdf
+        tree_to_pdf(tree, fout, simplifier=simplifier, layout=layout)
+    elif to == "pdf":
+        from .exporters.pdf import svg_to_pdf
+        from .exporters.svg import tree_to_svg
+        buf = io.StringIO()
+        tree_to_svg(tree, buf, simplifier=simplifier, layout=layout)
+        buf.seek(0)
+        svg_to_pdf(buf, fout)
+    elif to == "png":
+        from .exporters.png import DEFAULT_DPI, tree_to_png
+        tree_to_png(tree, fout, dpi=DEFAULT_DPI if dpi is None else dpi, simplifier=simplifier,
+                    viewport=viewport, layout=layout)
+    else:
+        raise click.UsageError("Unknown format %s" % to)
+
+
+def convert_rm_tiles(filename: Path, to, output_template: str, tile_width: float, tile_height: float,
+                     dpi: float | None = None, simplifier: tp.Optional["Simplifier"] = None) -> tp.List[Path]:
+    """Convert rm file `filename` to a grid of `svg` or `png` tiles.
+
+    Tile sizes are in screen units. Each tile is written to a file named by
+    formatting `output_template` with its `row`, `col` and `index`. The file is
+    only parsed once, and lines outside each tile are skipped.
+    """
+    from .exporters.png import DEFAULT_DPI, tree_to_png
+    from .exporters.svg import PageLayout, get_bounding_box, page_tiles, tree_to_svg
+
+    if dpi is None:
+        dpi = DEFAULT_DPI
+    tree = read_tree_file(filename)
+    layout = PageLayout(tree)
+    x_min, x_max, y_min, y_max = get_bounding_box(tree.root, layout.anchor_pos, extents=layout.extents)
+    page = (x_min, x_max + 1, y_min, y_max + 1)
+
+    tiles = [(Path(output_template.format(row=row, col=col, index=index)), viewport)
+             for index, (row, col, viewport) in enumerate(page_tiles(page, tile_width, tile_height))]
+    if len({output for output, _ in tiles}) != len(tiles):
+        raise click.UsageError("--output must include {row} and {col}, or {index}, to name each tile")
+
+    for output, viewport in tiles:
+        output.parent.mkdir(parents=True, exist_ok=True)
+        with open_output(to, output) as fout, profile.stage(to):
+            fout = profile.counted_output(fout)
+            if to == "svg":
+                tree_to_svg(tree, fout, simplifier=simplifier, viewport=viewport, layout=layout)
+            else:
+                tree_to_png(tree, fout, dpi=dpi, simplifier=simplifier, viewport=viewport, layout=layout)
+    return [output for output, _ in tiles]
+
 
 def pprint_blocks(f, fout, data=True) -> None:
     import pprint
+    from rmscene import read_blocks
     depth = None if data else 1
     result = read_blocks(f)
     for el in result:
@@ -152,11 +597,10 @@ def pprint_blocks(f, fout, data=True) -> None:
         pprint.pprint(el, depth=depth, stream=fout)
 
 
-def pprint_tree(f, fout, data=True) -> None:
-    tree = read_tree(f)
-
+def pprint_tree(tree: "SceneTree", fout, data=True) -> None:
     import pprint
     import re
+    from rmscene import scene_items as si
 
     def pprint_Line(self, object, stream, indent, allowance, context, level):
         min_x = min(p.x for p in object.points)
@@ -168,15 +612,19 @@ def pprint_tree(f, fout, data=True) -> None:
                      repr(object))
         stream.write(rep)
 
-    pprint.PrettyPrinter._dispatch[si.Line.__repr__] = pprint_Line
+    # Only change how lines are printed here, not for every use of pprint
+    class TreePrinter(pprint.PrettyPrinter):
+        _dispatch = dict(pprint.PrettyPrinter._dispatch)
+        _dispatch[si.Line.__repr__] = pprint_Line
 
     depth = None if data else 1
-    pprint.pprint(tree_structure(tree.root), stream=fout)
-    pprint.pprint(tree_structure(tree.root_text), depth=depth, stream=fout)
+    TreePrinter(stream=fout).pprint(tree_structure(tree.root))
+    TreePrinter(depth=depth, stream=fout).pprint(tree_structure(tree.root_text))
 
 
 
 def convert_text(text, fout):
+    from rmscene import simple_text_document, write_blocks
     write_blocks(fout, simple_text_document(text))
 
 
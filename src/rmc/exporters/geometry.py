@@ -0,0 +1,188 @@
+"""The points of the lines on a page, packed into arrays.
+
+rmscene gives each point of a line as a Python object, which takes several
+times the memory of its values and is slow to read one attribute at a time.
+`PackedLines` copies the points of all the lines on a page into one block of
+arrays (a row for each of x, y, speed, direction, width and pressure), along
+with the offset of each line on the page from the groups containing it, and
+the extents of each line. Finding the order of a group's children is also slow
+in rmscene, so the order found while packing is kept for later walks of the
+tree.
+
+Points read from rm files are stored as float32, which holds their values
+exactly; if any value needs more precision (as for version 1 points, or
+points made in Python), float64 is used instead.
+"""
+
+import operator
+import typing as tp
+
+import numpy as np
+
+from rmscene import scene_items as si
+
+POINT_FIELDS = ("x", "y", "speed", "direction", "width", "pressure")
+
+_FIELD_GETTERS = [operator.attrgetter(field) for field in POINT_FIELDS]
+
+
+def pack_points(points: tp.Sequence[si.Point]) -> np.ndarray:
+    """Values of `points` as an array of shape (6, n), with a row for each of `POINT_FIELDS`."""
+    packed = np.zeros((len(POINT_FIELDS), len(points)), dtype=np.float32)
+    # Reading one field at a time is quicker than building a tuple for each point
+    for i, getter in enumerate(_FIELD_GETTERS):
+        values = np.fromiter(map(getter, points), float, count=len(points))
+        if packed.dtype == np.float32 and not np.array_equal(values.astype(np.float32), values):
+            packed = packed.astype(float)
+        packed[i] = values
+    return packed
+
+
+class LineGeometry:
+    """The points of a line, as a view of packed arrays.
+
+    `offset` is the position of the line's origin on the page, from the
+    anchors of the groups containing it.
+    """
+
+    __slots__ = ("data", "offset")
+
+    def __init__(self, data: np.ndarray, offset: tp.Tuple[float, float] = (0.0, 0.0)):
+        self.data = data
+        self.offset = offset
+
+    @classmethod
+    def from_points(cls, points: tp.Sequence[si.Point]) -> "LineGeometry":
+        return cls(pack_points(points))
+
+    def __len__(self):
+        return self.data.shape[1]
+
+    @property
+    def x(self) -> np.ndarray:
+        return self.data[0]
+
+    @property
+    def y(self) -> np.ndarray:
+        return self.data[1]
+
+    @property
+    def speed(self) -> np.ndarray:
+        return self.data[2]
+
+    @property
+    def direction(self) -> np.ndarray:
+        return self.data[3]
+
+    @property
+    def width(self) -> np.ndarray:
+        return self.data[4]
+
+    @property
+    def pressure(self) -> np.ndarray:
+        return self.data[5]
+
+    def coords(self) -> np.ndarray:
+        """x and y of each point, as a float64 array of shape (n, 2), relative to the line's origin."""
+        return self.data[:2].T.astype(float)
+
+
+class PackedLines:
+    """The points of `lines`, packed into one block of arrays.
+
+    `offsets` gives the position of each line's origin on the page. Look up
+    the points of a line with `geometry`, and its extents with `extents`.
+
+    `children` can give the `(child_id, child)` pairs of groups, in order, as
+    `{id(group): (group, children)}`, to be looked up with `children`.
+    """
+
+    def __init__(self, lines: tp.Sequence[si.Line], offsets: tp.Sequence[tp.Tuple[float, float]],
+                 children: tp.Dict[int, tp.Tuple[si.Group, list]] | None = None):
+        # Keep references to the lines so that their ids can't be reused
+        self.lines = list(lines)
+        self.offsets = [(float(x), float(y)) for x, y in offsets]
+        self._index = {id(line): i for i, line in enumerate(self.lines)}
+        self._children = {} if children is None else children
+        self._child_positions = {}
+
+        counts = np.array([len(line.points) for line in self.lines], dtype=np.int64)
+        self.starts = np.concatenate(([0], np.cumsum(counts)))
+        self.data = pack_points([p for line in self.lines for p in line.points])
+
+        # Extents of each line with any points, relative to its origin
+        self._extents = [None] * len(self.lines)
+        nonempty = np.flatnonzero(counts)
+        if len(nonempty):
+            x, y = self.data[0], self.data[1]
+            starts = self.starts[nonempty]
+            columns = [np.minimum.reduceat(x, starts), np.maximum.reduceat(x, starts),
+                       np.minimum.reduceat(y, starts), np.maximum.reduceat(y, starts)]
+            # Each reduction runs to the next start, so correct those followed by empty lines
+            ends = self.starts[nonempty + 1]
+            short = np.flatnonzero(ends < np.append(starts[1:], len(x)))
+            for j in short.tolist():
+                start, end = int(starts[j]), int(ends[j])
+                columns[0][j], columns[1][j] = x[start:end].min(), x[start:end].max()
+                columns[2][j], columns[3][j] = y[start:end].min(), y[start:end].max()
+            for i, extents in zip(nonempty.tolist(), zip(*(c.tolist() for c in columns))):
+                self._extents[i] = extents
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __contains__(self, line: si.Line):
+        return id(line) in self._index
+
+    @property
+    def n_points(self) -> int:
+        return self.data.shape[1]
+
+    def geometry(self, line: si.Line) -> LineGeometry:
+        """The points of `line`, which must be one of the packed lines."""
+        i = self._index[id(line)]
+        return LineGeometry(self.data[:, self.starts[i]:self.starts[i + 1]], self.offsets[i])
+
+    def children(self, group: si.Group) -> tp.Optional[list]:
+        """`(child_id, child)` for each child of `group` in order, or None if not known."""
+        entry = self._children.get(id(group))
+        return entry[1] if entry is not None else None
+
+    def index(self, line: si.Line) -> int:
+        """Position of `line` among the packed lines, which is its drawing order."""
+        return self._index[id(line)]
+
+    def visible_positions(self, group: si.Group, visible: np.ndarray) -> tp.Optional[np.ndarray]:
+        """Positions in `children(group)` of the child groups, and of the child lines in `visible`.
+
+        `visible` is a sorted array of line indices (see `index`). Returns
+        None if the children of `group` are not known.
+        """
+        children = self.children(group)
+        if children is None:
+            return None
+        if id(group) not in self._child_positions:
+            group_positions, line_positions, line_indices = [], [], []
+            for position, (_, child) in enumerate(children):
+                if isinstance(child, si.Group):
+                    group_positions.append(position)
+                elif isinstance(child, si.Line) and child in self:
+                    line_positions.append(position)
+                    line_indices.append(self.index(child))
+            self._child_positions[id(group)] = (np.array(group_positions, dtype=np.int64),
+                                                np.array(line_positions, dtype=np.int64),
+                                                np.array(line_indices, dtype=np.int64))
+        group_positions, line_positions, line_indices = self._child_positions[id(group)]
+        if not len(line_indices):
+            return group_positions
+        # A group's lines are packed in order, so only look at the visible
+        # lines in the range of its line indices
+        lo, hi = np.searchsorted(visible, (line_indices[0], line_indices[-1] + 1))
+        candidates = visible[lo:hi]
+        found = np.searchsorted(line_indices, candidates)
+        found = found[line_indices[found] == candidates]
+        return np.union1d(group_positions, line_positions[found])
+
+    def extents(self, line: si.Line) -> tp.Optional[tp.Tuple[float, float, float, float]]:
+        """Extents `(x_min, x_max, y_min, y_max)` of `line`, relative to its origin, or None if it has no points."""
+        return self._extents[self._index[id(line)]]
@@ -0,0 +1,204 @@
+"""Convert SVG files to PDF using long-running Inkscape processes.
+
+Starting Inkscape takes much longer than converting a typical page, so instead
+of running a new process for every file, `InkscapeWorker` keeps one running in
+its interactive shell mode (`inkscape --shell`) and sends it export actions.
+"""
+
+import atexit
+import logging
+import os
+import queue
+import shutil
+import subprocess
+import threading
+import time
+import typing as tp
+
+_logger = logging.getLogger(__name__)
+
+INKSCAPE_PATHS = [
+    "inkscape",
+    # Default MacOS path
+    "/Applications/Inkscape.app/Contents/MacOS/inkscape",
+]
+
+
+# Number of files converted in one batch of actions
+BATCH_SIZE = 20
+
+
+class InkscapeError(RuntimeError):
+    """Inkscape failed to convert a file."""
+
+
+def find_inkscape() -> str:
+    """Return the path of the Inkscape executable."""
+    for path in INKSCAPE_PATHS:
+        found = shutil.which(path)
+        if found is not None:
+            return found
+    raise FileNotFoundError("Inkscape not found in path")
+
+
+def export_actions(svg_path, pdf_path) -> tp.List[str]:
+    """Inkscape actions to convert `svg_path` to `pdf_path`."""
+    return [f"file-open:{svg_path}", f"export-filename:{pdf_path}", "export-do", "file-close"]
+
+
+class InkscapeWorker:
+    """An Inkscape process running in shell mode.
+
+    The process is started when first needed, and restarted if it exits or
+    stops responding.
+    """
+
+    PROMPT = b"> "
+
+    def __init__(self, executable: tp.Optional[str] = None, timeout: float = 120.0):
+        self.executable = executable
+        self.timeout = timeout
+        self._process = None
+        self._output = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def running(self) -> bool:
+        return self._process is not None and self._process.poll() is None
+
+    def start(self):
+        if self.executable is None:
+            self.executable = find_inkscape()
+        _logger.info("Starting Inkscape shell: %s", self.executable)
+        self._process = subprocess.Popen([self.executable, "--shell"],
+                                         stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE)
+        # Read output in a thread so that waiting for the prompt can time out
+        self._output = queue.Queue()
+        reader = threading.Thread(target=_read_output, args=(self._process.stdout, self._output), daemon=True)
+        reader.start()
+        self._wait_for_prompt()
+
+    def close(self):
+        """Stop the Inkscape process."""
+        if self._process is None:
+            return
+        process, self._process = self._process, None
+        try:
+            if process.poll() is None:
+                process.stdin.write(b"quit\n")
+                process.stdin.close()
+                process.wait(timeout=5)
+        except (OSError, subprocess.TimeoutExpired):
+            process.kill()
+            process.wait()
+
+    def _wait_for_prompt(self) -> bytes:
+        received = b""
+        deadline = time.monotonic() + self.timeout
+        while not received.endswith(self.PROMPT):
+            try:
+                data = self._output.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                raise InkscapeError("Timed out waiting for Inkscape")
+            if not data:
+                raise InkscapeError("Inkscape exited unexpectedly")
+            received += data
+        return received
+
+    def run(self, actions: tp.Sequence[str]) -> bytes:
+        """Run `actions` and wait for them to finish, returning Inkscape's output."""
+        if not self.running:
+            self.start()
+        self._process.stdin.write(("; ".join(actions) + "\n").encode())
+        self._process.stdin.flush()
+        return self._wait_for_prompt()
+
+    def convert(self, jobs: tp.Sequence[tp.Tuple[str, str]]):
+        """Convert each `(svg_path, pdf_path)` in `jobs` in one batch of actions.
+
+        If Inkscape fails, it is restarted and the batch is tried once more.
+        """
+        if self.executable is None:
+            self.executable = find_inkscape()
+        actions = [action for svg_path, pdf_path in jobs for action in export_actions(svg_path, pdf_path)]
+        for attempt in range(2):
+            try:
+                self.run(actions)
+                missing = [pdf_path for _, pdf_path in jobs
+                           if not os.path.exists(pdf_path) or os.path.getsize(pdf_path) == 0]
+                if missing:
+                    raise InkscapeError("Inkscape did not write %s" % ", ".join(map(str, missing)))
+                return
+            except (InkscapeError, OSError) as e:
+                _logger.warning("Inkscape conversion failed (%s), restarting Inkscape", e)
+                self._kill()
+                if attempt > 0:
+                    raise
+
+    def _kill(self):
+        if self._process is not None:
+            self._process.kill()
+            self._process.wait()
+            self._process = None
+
+
+def _read_output(stream, output: queue.Queue):
+    while True:
+        data = stream.read1(4096)
+        output.put(data)
+        if not data:
+            break
+
+
+class InkscapePool:
+    """A fixed number of `InkscapeWorker`s, shared between threads."""
+
+    def __init__(self, size: int = 1, **kwargs):
+        self._workers = [InkscapeWorker(**kwargs) for _ in range(size)]
+        self._idle = queue.LifoQueue()
+        for worker in self._workers:
+            self._idle.put(worker)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def convert(self, jobs: tp.Sequence[tp.Tuple[str, str]], batch_size: int = BATCH_SIZE):
+        """Convert each `(svg_path, pdf_path)` in `jobs`, `batch_size` files at a time."""
+        for i in range(0, len(jobs), batch_size):
+            worker = self._idle.get()
+            try:
+                worker.convert(jobs[i:i + batch_size])
+            finally:
+                self._idle.put(worker)
+
+    def close(self):
+        for worker in self._workers:
+            worker.close()
+
+
+_default_pool: tp.Optional[InkscapePool] = None
+_default_pool_lock = threading.Lock()
+
+
+def default_pool() -> InkscapePool:
+    """Return the Inkscape pool shared within this process, creating it if needed.
+
+    The number of workers can be set with the `RMC_INKSCAPE_WORKERS`
+    environment variable (default 1).
+    """
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            size = int(os.environ.get("RMC_INKSCAPE_WORKERS", "1"))
+            _default_pool = InkscapePool(size)
+            atexit.register(_default_pool.close)
+        return _default_pool
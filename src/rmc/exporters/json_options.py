@@ -0,0 +1,8 @@
+"""Options of the JSON exporters, which the command line needs before they are imported.
+
+Kept apart from `rmc.exporters.ndjson`, which imports rmscene, so that
+starting `rmc` stays quick.
+"""
+
+# How the points of lines are written: in full, as their count and extents, or not at all
+POINTS_MODES = ("all", "summary", "none")
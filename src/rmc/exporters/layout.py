@@ -0,0 +1,364 @@
+"""Layout of a page: positions of its text, anchors and groups, and their extents.
+
+This is shared by the exporters, and by commands which only need the text or
+the page size, so it doesn't import NumPy until the points of the lines are
+packed (see `PageLayout.lines`).
+"""
+
+import logging
+import typing as tp
+from functools import cached_property
+
+from rmscene import CrdtId, SceneTree
+from rmscene import scene_items as si
+from rmscene.text import Paragraph, TextDocument
+
+from .. import profile
+
+if tp.TYPE_CHECKING:
+    import numpy as np
+    from .geometry import PackedLines
+
+_logger = logging.getLogger(__name__)
+
+SCREEN_WIDTH = 1404
+SCREEN_HEIGHT = 1872
+SCREEN_DPI = 226
+
+SCALE = 72.0 / SCREEN_DPI
+
+PAGE_WIDTH_PT = SCREEN_WIDTH * SCALE
+PAGE_HEIGHT_PT = SCREEN_HEIGHT * SCALE
+X_SHIFT = PAGE_WIDTH_PT // 2
+
+# Minimum bounding box of a page, in screen units
+SCREEN_BOUNDING_BOX = (- SCREEN_WIDTH // 2, SCREEN_WIDTH // 2, 0, SCREEN_HEIGHT)
+
+
+def scale(screen_unit: float) -> float:
+    return screen_unit * SCALE
+
+
+# For now, at least, the xx and yy function are identical to scale
+xx = scale
+yy = scale
+
+TEXT_TOP_Y = -88
+LINE_HEIGHTS = {
+    # Based on a rm file having 4 anchors based on the line height I was able to find a value of
+    # 69.5, but decided on 70 (to keep integer values)
+    si.ParagraphStyle.PLAIN: 70,
+    si.ParagraphStyle.BULLET: 35,
+    si.ParagraphStyle.BULLET2: 35,
+    si.ParagraphStyle.BOLD: 70,
+    si.ParagraphStyle.HEADING: 150,
+    si.ParagraphStyle.CHECKBOX: 35,
+    si.ParagraphStyle.CHECKBOX_CHECKED: 35,
+
+    # There appears to be another format code (value 0) which is used when the
+    # text starts far down the page, which case it has a negative offset (line
+    # height) of about -20?
+    #
+    # Probably, actually, the line height should be added *after* the first
+    # line, but there is still something a bit odd going on here.
+}
+
+
+def build_anchor_pos(text: tp.Optional[si.Text],
+                     paragraphs: tp.Optional[tp.List["ParagraphLayout"]] = None) -> tp.Dict[CrdtId, int]:
+    """
+    Find the anchor pos
+
+    :param text: the root text of the remarkable file
+    :param paragraphs: the layout of `text`, if already known
+    """
+    # Special anchors adjusted based on pen_size_test.strokes.rm
+    anchor_pos = {
+        CrdtId(0, 281474976710654): 100,
+        CrdtId(0, 281474976710655): 100,
+    }
+
+    if text is not None:
+        if paragraphs is None:
+            paragraphs = layout_paragraphs(text, TextDocument.from_scene_item(text))
+        # Save anchor from text
+        for p, top, _ in paragraphs:
+            anchor_pos[p.start_id] = top
+            for subp in p.contents:
+                for k in subp.i:
+                    anchor_pos[k] = top  # TODO check these anchor are used
+
+    return anchor_pos
+
+
+class ParagraphLayout(tp.NamedTuple):
+    """Position of a paragraph of the root text, in screen units."""
+
+    paragraph: Paragraph
+
+    # Top of the paragraph, which groups are anchored to
+    top: float
+
+    # Where the paragraph's text is drawn
+    baseline: float
+
+
+def layout_paragraphs(text: si.Text, doc: TextDocument) -> tp.List[ParagraphLayout]:
+    """Lay out the paragraphs of `doc`, the contents of root text `text`."""
+    result = []
+    ypos = text.pos_y + TEXT_TOP_Y
+    y_offset = TEXT_TOP_Y
+    for p in doc.contents:
+        line_height = LINE_HEIGHTS.get(p.style.value, 70)
+        y_offset += line_height
+        result.append(ParagraphLayout(p, ypos, text.pos_y + y_offset))
+        ypos += line_height
+    return result
+
+
+class PageLayout:
+    """Text layout, anchor positions, line points and extents of a scene tree, found once.
+
+    Building the `TextDocument` from the root text's CRDT sequences is slow
+    on text-heavy pages, so each part is only worked out when first needed,
+    and exporters share one `PageLayout` rather than starting from the tree.
+
+    Packing the points of the lines (`lines`) takes as much memory again as
+    the points themselves, so it is only done for drawing parts of the page
+    (see `visible_lines`), where the same page is usually drawn many times.
+    Drawing the whole page packs the points of one line at a time, unless
+    they have already been packed (see `packed_lines`).
+    """
+
+    def __init__(self, tree: SceneTree):
+        self.tree = tree
+
+    @cached_property
+    def text_document(self) -> tp.Optional[TextDocument]:
+        """The contents of the root text, or None if there is none."""
+        if self.tree.root_text is None:
+            return None
+        with profile.stage("text_document"):
+            return TextDocument.from_scene_item(self.tree.root_text)
+
+    @cached_property
+    def paragraphs(self) -> tp.List[ParagraphLayout]:
+        """Position of each paragraph of the root text."""
+        if self.text_document is None:
+            return []
+        return layout_paragraphs(self.tree.root_text, self.text_document)
+
+    @cached_property
+    def anchor_pos(self) -> tp.Dict[CrdtId, int]:
+        """y position of each anchor, as from `build_anchor_pos`."""
+        paragraphs = self.paragraphs
+        with profile.stage("anchors"):
+            return build_anchor_pos(self.tree.root_text, paragraphs)
+
+    @cached_property
+    def lines(self) -> "PackedLines":
+        """The points of every line in the tree, packed into arrays, as from `pack_lines`."""
+        anchor_pos = self.anchor_pos
+        with profile.stage("pack"):
+            lines = pack_lines(self.tree.root, anchor_pos)
+        if "extents" in self.__dict__:
+            # Look up line extents and the order of children from now on
+            self.extents.packed = lines
+        return lines
+
+    @property
+    def packed_lines(self) -> tp.Optional["PackedLines"]:
+        """`lines` if the points have already been packed, otherwise None."""
+        return self.__dict__.get("lines")
+
+    @cached_property
+    def extents(self) -> "ExtentsCache":
+        return ExtentsCache(self.anchor_pos, self.packed_lines)
+
+    @cached_property
+    def stroke_index(self) -> "StrokeIndex":
+        """Spatial index of the lines on the page, for finding those in a viewport."""
+        from ..spatial import StrokeIndex
+        self.lines  # packed first, so that packing isn't timed as indexing
+        with profile.stage("index"):
+            return StrokeIndex.from_tree(self.tree, self)
+
+    def visible_lines(self, viewport: "Extents") -> "np.ndarray":
+        """Indices in `lines` of the lines which might be seen in `viewport` (on the page), sorted."""
+        import numpy as np
+        entries = self.stroke_index.query(viewport, STROKE_MARGIN)
+        return np.sort(np.fromiter((self.lines.index(entry.line) for entry in entries),
+                                   dtype=np.int64, count=len(entries)))
+
+
+def pack_lines(root: si.Group, anchor_pos: tp.Dict[CrdtId, int]) -> "PackedLines":
+    """Pack the points of the lines within `root`, in drawing order.
+
+    The offset of each line is the sum of the anchor offsets of the groups
+    containing it. The order of each group's children is recorded too.
+    """
+    from .geometry import PackedLines
+    lines = []
+    offsets = []
+    children = {}
+
+    def visit(group, x, y):
+        anchor_x, anchor_y = get_anchor(group, anchor_pos)
+        x += anchor_x
+        y += anchor_y
+        items = group.children.items()
+        children[id(group)] = (group, items)
+        for _, child in items:
+            if isinstance(child, si.Group):
+                visit(child, x, y)
+            elif isinstance(child, si.Line):
+                lines.append(child)
+                offsets.append((x, y))
+
+    visit(root, 0.0, 0.0)
+    return PackedLines(lines, offsets, children)
+
+
+def ordered_children(item: si.Group, lines: tp.Optional["PackedLines"] = None):
+    """`(child_id, child)` for each child of `item`, in order.
+
+    The order recorded in `lines` is used if it has one for `item`, as
+    sorting the children again is slow.
+    """
+    if lines is not None:
+        children = lines.children(item)
+        if children is not None:
+            return children
+    return item.children.items()
+
+
+def get_anchor(item: si.Group, anchor_pos):
+    anchor_x = 0.0
+    anchor_y = 0.0
+    if item.anchor_id is not None:
+        assert item.anchor_origin_x is not None
+        anchor_x = item.anchor_origin_x.value
+        if item.anchor_id.value in anchor_pos:
+            anchor_y = anchor_pos[item.anchor_id.value]
+            _logger.debug("Group anchor: %s -> y=%.1f (scalded y=%.1f)",
+                          item.anchor_id.value,
+                          anchor_y,
+                          yy(anchor_y))
+        else:
+            _logger.warning("Group anchor: %s is unknown!", item.anchor_id.value)
+
+    return anchor_x, anchor_y
+
+
+def get_bounding_box(item: si.Group,
+                     anchor_pos: tp.Dict[CrdtId, int],
+                     default: tp.Tuple[int, int, int, int] = SCREEN_BOUNDING_BOX,
+                     extents: tp.Optional["ExtentsCache"] = None) \
+        -> tp.Tuple[int, int, int, int]:
+    """
+    Get the bounding box of the given item.
+    The minimum size is the default size of the screen.
+
+    :param extents: cache of group and line extents to use (which should have
+    been made with the same `anchor_pos`); by default a new one is made.
+    :return: x_min, x_max, y_min, y_max: the bounding box in screen units (need to be scalded using xx and yy functions)
+    """
+    if extents is None:
+        extents = ExtentsCache(anchor_pos)
+    with profile.stage("bounding_box"):
+        return union_extents(default, extents.children(item))
+
+
+Extents = tp.Tuple[float, float, float, float]
+
+
+def union_extents(a: tp.Optional[Extents], b: tp.Optional[Extents]) -> tp.Optional[Extents]:
+    """Smallest extents containing both `a` and `b` (either of which may be None)."""
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return min(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), max(a[3], b[3])
+
+
+def points_extents(points: tp.Sequence[si.Point]) -> tp.Optional[Extents]:
+    """Extents `(x_min, x_max, y_min, y_max)` of `points`, or None if there are none."""
+    if not points:
+        return None
+    # For the few tens of points in a typical line, this is quicker than
+    # building a NumPy array first
+    xs = [p.x for p in points]
+    ys = [p.y for p in points]
+    return min(xs), max(xs), min(ys), max(ys)
+
+
+class ExtentsCache:
+    """Extents of the groups and lines in a scene tree, computed once.
+
+    Extents are `(x_min, x_max, y_min, y_max)` in screen units, relative to
+    the containing group -- the extents of a group's children don't include
+    the group's own anchor offset. A group's extents include its origin, as
+    its anchor point.
+
+    The cache holds the extents of every item it has been asked about, so it
+    can be shared between exporters, or used to find the page size without
+    rendering anything. If `lines` is given, the extents of the lines packed
+    in it are used rather than working them out again.
+    """
+
+    def __init__(self, anchor_pos: tp.Dict[CrdtId, int], lines: tp.Optional["PackedLines"] = None):
+        self.anchor_pos = anchor_pos
+        self.packed = lines
+        self._lines = {}
+        self._groups = {}
+
+    def line(self, item: si.Line) -> tp.Optional[Extents]:
+        """Extents of the points of `item`, or None if it has no points."""
+        if self.packed is not None and item in self.packed:
+            return self.packed.extents(item)
+        key = id(item)
+        if key not in self._lines:
+            # keep a reference to the item so that its id can't be reused
+            self._lines[key] = (item, points_extents(item.points))
+        return self._lines[key][1]
+
+    def children(self, item: si.Group) -> tp.Optional[Extents]:
+        """Extents of the children of `item`, or None if it has none."""
+        key = id(item)
+        if key not in self._groups:
+            extents = None
+            for _, child in ordered_children(item, self.packed):
+                if isinstance(child, si.Group):
+                    extents = union_extents(extents, self.group(child))
+                elif isinstance(child, si.Line):
+                    extents = union_extents(extents, self.line(child))
+            self._groups[key] = (item, extents)
+        return self._groups[key][1]
+
+    def group(self, item: si.Group) -> Extents:
+        """Extents of `item`, including its origin and its anchor offset."""
+        anchor_x, anchor_y = get_anchor(item, self.anchor_pos)
+        x_min, x_max, y_min, y_max = union_extents((0, 0, 0, 0), self.children(item))
+        return x_min + anchor_x, x_max + anchor_x, y_min + anchor_y, y_max + anchor_y
+
+
+def get_page_extents(tree: SceneTree) -> Extents:
+    """Extents of the page (at least the screen size) for `tree`, without rendering it."""
+    layout = PageLayout(tree)
+    return get_bounding_box(tree.root, layout.anchor_pos, extents=layout.extents)
+
+
+# Lines are drawn wider than their points, so lines within this distance (in
+# screen units) of a viewport are drawn in case they overlap it.
+STROKE_MARGIN = 50
+
+
+def extents_overlap(a: Extents, b: Extents, margin: float = 0) -> bool:
+    """Whether extents `a` and `b` overlap, or are within `margin` of each other."""
+    return (a[0] - margin <= b[1] and b[0] - margin <= a[1]
+            and a[2] - margin <= b[3] and b[2] - margin <= a[3])
+
+
+def shift_extents(extents: Extents, dx: float, dy: float) -> Extents:
+    x_min, x_max, y_min, y_max = extents
+    return x_min + dx, x_max + dx, y_min + dy, y_max + dy
@@ -1,19 +1,27 @@
 """Export text content of rm files as Markdown."""
 
-from rmscene import read_tree
+from rmscene import SceneTree, read_tree
 from rmscene import scene_items as si
 
 from rmscene.text import TextDocument
 
+from .layout import PageLayout
+
 
 def print_text(f, fout):
     tree = read_tree(f)
+    tree_to_markdown(tree, fout)
+
+
+def tree_to_markdown(tree: SceneTree, fout, layout: PageLayout | None = None):
+    if layout is None:
+        layout = PageLayout(tree)
 
     # Find out what anchor characters are used
     anchor_ids = set(collect_anchor_ids(tree.root))
 
     if tree.root_text:
-        print_root_text(tree.root_text, fout, anchor_ids)
+        print_root_text(tree.root_text, fout, anchor_ids, layout.text_document)
 
     JOIN_TOLERANCE = 2
     print("\n\n# Highlights", file=fout)
@@ -27,8 +35,9 @@ def print_text(f, fout):
     print(file=fout)
 
 
-def print_root_text(root_text: si.Text, fout, anchor_ids):
-    doc = TextDocument.from_scene_item(root_text)
+def print_root_text(root_text: si.Text, fout, anchor_ids, doc: TextDocument | None = None):
+    if doc is None:
+        doc = TextDocument.from_scene_item(root_text)
     for p in doc.contents:
         annotated_line = annotate_anchor_ids(anchor_ids,
                                              str(p),
@@ -0,0 +1,127 @@
+"""Dump the blocks or scene tree of rm files as JSON, one object per line.
+
+Unlike the `blocks` and `tree` formats, which are for reading, this output can
+be read by other programs, e.g. `jq`. Blocks are written one at a time as they
+are read, so dumping the blocks of a large file takes little memory.
+
+Values are converted as follows:
+
+- Blocks and scene items become objects, with their class name as `type`.
+- Ids (`CrdtId`) become strings "part1,part2", as in the anchors shown in
+  Markdown output.
+- Enums become their names.
+- Bytes become hex strings.
+- Sequences (`CrdtSequence`) become lists of `{"id": ..., "value": ...}`, in order.
+
+The points of lines can be written in full (as an object with a list for
+each of x, y, speed, direction, width and pressure), summarised by their
+count and extents, or left out; see `POINTS_MODES`.
+"""
+
+import dataclasses
+import enum
+import json
+import uuid
+
+from rmscene import SceneTree, read_blocks
+from rmscene import scene_items as si
+from rmscene.crdt_sequence import CrdtSequence
+from rmscene.tagged_block_common import CrdtId
+
+from .json_options import POINTS_MODES  # noqa: F401
+
+_POINT_FIELDS = [field.name for field in dataclasses.fields(si.Point)]
+
+
+def blocks_to_ndjson(f, fout, points: str = "all"):
+    """Write each block read from binary stream `f` as a line of JSON to `fout`."""
+    for block in read_blocks(f):
+        write_line(to_json(block, points), fout)
+
+
+def tree_to_ndjson(tree: SceneTree, fout, points: str = "all"):
+    """Write each node of `tree` as a line of JSON to `fout`.
+
+    Nodes are written depth first, in order, starting from the root group.
+    Each has its `id`, and the `parent` id of the group containing it; groups
+    don't include their children. The root text is written last, with `id`
+    and `parent` null.
+    """
+    stack = [(None, tree.root.node_id, tree.root)]
+    while stack:
+        parent_id, node_id, item = stack.pop()
+        if isinstance(item, si.Group):
+            record = {"type": "Group", "id": format_id(node_id), "parent": format_id(parent_id)}
+            record.update((field.name, to_json(getattr(item, field.name), points))
+                          for field in dataclasses.fields(item) if field.name not in ("node_id", "children"))
+            write_line(record, fout)
+            stack.extend((node_id, child_id, child) for child_id, child in reversed(item.children.items()))
+        elif item is not None:
+            record = to_json(item, points)
+            write_line({"type": record.pop("type"), "id": format_id(node_id), "parent": format_id(parent_id),
+                        **record}, fout)
+    if tree.root_text is not None:
+        record = to_json(tree.root_text, points)
+        write_line({"type": record.pop("type"), "id": None, "parent": None, **record}, fout)
+
+
+def write_line(record: dict, fout):
+    fout.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")))
+    fout.write("\n")
+
+
+def format_id(crdt_id: CrdtId | None) -> str | None:
+    return None if crdt_id is None else f"{crdt_id.part1},{crdt_id.part2}"
+
+
+def to_json(value, points: str = "all"):
+    """Convert `value`, from a block or scene tree, to plain JSON values."""
+    if value is None or isinstance(value, (str, bool, float)):
+        return value
+    if isinstance(value, enum.Enum):
+        return value.name
+    if isinstance(value, int):
+        return value
+    if isinstance(value, CrdtId):
+        return format_id(value)
+    if isinstance(value, (bytes, bytearray)):
+        return value.hex()
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    if isinstance(value, CrdtSequence):
+        return [{"id": format_id(item_id), "value": to_json(item, points)} for item_id, item in value.items()]
+    if isinstance(value, si.Line):
+        return _line_to_json(value, points)
+    if dataclasses.is_dataclass(value):
+        return {"type": type(value).__name__,
+                **{field.name: to_json(getattr(value, field.name), points) for field in dataclasses.fields(value)}}
+    if isinstance(value, (list, tuple)):
+        return [to_json(item, points) for item in value]
+    if isinstance(value, dict):
+        return {_key(key): to_json(item, points) for key, item in value.items()}
+    return repr(value)
+
+
+def _key(key) -> str:
+    if isinstance(key, CrdtId):
+        return format_id(key)
+    if isinstance(key, enum.Enum):
+        return key.name
+    return str(key)
+
+
+def _line_to_json(line: si.Line, points: str) -> dict:
+    record = {"type": "Line"}
+    for field in dataclasses.fields(line):
+        if field.name != "points":
+            record[field.name] = to_json(getattr(line, field.name), points)
+    if points == "all":
+        record["points"] = {name: [getattr(p, name) for p in line.points] for name in _POINT_FIELDS}
+    elif points == "summary":
+        xs = [p.x for p in line.points]
+        ys = [p.y for p in line.points]
+        record["points"] = {"count": len(line.points),
+                            "extents": [min(xs), max(xs), min(ys), max(ys)] if line.points else None}
+    elif points != "none":
+        raise ValueError(f"Unknown points mode {points!r}")
+    return record
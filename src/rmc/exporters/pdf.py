@@ -1,46 +1,355 @@
 """Convert blocks to pdf file.
 
+PDF output is written directly by `tree_to_pdf`. Alternatively, SVG output can
+be converted using Inkscape (`svg_to_pdf`, `rm_to_pdf`), which is kept running
+between conversions (see `rmc.exporters.inkscape`).
+
 Code originally from https://github.com/lschwetlick/maxio through
 https://github.com/chemag/maxio .
 """
 
 import logging
-from tempfile import NamedTemporaryFile
-from subprocess import check_call
+import os
+import typing as tp
+import zlib
+from tempfile import TemporaryDirectory
+
+from rmscene import SceneTree, read_tree
+from rmscene import scene_items as si
+from rmscene.text import TextDocument
 
+from .. import profile
+from .inkscape import default_pool
+from .geometry import LineGeometry, PackedLines
+from .layout import (get_anchor, get_bounding_box, layout_paragraphs, ordered_children, PageLayout,
+                     ParagraphLayout, scale, xx, yy, SCALE)
 from .svg import rm_to_svg
+from .simplify import Simplifier
+from .writing_tools import Pen, segment_indices
 
 _logger = logging.getLogger(__name__)
 
+LINECAPS = {
+    "butt": 0,
+    "round": 1,
+    "square": 2,
+}
+
+# Standard PDF fonts (which don't need embedding) matching the text styles used
+# in SVG output.
+TEXT_FONTS = {
+    "heading": ("Times-Roman", 14),
+    "bold": ("Helvetica-Bold", 8),
+}
+DEFAULT_TEXT_FONT = ("Helvetica", 7)
+
 
-def rm_to_pdf(rm_path, pdf_path, debug=0):
+def rm_to_pdf(rm_path, pdf_path, debug=0, use_inkscape=False):
     """Convert `rm_path` to PDF at `pdf_path`."""
-    with NamedTemporaryFile(suffix=".svg") as f_temp:
-        rm_to_svg(rm_path, f_temp.name)
+    if not use_inkscape:
+        with open(rm_path, "rb") as infile, open(pdf_path, "wb") as outfile:
+            tree = read_tree(infile)
+            tree_to_pdf(tree, outfile)
+        return
+
+    with TemporaryDirectory() as tmpdir:
+        svg_path = os.path.join(tmpdir, "page.svg")
+        rm_to_svg(rm_path, svg_path)
 
         # use inkscape to convert svg to pdf
-        check_call(["inkscape", f_temp.name, "--export-filename", pdf_path])
+        default_pool().convert([(svg_path, os.path.abspath(pdf_path))])
 
 
 def svg_to_pdf(svg_file, pdf_file):
-    """Read svg data from `svg_file` and write PDF data to `pdf_file`."""
+    """Read svg data from `svg_file` and write PDF data to `pdf_file`.
+
+    The conversion is done by Inkscape, which is kept running between calls.
+    """
+    with TemporaryDirectory() as tmpdir:
+        svg_path = os.path.join(tmpdir, "page.svg")
+        pdf_path = os.path.join(tmpdir, "page.pdf")
+        with open(svg_path, "w") as fsvg:
+            fsvg.write(svg_file.read())
 
-    with NamedTemporaryFile("w", suffix=".svg") as fsvg, NamedTemporaryFile("rb", suffix=".pdf") as fpdf:
-        fsvg.write(svg_file.read())
-        fsvg.flush() # Make sure content is writen to the file
-        
         # use inkscape to convert svg to pdf
-        try:
-            print("Convert SVG to PDF using Inkscape")
-            check_call(["inkscape", fsvg.name, "--export-filename", fpdf.name])
-        except FileNotFoundError:
-            print("Inkscape not found in path")
-
-            try:
-                print("Convert SVG to PDF using Inkscape (default MacOS path)")
-                check_call(["/Applications/Inkscape.app/Contents/MacOS/inkscape", fsvg.name, "--export-filename", fpdf.name])
-            except FileNotFoundError:
-                pass
-
-        pdf_file.write(fpdf.read())
+        _logger.info("Convert SVG to PDF using Inkscape")
+        with profile.stage("inkscape"):
+            default_pool().convert([(svg_path, pdf_path)])
+
+        with open(pdf_path, "rb") as fpdf:
+            pdf_file.write(fpdf.read())
         pdf_file.flush()
+
+
+def tree_to_pdf(tree: SceneTree, output, simplifier: Simplifier | None = None,
+                layout: PageLayout | None = None):
+    """Convert Blocks to a single-page PDF, written to binary stream `output`.
+
+    `layout` can be given to reuse the text layout and extents already worked
+    out for `tree` by another exporter.
+    """
+    writer = PdfWriter(output)
+    draw_page(tree, writer, simplifier, layout)
+    writer.close()
+
+
+def trees_to_pdf(trees: tp.Iterable[SceneTree], output, simplifier: Simplifier | None = None):
+    """Convert each of `trees` to a page of one PDF, written to `output`.
+
+    Each page is written out as soon as it has been drawn, so `trees` can be a
+    generator which reads the files one at a time.
+    """
+    writer = PdfWriter(output)
+    for tree in trees:
+        draw_page(tree, writer, simplifier)
+    writer.close()
+
+
+def draw_page(tree: SceneTree, writer: "PdfWriter", simplifier: Simplifier | None = None,
+              layout: PageLayout | None = None):
+    """Draw `tree` as a new page of `writer`.
+
+    The page has the same size and layout as the SVG output. If `simplifier` is
+    given, strokes are simplified to within its tolerance.
+    """
+    if layout is None:
+        layout = PageLayout(tree)
+    anchor_pos = layout.anchor_pos
+    x_min, x_max, y_min, y_max = get_bounding_box(tree.root, anchor_pos, extents=layout.extents)
+    width_pt = xx(x_max - x_min + 1)
+    height_pt = yy(y_max - y_min + 1)
+
+    canvas = PdfCanvas()
+    # Flip the y axis so that drawing uses the same coordinates as the SVG
+    canvas.transform(1, 0, 0, -1, -xx(x_min), yy(y_min) + height_pt)
+
+    if tree.root_text is not None:
+        paragraphs = layout.paragraphs
+        with profile.stage("text"):
+            draw_text(tree.root_text, canvas, paragraphs)
+
+    with profile.stage("draw"):
+        draw_group(tree.root, canvas, anchor_pos, simplifier, layout.packed_lines)
+
+    with profile.stage("write"):
+        writer.add_page(width_pt, height_pt, canvas)
+
+
+def draw_group(item: si.Group, canvas: "PdfCanvas", anchor_pos, simplifier=None, lines: PackedLines | None = None):
+    anchor_x, anchor_y = get_anchor(item, anchor_pos)
+    canvas.save()
+    canvas.transform(1, 0, 0, 1, xx(anchor_x), yy(anchor_y))
+    profile.count(groups=1)
+    for _, child in ordered_children(item, lines):
+        if isinstance(child, si.Group):
+            draw_group(child, canvas, anchor_pos, simplifier, lines)
+        elif isinstance(child, si.Line):
+            draw_stroke(child, canvas, simplifier, lines.geometry(child) if lines is not None else None)
+    canvas.restore()
+
+
+def draw_stroke(item: si.Line, canvas: "PdfCanvas", simplifier=None, geometry: LineGeometry | None = None):
+    pen = Pen.create(item.tool.value, item.color.value, item.thickness_scale)
+    canvas.set_linecap(LINECAPS[pen.stroke_linecap])
+    if geometry is None:
+        geometry = LineGeometry.from_points(item.points)
+    coords = geometry.coords()
+    segments = 0
+    for indices, segment_rgb, segment_width, segment_opacity in segment_indices(pen, geometry, simplifier):
+        segments += 1
+        width = scale(segment_width)
+        if _fmt(width) == "0" or width < 0:
+            # PDF viewers draw "0 w" as the thinnest visible line, but SVG and PNG draw nothing
+            continue
+        canvas.set_stroke_rgb(segment_rgb)
+        canvas.set_line_width(width)
+        canvas.set_stroke_alpha(segment_opacity)
+        # Equivalent to xx(x) and yy(y) for each point
+        canvas.polyline((coords[indices] * SCALE).tolist())
+    profile.count(lines=1, points=len(geometry), segments=segments)
+
+
+def draw_text(text: si.Text, canvas: "PdfCanvas", paragraphs: tp.Optional[tp.List[ParagraphLayout]] = None):
+    if paragraphs is None:
+        paragraphs = layout_paragraphs(text, TextDocument.from_scene_item(text))
+    for p, _, ypos in paragraphs:
+        xpos = text.pos_x
+        cls = p.style.value.name.lower()
+        if str(p):
+            font, size = TEXT_FONTS.get(cls, DEFAULT_TEXT_FONT)
+            canvas.text(xx(xpos), yy(ypos), str(p).strip(), font, size)
+
+
+def _fmt(value: float) -> str:
+    """Format a number compactly for a PDF content stream."""
+    s = f"{value:.3f}".rstrip("0").rstrip(".")
+    return "0" if s in ("-0", "") else s
+
+
+def _pdf_string(text: str) -> str:
+    """Encode `text` as a PDF literal string using WinAnsiEncoding."""
+    data = text.encode("cp1252", errors="replace").decode("latin-1")
+    data = data.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+    data = data.replace("\r", "\\r").replace("\n", "\\n")
+    return f"({data})"
+
+
+class PdfCanvas:
+    """Build the content stream for one PDF page.
+
+    Graphics state is tracked so that operators are only written when a value
+    actually changes. Fonts and opacities used are recorded so that the page's
+    resources can be written along with it.
+    """
+
+    def __init__(self):
+        self.ops = []
+        self.fonts = set()
+        self.alphas = set()
+        self._state = {}
+        self._stack = []
+
+    def save(self):
+        self._stack.append(dict(self._state))
+        self.ops.append("q")
+
+    def restore(self):
+        self._state = self._stack.pop()
+        self.ops.append("Q")
+
+    def transform(self, a, b, c, d, e, f):
+        if (a, b, c, d, e, f) != (1, 0, 0, 1, 0, 0):
+            self.ops.append(" ".join(_fmt(v) for v in (a, b, c, d, e, f)) + " cm")
+
+    def _set(self, key, value, op):
+        if self._state.get(key) != value:
+            self._state[key] = value
+            self.ops.append(op)
+
+    def set_linecap(self, cap: int):
+        self._set("cap", cap, f"{cap} J")
+
+    def set_line_width(self, width: float):
+        self._set("width", width, f"{_fmt(width)} w")
+
+    def set_stroke_rgb(self, rgb):
+        self._set("rgb", tuple(rgb), " ".join(_fmt(c / 255) for c in rgb) + " RG")
+
+    def set_stroke_alpha(self, alpha: float):
+        alpha = round(min(max(alpha, 0), 1), 3)
+        self.alphas.add(alpha)
+        self._set("alpha", alpha, f"/{PdfWriter.alpha_name(alpha)} gs")
+
+    def polyline(self, points):
+        if not points:
+            return
+        (x0, y0), *rest = points
+        path = [f"{_fmt(x0)} {_fmt(y0)} m"]
+        if rest:
+            path.extend(f"{_fmt(x)} {_fmt(y)} l" for x, y in rest)
+        else:
+            # A zero-length line still gets drawn as a dot with round caps
+            path.append(f"{_fmt(x0)} {_fmt(y0)} l")
+        path.append("S")
+        self.ops.append(" ".join(path))
+
+    def text(self, x: float, y: float, text: str, font: str, size: float):
+        self.fonts.add(font)
+        # Flip the text matrix back, since the page coordinates have y down
+        self.ops.append(f"BT /{PdfWriter.font_name(font)} {_fmt(size)} Tf "
+                        f"1 0 0 -1 {_fmt(x)} {_fmt(y)} Tm {_pdf_string(text)} Tj ET")
+
+    def getvalue(self) -> bytes:
+        return "\n".join(self.ops).encode("latin-1")
+
+
+class PdfWriter:
+    """Write a PDF document incrementally.
+
+    Each object is written to `output` as soon as it is added, so only object
+    offsets are kept in memory. The page tree, catalog, cross-reference table
+    and trailer are written by `close()`.
+    """
+
+    def __init__(self, output):
+        self.output = output
+        self._pos = 0
+        self._offsets = []
+        self._page_ids = []
+        self._fonts = {}
+        self._alphas = {}
+        self._write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+        self._pages_id = self._reserve()
+
+    @staticmethod
+    def font_name(font: str) -> str:
+        return font.replace("-", "")
+
+    @staticmethod
+    def alpha_name(alpha: float) -> str:
+        return "GS%d" % round(alpha * 1000)
+
+    def _write(self, data: bytes):
+        self.output.write(data)
+        self._pos += len(data)
+
+    def _reserve(self) -> int:
+        self._offsets.append(None)
+        return len(self._offsets)
+
+    def add_object(self, body: bytes, obj_id: int | None = None) -> int:
+        """Write an object, returning its id."""
+        if obj_id is None:
+            obj_id = self._reserve()
+        self._offsets[obj_id - 1] = self._pos
+        self._write(b"%d 0 obj\n%s\nendobj\n" % (obj_id, body))
+        return obj_id
+
+    def add_stream(self, data: bytes, compress=True) -> int:
+        """Write a stream object, returning its id."""
+        filters = b""
+        if compress:
+            data = zlib.compress(data)
+            filters = b" /Filter /FlateDecode"
+        return self.add_object(b"<< /Length %d%s >>\nstream\n%s\nendstream" % (len(data), filters, data))
+
+    def _font_id(self, font: str) -> int:
+        if font not in self._fonts:
+            self._fonts[font] = self.add_object(
+                b"<< /Type /Font /Subtype /Type1 /BaseFont /%s /Encoding /WinAnsiEncoding >>"
+                % font.encode("latin-1"))
+        return self._fonts[font]
+
+    def _alpha_id(self, alpha: float) -> int:
+        if alpha not in self._alphas:
+            self._alphas[alpha] = self.add_object(
+                b"<< /Type /ExtGState /CA %s /ca %s >>" % (_fmt(alpha).encode(), _fmt(alpha).encode()))
+        return self._alphas[alpha]
+
+    def add_page(self, width: float, height: float, canvas: PdfCanvas):
+        """Write a page of size `width` x `height` (in pt) with the contents of `canvas`."""
+        content_id = self.add_stream(canvas.getvalue())
+        fonts = " ".join(f"/{self.font_name(font)} {self._font_id(font)} 0 R"
+                         for font in sorted(canvas.fonts))
+        alphas = " ".join(f"/{self.alpha_name(alpha)} {self._alpha_id(alpha)} 0 R"
+                          for alpha in sorted(canvas.alphas))
+        page = (f"<< /Type /Page /Parent {self._pages_id} 0 R "
+                f"/MediaBox [0 0 {_fmt(width)} {_fmt(height)}] "
+                f"/Resources << /Font << {fonts} >> /ExtGState << {alphas} >> >> "
+                f"/Contents {content_id} 0 R >>")
+        self._page_ids.append(self.add_object(page.encode("latin-1")))
+
+    def close(self):
+        """Write the page tree and trailer to finish the document."""
+        kids = " ".join(f"{page_id} 0 R" for page_id in self._page_ids)
+        self.add_object(f"<< /Type /Pages /Kids [{kids}] /Count {len(self._page_ids)} >>".encode("latin-1"),
+                        self._pages_id)
+        catalog_id = self.add_object(f"<< /Type /Catalog /Pages {self._pages_id} 0 R >>".encode("latin-1"))
+
+        xref_pos = self._pos
+        lines = [b"xref", b"0 %d" % (len(self._offsets) + 1), b"0000000000 65535 f "]
+        lines.extend(b"%010d 00000 n " % offset for offset in self._offsets)
+        self._write(b"\n".join(lines) + b"\n")
+        self._write(b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n"
+                    % (len(self._offsets) + 1, catalog_id, xref_pos))
+        self.output.flush()
@@ -0,0 +1,296 @@
+"""Convert blocks to png file.
+
+Strokes are drawn by a small anti-aliased rasteriser into a NumPy RGBA buffer,
+using the same page geometry as the SVG output, so no external tools are
+needed. Root text is not drawn.
+"""
+
+import logging
+import math
+import struct
+import typing as tp
+import zlib
+
+import numpy as np
+
+from rmscene import SceneTree, read_tree
+from rmscene import scene_items as si
+
+from .. import profile
+from .geometry import LineGeometry, PackedLines
+from .simplify import Simplifier
+from .layout import (get_anchor, get_bounding_box, shift_extents, Extents, ExtentsCache, PageLayout, xx, yy,
+                     SCALE)
+from .svg import visible_children
+from .writing_tools import Pen, segment_indices
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_DPI = 72
+
+# Long lines are split into pieces of at most this many pixels, so that each
+# piece only needs a small window of pixels to be checked.
+MAX_PIECE_LENGTH = 8
+
+# Limit on the number of pixel values computed at once when drawing a stroke
+MAX_BATCH_PIXELS = 1 << 22
+
+
+def rm_to_png(rm_path, png_path, dpi=DEFAULT_DPI):
+    """Convert `rm_path` to PNG at `png_path`."""
+    with open(rm_path, "rb") as infile, open(png_path, "wb") as outfile:
+        tree = read_tree(infile)
+        tree_to_png(tree, outfile, dpi=dpi)
+
+
+def tree_to_png(tree: SceneTree, output, dpi: float = DEFAULT_DPI, simplifier: Simplifier | None = None,
+                background: tp.Tuple[int, int, int, int] = (255, 255, 255, 255),
+                viewport: Extents | None = None, layout: PageLayout | None = None):
+    """Convert Blocks to PNG at `dpi`, written to binary stream `output`.
+
+    `viewport` limits the image to part of the page, and `layout` can be given
+    to reuse work already done for `tree`, as for `tree_to_svg`.
+    """
+    image = render_tree(tree, dpi, simplifier, background, viewport, layout)
+    with profile.stage("write"):
+        write_png(image, output, dpi)
+
+
+def render_tree(tree: SceneTree, dpi: float = DEFAULT_DPI, simplifier: Simplifier | None = None,
+                background: tp.Tuple[int, int, int, int] = (255, 255, 255, 255),
+                viewport: Extents | None = None, layout: PageLayout | None = None) -> np.ndarray:
+    """Draw `tree` into an RGBA image array of shape (height, width, 4)."""
+    if layout is None:
+        layout = PageLayout(tree)
+    anchor_pos = layout.anchor_pos
+    extents = layout.extents
+
+    # Pixels per pt, and so per screen unit
+    px_per_pt = dpi / 72
+    if viewport is None:
+        x_min, x_max, y_min, y_max = get_bounding_box(tree.root, anchor_pos, extents=extents)
+        width = math.ceil(xx(x_max - x_min + 1) * px_per_pt)
+        height = math.ceil(yy(y_max - y_min + 1) * px_per_pt)
+    else:
+        x_min, x_max, y_min, y_max = viewport
+        width = math.ceil(xx(x_max - x_min) * px_per_pt)
+        height = math.ceil(yy(y_max - y_min) * px_per_pt)
+    # A tiny dpi can round the page down to nothing, which can't be written as PNG
+    width = max(width, 1)
+    height = max(height, 1)
+
+    canvas = RasterCanvas(width, height, background)
+    with profile.stage("draw"):
+        if viewport is not None:
+            lines = layout.lines
+            visible_lines = layout.visible_lines(viewport)
+        else:
+            lines = layout.packed_lines
+            visible_lines = None
+        draw_group(tree.root, canvas, anchor_pos, -x_min, -y_min, SCALE * px_per_pt, simplifier,
+                   viewport, extents, lines, visible_lines)
+    return canvas.to_rgba()
+
+
+def draw_group(item: si.Group, canvas: "RasterCanvas", anchor_pos, x_offset, y_offset, px_per_unit,
+               simplifier=None, viewport: Extents | None = None, extents: ExtentsCache | None = None,
+               lines: PackedLines | None = None, visible_lines: np.ndarray | None = None):
+    anchor_x, anchor_y = get_anchor(item, anchor_pos)
+    x_offset += anchor_x
+    y_offset += anchor_y
+    if viewport is not None:
+        viewport = shift_extents(viewport, -anchor_x, -anchor_y)
+    profile.count(groups=1)
+    for _, child in visible_children(item, viewport, extents, visible_lines):
+        if isinstance(child, si.Group):
+            draw_group(child, canvas, anchor_pos, x_offset, y_offset, px_per_unit, simplifier,
+                       viewport, extents, lines, visible_lines)
+        elif isinstance(child, si.Line):
+            draw_stroke(child, canvas, x_offset, y_offset, px_per_unit, simplifier,
+                        lines.geometry(child) if lines is not None else None)
+
+
+def draw_stroke(item: si.Line, canvas: "RasterCanvas", x_offset, y_offset, px_per_unit, simplifier=None,
+                geometry: LineGeometry | None = None):
+    pen = Pen.create(item.tool.value, item.color.value, item.thickness_scale)
+    if geometry is None:
+        geometry = LineGeometry.from_points(item.points)
+    coords = geometry.coords()
+    polylines = []
+    for indices, segment_rgb, segment_width, segment_opacity in segment_indices(pen, geometry, simplifier):
+        segment_coords = coords[indices]
+        segment_coords += (x_offset, y_offset)
+        segment_coords *= px_per_unit
+        polylines.append((segment_coords, segment_rgb, segment_width * px_per_unit, segment_opacity))
+    canvas.stroke(polylines, pen.stroke_linecap)
+    profile.count(lines=1, points=len(geometry), segments=len(polylines))
+
+
+class RasterCanvas:
+    """An RGBA image which strokes can be drawn on.
+
+    Colours are stored as premultiplied floats between 0 and 1.
+    """
+
+    def __init__(self, width: int, height: int, background=(255, 255, 255, 255)):
+        self.width = width
+        self.height = height
+        bg = np.array(background, dtype=np.float32) / 255
+        bg[:3] *= bg[3]
+        self.pixels = np.empty((height, width, 4), dtype=np.float32)
+        self.pixels[:] = bg
+
+    def stroke(self, polylines: tp.Sequence[tp.Tuple[np.ndarray, tp.Sequence[int], float, float]],
+               linecap: str = "round"):
+        """Draw a stroke made of `polylines`, each `(coords, rgb, width, opacity)`.
+
+        The whole stroke is composited at once, taking the colour of each pixel
+        from the polyline which covers it most, so that the overlapping ends of
+        consecutive polylines aren't drawn twice.
+        """
+        pieces = _stroke_pieces(polylines)
+        if pieces is None:
+            return
+        a, b, half_width, style = pieces
+        styles = np.array([(*rgb, 255 * min(max(opacity, 0), 1)) for _, rgb, _, opacity in polylines],
+                          dtype=np.float32) / 255
+
+        # Window of pixels around each piece which it might cover
+        reach = half_width * (math.sqrt(2) if linecap == "square" else 1) + 1
+        lo = np.floor(np.minimum(a, b) - reach[:, None]).astype(int)
+        hi = np.ceil(np.maximum(a, b) + reach[:, None]).astype(int)
+        size = int((hi - lo).max()) + 1
+
+        # Region of the image covered by the whole stroke
+        x0, y0 = np.maximum(lo.min(axis=0), 0)
+        x1, y1 = np.minimum(hi.max(axis=0) + 1, (self.width, self.height))
+        if x0 >= x1 or y0 >= y1:
+            return
+        region_width = x1 - x0
+        coverage = np.zeros((y1 - y0) * region_width, dtype=np.float32)
+        colour = np.zeros(((y1 - y0) * region_width, 4), dtype=np.float32)
+
+        batch = max(1, MAX_BATCH_PIXELS // (size * size))
+        for start in range(0, len(a), batch):
+            sl = slice(start, start + batch)
+            cov, xs, ys = _piece_coverage(a[sl], b[sl], half_width[sl], lo[sl], size, linecap)
+            inside = (cov > 0) & (xs >= x0) & (xs < x1) & (ys >= y0) & (ys < y1)
+            idx = (ys - y0) * region_width + (xs - x0)
+            piece_style = np.broadcast_to(style[sl, None, None], cov.shape)
+            idx, cov, piece_style = idx[inside], cov[inside], piece_style[inside]
+            np.maximum.at(coverage, idx, cov)
+            best = cov >= coverage[idx]
+            colour[idx[best]] = styles[piece_style[best]]
+
+        coverage = coverage.reshape(y1 - y0, region_width)
+        colour = colour.reshape(y1 - y0, region_width, 4)
+        alpha = (coverage * colour[..., 3])[..., None]
+        src = np.concatenate([colour[..., :3], np.ones_like(alpha)], axis=-1)
+        region = self.pixels[y0:y1, x0:x1]
+        region *= 1 - alpha
+        region += src * alpha
+
+    def to_rgba(self) -> np.ndarray:
+        """The image as 8-bit (non-premultiplied) RGBA values."""
+        alpha = self.pixels[..., 3:]
+        rgb = np.divide(self.pixels[..., :3], alpha, out=np.zeros_like(self.pixels[..., :3]), where=alpha > 0)
+        result = np.concatenate([rgb, alpha], axis=-1)
+        return np.clip(np.rint(result * 255), 0, 255).astype(np.uint8)
+
+
+def _stroke_pieces(polylines):
+    """Split `polylines` into short straight pieces.
+
+    Returns arrays of the piece start and end points, half widths and the
+    index of the polyline each came from; or None if there is nothing to draw.
+    """
+    starts, ends, half_widths, styles = [], [], [], []
+    for i, (coords, _, width, opacity) in enumerate(polylines):
+        if width <= 0 or opacity <= 0 or len(coords) == 0:
+            continue
+        if len(coords) == 1:
+            # A single point is drawn as a dot
+            a = b = coords
+        else:
+            a, b = coords[:-1], coords[1:]
+        starts.append(a)
+        ends.append(b)
+        half_widths.append(np.full(len(a), width / 2))
+        styles.append(np.full(len(a), i))
+    if not starts:
+        return None
+    a = np.concatenate(starts)
+    b = np.concatenate(ends)
+    half_width = np.concatenate(half_widths)
+    style = np.concatenate(styles)
+
+    # Subdivide long segments
+    n_sub = np.maximum(np.ceil(np.hypot(*(b - a).T) / MAX_PIECE_LENGTH), 1).astype(int)
+    if n_sub.max() > 1:
+        parent = np.repeat(np.arange(len(a)), n_sub)
+        k = np.arange(len(parent)) - np.repeat(np.cumsum(n_sub) - n_sub, n_sub)
+        t0 = (k / n_sub[parent])[:, None]
+        t1 = ((k + 1) / n_sub[parent])[:, None]
+        delta = (b - a)[parent]
+        a, b = a[parent] + t0 * delta, a[parent] + t1 * delta
+        half_width, style = half_width[parent], style[parent]
+    return a, b, half_width, style
+
+
+def _piece_coverage(a, b, half_width, lo, size, linecap):
+    """Anti-aliased coverage of a `size` x `size` window of pixels at `lo` by each piece.
+
+    Returns the coverage and the pixel x and y indices, each of shape
+    (n, size, size).
+    """
+    steps = np.arange(size)
+    xs = lo[:, 0, None, None] + steps[None, None, :]
+    ys = lo[:, 1, None, None] + steps[None, :, None]
+    # Pixel centres relative to the start of each piece
+    px = xs + 0.5 - a[:, 0, None, None]
+    py = ys + 0.5 - a[:, 1, None, None]
+    delta = b - a
+    length = np.hypot(*delta.T)
+    r = half_width[:, None, None]
+
+    if linecap == "round":
+        length2 = np.maximum(length ** 2, 1e-12)[:, None, None]
+        t = np.clip((px * delta[:, 0, None, None] + py * delta[:, 1, None, None]) / length2, 0, 1)
+        dist = np.hypot(px - t * delta[:, 0, None, None], py - t * delta[:, 1, None, None])
+        cov = np.clip(r + 0.5 - dist, 0, 1)
+    else:
+        # Distance outside the rectangle along the piece (extended by the
+        # half width for square caps)
+        safe_length = np.where(length > 0, length, 1)
+        ux = np.where(length > 0, delta[:, 0] / safe_length, 1)[:, None, None]
+        uy = np.where(length > 0, delta[:, 1] / safe_length, 0)[:, None, None]
+        along = px * ux + py * uy
+        across = np.abs(px * uy - py * ux)
+        half_length = (length / 2)[:, None, None]
+        extend = r if linecap == "square" else 0
+        outside = np.maximum(np.abs(along - half_length) - (half_length + extend), across - r)
+        cov = np.clip(0.5 - outside, 0, 1)
+
+    shape = cov.shape
+    return cov.astype(np.float32), np.broadcast_to(xs, shape), np.broadcast_to(ys, shape)
+
+
+def write_png(image: np.ndarray, output, dpi: float | None = None):
+    """Write RGBA `image` (shape (height, width, 4), uint8) as PNG to binary stream `output`."""
+    height, width, _ = image.shape
+    # Each row starts with the filter type (0 = none)
+    raw = np.zeros((height, 1 + width * 4), dtype=np.uint8)
+    raw[:, 1:] = image.reshape(height, width * 4)
+
+    output.write(b"\x89PNG\r\n\x1a\n")
+    output.write(_png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)))
+    if dpi is not None:
+        px_per_metre = round(dpi / 0.0254)
+        output.write(_png_chunk(b"pHYs", struct.pack(">IIB", px_per_metre, px_per_metre, 1)))
+    output.write(_png_chunk(b"IDAT", zlib.compress(raw.tobytes(), 6)))
+    output.write(_png_chunk(b"IEND", b""))
+    output.flush()
+
+
+def _png_chunk(tag: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data))
@@ -0,0 +1,79 @@
+"""Simplify strokes by dropping points which make no visible difference.
+
+Uses the Ramer-Douglas-Peucker algorithm: a point is only kept if leaving it
+out would move the line by more than the tolerance.
+"""
+
+import numpy as np
+
+
+def simplify_indices(coords: np.ndarray, tolerance: float) -> np.ndarray:
+    """Indices of the points of polyline `coords` (shape (n, 2)) to keep.
+
+    The first and last points are always kept.
+    """
+    n = len(coords)
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, n - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        distances = _segment_distances(coords[start + 1:end], coords[start], coords[end])
+        i = int(np.argmax(distances))
+        if distances[i] > tolerance:
+            split = start + 1 + i
+            keep[split] = True
+            stack.append((start, split))
+            stack.append((split, end))
+    return np.flatnonzero(keep)
+
+
+def _segment_distances(points: np.ndarray, a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Distance from each of `points` to the line segment from `a` to `b`."""
+    ab = b - a
+    length2 = float(ab @ ab)
+    if length2 == 0:
+        return np.hypot(*(points - a).T)
+    t = np.clip(((points - a) @ ab) / length2, 0, 1)
+    nearest = a + t[:, None] * ab
+    return np.hypot(*(points - nearest).T)
+
+
+class Simplifier:
+    """Simplify polylines to within `tolerance` (in screen units).
+
+    Keeps count of the points seen and kept, to report how much was dropped.
+    """
+
+    def __init__(self, tolerance: float):
+        self.tolerance = tolerance
+        self.points_in = 0
+        self.points_out = 0
+
+    def __repr__(self):
+        return f"Simplifier({self.tolerance!r})"
+
+    @property
+    def points_dropped(self) -> int:
+        return self.points_in - self.points_out
+
+    def keep(self, coords: np.ndarray, joined: bool = False) -> np.ndarray:
+        """Indices of the points of polyline `coords` (shape (n, 2)) which are needed (including both ends).
+
+        If `joined` is true, the first point is shared with the previous
+        segment of the stroke, so isn't counted again.
+        """
+        if len(coords) <= 2:
+            result = np.arange(len(coords))
+        else:
+            result = simplify_indices(coords, self.tolerance)
+        self.points_in += len(coords) - joined
+        self.points_out += len(result) - joined
+        return result
+
+    def report(self) -> str:
+        percent = 100 * self.points_dropped / self.points_in if self.points_in else 0
+        return (f"Simplified strokes: dropped {self.points_dropped} of {self.points_in} points "
+                f"({percent:.1f}%)")
@@ -5,57 +5,30 @@ https://github.com/chemag/maxio .
 """
 
 import logging
+import math
 import string
 import typing as tp
 from pathlib import Path
 
-from rmscene import CrdtId, SceneTree, read_tree
+import numpy as np
+
+from rmscene import SceneTree, read_tree
 from rmscene import scene_items as si
 from rmscene.text import TextDocument
 
-from .writing_tools import Pen
+from .. import profile
+from .geometry import LineGeometry, PackedLines
+# The page layout used to be here, so it is still imported from here too
+from .layout import (LINE_HEIGHTS, PAGE_HEIGHT_PT, PAGE_WIDTH_PT, SCALE, SCREEN_BOUNDING_BOX, SCREEN_DPI,
+                     SCREEN_HEIGHT, SCREEN_WIDTH, STROKE_MARGIN, TEXT_TOP_Y, X_SHIFT, Extents, ExtentsCache,
+                     PageLayout, ParagraphLayout, build_anchor_pos, extents_overlap, get_anchor, get_bounding_box,
+                     get_page_extents, layout_paragraphs, ordered_children, pack_lines, points_extents, scale,
+                     shift_extents, union_extents, xx, yy)
+from .simplify import Simplifier
+from .writing_tools import Pen, segment_indices
 
 _logger = logging.getLogger(__name__)
 
-SCREEN_WIDTH = 1404
-SCREEN_HEIGHT = 1872
-SCREEN_DPI = 226
-
-SCALE = 72.0 / SCREEN_DPI
-
-PAGE_WIDTH_PT = SCREEN_WIDTH * SCALE
-PAGE_HEIGHT_PT = SCREEN_HEIGHT * SCALE
-X_SHIFT = PAGE_WIDTH_PT // 2
-
-
-def scale(screen_unit: float) -> float:
-    return screen_unit * SCALE
-
-
-# For now, at least, the xx and yy function are identical to scale
-xx = scale
-yy = scale
-
-TEXT_TOP_Y = -88
-LINE_HEIGHTS = {
-    # Based on a rm file having 4 anchors based on the line height I was able to find a value of
-    # 69.5, but decided on 70 (to keep integer values)
-    si.ParagraphStyle.PLAIN: 70,
-    si.ParagraphStyle.BULLET: 35,
-    si.ParagraphStyle.BULLET2: 35,
-    si.ParagraphStyle.BOLD: 70,
-    si.ParagraphStyle.HEADING: 150,
-    si.ParagraphStyle.CHECKBOX: 35,
-    si.ParagraphStyle.CHECKBOX_CHECKED: 35,
-
-    # There appears to be another format code (value 0) which is used when the
-    # text starts far down the page, which case it has a negative offset (line
-    # height) of about -20?
-    #
-    # Probably, actually, the line height should be added *after* the first
-    # line, but there is still something a bit odd going on here.
-}
-
 SVG_HEADER = string.Template("""<?xml version="1.0" encoding="UTF-8"?>
 <svg xmlns="http://www.w3.org/2000/svg" height="$height" width="$width" viewBox="$viewbox">""")
 
@@ -72,133 +45,217 @@ def read_template_svg(template_path: Path) -> str:
     return "\n".join(lines[2:-2])
 
 
-def tree_to_svg(tree: SceneTree, output, include_template: Path | None = None):
-    """Convert Blocks to SVG."""
+def tree_to_svg(tree: SceneTree, output, include_template: Path | None = None,
+                simplifier: Simplifier | None = None, viewport: tp.Optional["Extents"] = None,
+                layout: tp.Optional["PageLayout"] = None, stream: bool = False):
+    """Convert Blocks to SVG.
+
+    If `simplifier` is given, strokes are simplified to within its tolerance.
+
+    If `viewport` is given, as `(x_min, x_max, y_min, y_max)` in screen units,
+    only that part of the page is drawn and lines outside it are skipped.
+
+    `layout` can be given to reuse the text layout and extents already worked
+    out for `tree`, e.g. when drawing several viewports or formats.
+
+    If `stream` is true, strokes are written as they are drawn, before the
+    size of the page is known. If `output` is seekable, space is left for the
+    header, which is filled in at the end; otherwise the header gives the
+    size of the screen, and a warning is logged if the page is larger.
+    """
+    output = BufferedOutput(output)
 
     # find the anchor pos for further use
-    anchor_pos = build_anchor_pos(tree.root_text)
+    if layout is None:
+        layout = PageLayout(tree)
+    anchor_pos = layout.anchor_pos
     _logger.debug("anchor_pos: %s", anchor_pos)
 
-    # find the extremum along x and y
-    x_min, x_max, y_min, y_max = get_bounding_box(tree.root, anchor_pos)
-    width_pt = xx(x_max - x_min + 1)
-    height_pt = yy(y_max - y_min + 1)
-    _logger.debug("x_min, x_max, y_min, y_max: %.1f, %.1f, %.1f, %.1f ; scalded %.1f, %.1f, %.1f, %.1f",
-                  x_min, x_max, y_min, y_max, xx(x_min), xx(x_max), yy(y_min), yy(y_max))
+    if viewport is not None:
+        x_min, x_max, y_min, y_max = viewport
+        page = (x_min, y_min, x_max - x_min, y_max - y_min)
+    elif stream:
+        # Assume the page is the size of the screen for now
+        page = _page_rect(SCREEN_BOUNDING_BOX)
+    else:
+        # find the extremum along x and y
+        page = _page_rect(get_bounding_box(tree.root, anchor_pos, extents=layout.extents))
+    _logger.debug("page x, y, width, height: %.1f, %.1f, %.1f, %.1f", *page)
+
+    patches = []
+    streaming = stream and viewport is None
+    seekable = streaming and output.output.seekable()
+
+    def write_page_part(make_part):
+        if seekable:
+            # Leave space to fill in later
+            output.flush()
+            patches.append((output.output.tell(), make_part))
+            output.write(_pad(make_part(page), STREAM_HEADER_SIZE))
+        else:
+            output.write(make_part(page))
 
     # add svg header
-    output.write(SVG_HEADER.substitute(width=width_pt,
-                                       height=height_pt,
-                                       viewbox=f"{xx(x_min)} {yy(y_min)} {width_pt} {height_pt}") + "\n")
+    write_page_part(svg_header)
 
     if include_template is not None:
         output.write(read_template_svg(include_template))
-        output.write(f'\n\t<rect fill="url(#template)" x="{xx(x_min)}" y="{yy(y_min)}"'
-                     f' width="{width_pt}" height="{height_pt}"/>\n')
+        write_page_part(template_rect)
 
     output.write(f'\t<g id="p1" style="display:inline">\n')
+    if streaming:
+        # Send the header straight away
+        output.flush()
 
     if tree.root_text is not None:
-        draw_text(tree.root_text, output)
-
-    draw_group(tree.root, output, anchor_pos)
+        paragraphs = layout.paragraphs
+        with profile.stage("text"):
+            draw_text(tree.root_text, output, paragraphs)
+
+    # Only worked out once the header has been sent, when streaming
+    extents = layout.extents
+    with profile.stage("draw"):
+        if viewport is not None:
+            lines = layout.lines
+            visible_lines = layout.visible_lines(viewport)
+        else:
+            lines = layout.packed_lines
+            visible_lines = None
+        draw_group(tree.root, output, anchor_pos, simplifier, viewport, extents, lines, visible_lines)
 
     # Closing page group
     output.write('\t</g>\n')
     # END notebook
     output.write('</svg>\n')
+    output.flush()
 
+    if streaming:
+        actual_page = _page_rect(get_bounding_box(tree.root, anchor_pos, extents=extents))
+        if seekable:
+            end = output.output.tell()
+            for position, make_part in patches:
+                output.output.seek(position)
+                output.output.write(_pad(make_part(actual_page), STREAM_HEADER_SIZE))
+            output.output.seek(end)
+        elif actual_page != page:
+            _logger.warning("Page is larger than the screen, but the SVG size could not be "
+                            "updated because the output is not seekable")
 
-def build_anchor_pos(text: tp.Optional[si.Text]) -> tp.Dict[CrdtId, int]:
-    """
-    Find the anchor pos
 
-    :param text: the root text of the remarkable file
-    """
-    # Special anchors adjusted based on pen_size_test.strokes.rm
-    anchor_pos = {
-        CrdtId(0, 281474976710654): 100,
-        CrdtId(0, 281474976710655): 100,
-    }
-
-    if text is not None:
-        # Save anchor from text
-        doc = TextDocument.from_scene_item(text)
-        ypos = text.pos_y + TEXT_TOP_Y
-        for i, p in enumerate(doc.contents):
-            anchor_pos[p.start_id] = ypos
-            for subp in p.contents:
-                for k in subp.i:
-                    anchor_pos[k] = ypos  # TODO check these anchor are used
-            ypos += LINE_HEIGHTS.get(p.style.value, 70)
-
-    return anchor_pos
-
-
-def get_anchor(item: si.Group, anchor_pos):
-    anchor_x = 0.0
-    anchor_y = 0.0
-    if item.anchor_id is not None:
-        assert item.anchor_origin_x is not None
-        anchor_x = item.anchor_origin_x.value
-        if item.anchor_id.value in anchor_pos:
-            anchor_y = anchor_pos[item.anchor_id.value]
-            _logger.debug("Group anchor: %s -> y=%.1f (scalded y=%.1f)",
-                          item.anchor_id.value,
-                          anchor_y,
-                          yy(anchor_y))
-        else:
-            _logger.warning("Group anchor: %s is unknown!", item.anchor_id.value)
+# Space reserved for each part of the SVG which depends on the page size,
+# when streaming to a seekable output
+STREAM_HEADER_SIZE = 256
 
-    return anchor_x, anchor_y
 
+def _page_rect(bounding_box: "Extents") -> tp.Tuple[float, float, float, float]:
+    """Page `(x, y, width, height)` for `bounding_box`, which includes its last unit."""
+    x_min, x_max, y_min, y_max = bounding_box
+    return x_min, y_min, x_max - x_min + 1, y_max - y_min + 1
 
-def get_bounding_box(item: si.Group,
-                     anchor_pos: tp.Dict[CrdtId, int],
-                     default: tp.Tuple[int, int, int, int] = (- SCREEN_WIDTH // 2, SCREEN_WIDTH // 2, 0, SCREEN_HEIGHT)) \
-        -> tp.Tuple[int, int, int, int]:
-    """
-    Get the bounding box of the given item.
-    The minimum size is the default size of the screen.
 
-    :return: x_min, x_max, y_min, y_max: the bounding box in screen units (need to be scalded using xx and yy functions)
-    """
-    x_min, x_max, y_min, y_max = default
+def svg_header(page: tp.Tuple[float, float, float, float]) -> str:
+    """SVG header for a page `(x, y, width, height)` (in screen units)."""
+    x_min, y_min, width, height = page
+    width_pt = xx(width)
+    height_pt = yy(height)
+    return SVG_HEADER.substitute(width=width_pt,
+                                 height=height_pt,
+                                 viewbox=f"{xx(x_min)} {yy(y_min)} {width_pt} {height_pt}") + "\n"
 
-    for child_id in item.children:
-        child = item.children[child_id]
-        if isinstance(child, si.Group):
-            anchor_x, anchor_y = get_anchor(child, anchor_pos)
-            x_min_t, x_max_t, y_min_t, y_max_t = get_bounding_box(child, anchor_pos, (0, 0, 0, 0))
-            x_min = min(x_min, x_min_t + anchor_x)
-            x_max = max(x_max, x_max_t + anchor_x)
-            y_min = min(y_min, y_min_t + anchor_y)
-            y_max = max(y_max, y_max_t + anchor_y)
-        elif isinstance(child, si.Line):
-            x_min = min([x_min] + [p.x for p in child.points])
-            x_max = max([x_max] + [p.x for p in child.points])
-            y_min = min([y_min] + [p.y for p in child.points])
-            y_max = max([y_max] + [p.y for p in child.points])
 
-    return x_min, x_max, y_min, y_max
+def template_rect(page: tp.Tuple[float, float, float, float]) -> str:
+    """SVG rect filling the page `(x, y, width, height)` with the template."""
+    x_min, y_min, width, height = page
+    return (f'\n\t<rect fill="url(#template)" x="{xx(x_min)}" y="{yy(y_min)}"'
+            f' width="{xx(width)}" height="{yy(height)}"/>\n')
+
+
+def _pad(tag: str, size: int) -> str:
+    """Pad the end of the XML tag in `tag` with spaces to `size` characters."""
+    end = tag.rindex(">")
+    if tag[end - 1] == "/":
+        end -= 1
+    if len(tag) > size:
+        raise ValueError("Not enough space reserved for %r" % tag)
+    return tag[:end] + " " * (size - len(tag)) + tag[end:]
+
+
+def visible_children(item: si.Group, viewport: Extents | None, extents: ExtentsCache | None,
+                     visible_lines: np.ndarray | None = None):
+    """Iterate `(child_id, child)` for children of `item` which might be seen in `viewport`.
+
+    `viewport` is relative to `item`, like the extents of its children. If
+    `viewport` is None, all children are visible.
+
+    `visible_lines` can give the lines which might be seen, as from
+    `PageLayout.visible_lines`. Then only those lines are looked at, rather
+    than checking the extents of every line in `item`.
+    """
+    packed = extents.packed if extents is not None else None
+    if viewport is not None and visible_lines is not None and packed is not None:
+        positions = packed.visible_positions(item, visible_lines)
+        if positions is not None:
+            children = packed.children(item)
+            for position in positions.tolist():
+                child_id, child = children[position]
+                if isinstance(child, si.Group) and not extents_overlap(extents.group(child), viewport,
+                                                                       STROKE_MARGIN):
+                    continue
+                yield child_id, child
+            return
+
+    for child_id, child in ordered_children(item, packed):
+        if viewport is not None:
+            if isinstance(child, si.Group):
+                child_extents = extents.group(child)
+            elif isinstance(child, si.Line):
+                child_extents = extents.line(child)
+            else:
+                child_extents = None
+            if child_extents is None or not extents_overlap(child_extents, viewport, STROKE_MARGIN):
+                continue
+        yield child_id, child
+
+
+def page_tiles(page: Extents, tile_width: float, tile_height: float) \
+        -> tp.List[tp.Tuple[int, int, Extents]]:
+    """Split `page` into a grid of tiles, each `tile_width` by `tile_height`.
+
+    Returns `(row, col, viewport)` for each tile, row by row. All tiles have
+    the same size, so those at the right and bottom may extend past the page.
+    """
+    x_min, x_max, y_min, y_max = page
+    cols = max(1, math.ceil((x_max - x_min) / tile_width))
+    rows = max(1, math.ceil((y_max - y_min) / tile_height))
+    return [(row, col, (x_min + col * tile_width, x_min + (col + 1) * tile_width,
+                        y_min + row * tile_height, y_min + (row + 1) * tile_height))
+            for row in range(rows) for col in range(cols)]
 
 
-def draw_group(item: si.Group, output, anchor_pos):
+def draw_group(item: si.Group, output, anchor_pos, simplifier=None, viewport: Extents | None = None,
+               extents: ExtentsCache | None = None, lines: PackedLines | None = None,
+               visible_lines: np.ndarray | None = None):
     anchor_x, anchor_y = get_anchor(item, anchor_pos)
     output.write(f'\t\t<g id="{item.node_id}" transform="translate({xx(anchor_x)}, {yy(anchor_y)})">\n')
-    for child_id in item.children:
-        child = item.children[child_id]
+    profile.count(groups=1)
+    if viewport is not None:
+        viewport = shift_extents(viewport, -anchor_x, -anchor_y)
+    for child_id, child in visible_children(item, viewport, extents, visible_lines):
         _logger.debug("Group child: %s %s", child_id, type(child))
         if _logger.root.level == logging.DEBUG:
             output.write(f'\t\t<!-- child {child_id} {type(child)} -->\n')
         if isinstance(child, si.Group):
-            draw_group(child, output, anchor_pos)
+            draw_group(child, output, anchor_pos, simplifier, viewport, extents, lines, visible_lines)
         elif isinstance(child, si.Line):
-            draw_stroke(child, output)
+            draw_stroke(child, output, simplifier, lines.geometry(child) if lines is not None else None)
     output.write(f'\t\t</g>\n')
 
 
-def draw_stroke(item: si.Line, output):
+def draw_stroke(item: si.Line, output, simplifier=None, geometry: LineGeometry | None = None):
+    """Draw `item` as a polyline for each segment.
+
+    `geometry` is the line's packed points, if already packed.
+    """
     # print debug infos
     if _logger.root.level == logging.DEBUG:
         _logger.debug("Writing line: %s", item)
@@ -208,47 +265,72 @@ def draw_stroke(item: si.Line, output):
     # initiate the pen
     pen = Pen.create(item.tool.value, item.color.value, item.thickness_scale)
 
-    last_xpos = -1.
-    last_ypos = -1.
-    last_segment_width = segment_width = 0
-    # Iterate through the point to form a polyline
-    for point_id, point in enumerate(item.points):
-        # align the original position
-        xpos = point.x
-        ypos = point.y
-        if point_id % pen.segment_length == 0:
-            # if there was a previous segment, end it
-            if last_xpos != -1.:
-                output.write('"/>\n')
-
-            segment_color = pen.get_segment_color(point.speed, point.direction, point.width, point.pressure,
-                                                  last_segment_width)
-            segment_width = pen.get_segment_width(point.speed, point.direction, point.width, point.pressure,
-                                                  last_segment_width)
-            segment_opacity = pen.get_segment_opacity(point.speed, point.direction, point.width, point.pressure,
-                                                      last_segment_width)
-            # create the next segment of the stroke
-            output.write('\t\t\t<polyline ')
-            output.write(f'style="fill:none; stroke:{segment_color}; '
-                         f'stroke-width:{scale(segment_width):.3f}; opacity:{segment_opacity}" ')
-            output.write(f'stroke-linecap="{pen.stroke_linecap}" ')
-            output.write('points="')
-            if last_xpos != -1.:
-                # Join to previous segment
-                output.write(f'{xx(last_xpos):.3f},{yy(last_ypos):.3f} ')
-        # store the last position
-        last_xpos = xpos
-        last_ypos = ypos
-        last_segment_width = segment_width
-
-        # add current point
-        output.write(f'{xx(xpos):.3f},{yy(ypos):.3f} ')
+    if geometry is None:
+        geometry = LineGeometry.from_points(item.points)
 
-    # end stroke
-    output.write('" />\n')
+    # Format all the coordinates at once, and build the whole stroke in one string
+    point_strs = format_coords(geometry.coords())
+    parts = []
 
+    # Iterate through the segments to form polylines
+    segment_id = -1
+    for segment_id, (indices, segment_rgb, segment_width, segment_opacity) \
+            in enumerate(segment_indices(pen, geometry, simplifier)):
+        # if there was a previous segment, end it
+        if segment_id > 0:
+            parts.append('"/>\n')
 
-def draw_text(text: si.Text, output):
+        # create the next segment of the stroke
+        segment_color = "rgb" + str(tuple(segment_rgb))
+        parts.append(f'\t\t\t<polyline style="fill:none; stroke:{segment_color}; '
+                     f'stroke-width:{scale(segment_width):.3f}; opacity:{segment_opacity}" '
+                     f'stroke-linecap="{pen.stroke_linecap}" points="')
+
+        # the segment's points (including the join to the previous segment)
+        parts.append(" ".join([point_strs[i] for i in indices.tolist()]))
+        parts.append(" ")
+
+    # end stroke
+    parts.append('" />\n')
+    output.write("".join(parts))
+    profile.count(lines=1, points=len(geometry), segments=segment_id + 1)
+
+
+def format_coords(coords: np.ndarray) -> tp.List[str]:
+    """Format each row of `coords` (shape (n, 2)) as "x,y", scaled using xx and yy."""
+    if not len(coords):
+        return []
+    # Equivalent to xx(x) and yy(y) for each point
+    coords = coords * SCALE
+    return (("%.3f,%.3f\n" * len(coords)) % tuple(coords.ravel().tolist())).split("\n")[:-1]
+
+
+class BufferedOutput:
+    """Collect many small writes and pass them on to `output` in large chunks."""
+
+    def __init__(self, output, chunk_size: int = 1 << 16):
+        self.output = output
+        self.chunk_size = chunk_size
+        self._parts = []
+        self._size = 0
+
+    def write(self, data: str) -> int:
+        self._parts.append(data)
+        self._size += len(data)
+        if self._size >= self.chunk_size:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        """Pass on what has been written so far, and flush `output` so that it is sent straight away."""
+        if self._parts:
+            self.output.write("".join(self._parts))
+            self._parts = []
+            self._size = 0
+        self.output.flush()
+
+
+def draw_text(text: si.Text, output, paragraphs: tp.Optional[tp.List[ParagraphLayout]] = None):
     output.write('\t\t<g class="root-text" style="display:inline">')
 
     # add some style to get readable text
@@ -266,14 +348,10 @@ def draw_text(text: si.Text, output):
             </style>
 ''')
 
-    y_offset = TEXT_TOP_Y
-
-    doc = TextDocument.from_scene_item(text)
-    for p in doc.contents:
-        y_offset += LINE_HEIGHTS.get(p.style.value, 70)
-
+    if paragraphs is None:
+        paragraphs = layout_paragraphs(text, TextDocument.from_scene_item(text))
+    for p, _, ypos in paragraphs:
         xpos = text.pos_x
-        ypos = text.pos_y + y_offset
         cls = p.style.value.name.lower()
         if str(p):
             # TODO: this doesn't take into account the CrdtStr.properties (font-weight/font-style)
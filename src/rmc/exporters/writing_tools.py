@@ -7,9 +7,13 @@ Code originally from https://github.com/lschwetlick/maxio through https://github
 import logging
 import math
 
+import numpy as np
+
 from rmscene.scene_items import Pen as PenType
 from rmscene.scene_items import PenColor
 
+from .geometry import LineGeometry
+
 _logger = logging.getLogger(__name__)
 
 # color_id to RGB conversion
@@ -42,6 +46,39 @@ def clamp(value):
     return min(max(value, 0), 1)
 
 
+def clamp_array(values):
+    """
+    Clamp each of `values` between 0 and 1.
+    """
+    return np.minimum(np.maximum(values, 0), 1)
+
+
+def power_array(values, exponent):
+    """
+    Raise each of `values` to `exponent`.
+
+    This uses Python's float power rather than `np.power`, whose vectorised
+    implementation can differ in the last bit, so that results match the
+    scalar methods exactly.
+    """
+    return np.array([value ** exponent for value in values.tolist()], dtype=float)
+
+
+def last_width_recurrence(base, feedback):
+    """
+    Solve `width[i] = base[i] + feedback * width[i - 1]`, with `width[-1] = 0`.
+
+    The recurrence is evaluated term by term (with the same floating point
+    operations as the scalar methods), since it can't be vectorised exactly.
+    """
+    widths = []
+    last_width = 0
+    for value in base.tolist():
+        last_width = value + (feedback * last_width)
+        widths.append(last_width)
+    return np.array(widths)
+
+
 class Pen:
     def __init__(self, name, base_width, base_color_id):
         self.base_width = base_width
@@ -75,11 +112,36 @@ class Pen:
         return self.base_width
 
     def get_segment_color(self, speed, direction, width, pressure, last_width):
-        return "rgb" + str(tuple(self.base_color))
+        return "rgb" + str(tuple(self.get_segment_rgb(speed, direction, width, pressure, last_width)))
+
+    def get_segment_rgb(self, speed, direction, width, pressure, last_width):
+        return tuple(self.base_color)
 
     def get_segment_opacity(self, speed, direction, width, pressure, last_width):
         return self.base_opacity
 
+    # Vectorised versions of the methods above: the point values are arrays
+    # with one entry per segment. These fall back to calling the scalar
+    # methods, and are overridden where the formulas can be vectorised.
+
+    def get_segment_widths(self, speed, direction, width, pressure):
+        """Segment widths, with `last_width` fed back from each segment to the next."""
+        widths = []
+        last_width = 0
+        for args in zip(speed.tolist(), direction.tolist(), width.tolist(), pressure.tolist()):
+            last_width = self.get_segment_width(*args, last_width)
+            widths.append(last_width)
+        return np.array(widths)
+
+    def get_segment_rgbs(self, speed, direction, width, pressure, last_width):
+        """Segment colours as an array of shape (n, 3)."""
+        return np.array([self.get_segment_rgb(*args) for args in zip(
+            speed.tolist(), direction.tolist(), width.tolist(), pressure.tolist(), last_width.tolist())])
+
+    def get_segment_opacities(self, speed, direction, width, pressure, last_width):
+        return np.array([self.get_segment_opacity(*args) for args in zip(
+            speed.tolist(), direction.tolist(), width.tolist(), pressure.tolist(), last_width.tolist())])
+
     @classmethod
     def create(cls, pen_nr, color_id, width):
         # Brush
@@ -121,6 +183,42 @@ class Pen:
         raise Exception(f'Unknown pen_nr: {pen_nr}')
 
 
+def segment_indices(pen: Pen, geometry: LineGeometry, simplifier=None):
+    """Split the packed points of a line into the segments drawn with constant style by `pen`.
+
+    Yields `(indices, rgb, width, opacity)` for each segment, where `indices`
+    is an array of the indices of the segment's points in `geometry`. Apart
+    from the first, each segment starts with the last point of the previous
+    one so that consecutive segments join up.
+
+    If `simplifier` is given (see `rmc.exporters.simplify`), the points within
+    each segment are simplified; the ends of segments are always kept.
+    """
+    n = len(geometry)
+    step = pen.segment_length
+
+    # The style of each segment depends on its first point; compute them all at once
+    speed = geometry.speed[::step].astype(float)
+    direction = geometry.direction[::step].astype(float)
+    width = geometry.width[::step].astype(float)
+    pressure = geometry.pressure[::step].astype(float)
+
+    segment_widths = pen.get_segment_widths(speed, direction, width, pressure)
+    last_widths = np.concatenate(([0], segment_widths[:-1]))[:len(segment_widths)]
+    segment_rgbs = pen.get_segment_rgbs(speed, direction, width, pressure, last_widths)
+    segment_opacities = pen.get_segment_opacities(speed, direction, width, pressure, last_widths)
+
+    coords = geometry.coords() if simplifier is not None else None
+    for i, (segment_rgb, segment_width, segment_opacity) in enumerate(
+            zip(segment_rgbs.tolist(), segment_widths.tolist(), segment_opacities.tolist())):
+        start = i * step
+        # Apart from the first, start from the last point of the previous segment
+        indices = np.arange(start - 1 if i > 0 else start, min(start + step, n))
+        if simplifier is not None:
+            indices = indices[simplifier.keep(coords[indices], joined=i > 0)]
+        yield indices, tuple(segment_rgb), segment_width, segment_opacity
+
+
 class Fineliner(Pen):
     def __init__(self, base_width, base_color_id):
         super().__init__("Fineliner", base_width * 1.8, base_color_id)
@@ -135,13 +233,22 @@ class Ballpoint(Pen):
         segment_width = (0.5 + pressure / 255) + (width / 4) - 0.5 * ((speed / 4) / 50)
         return segment_width
 
-    def get_segment_color(self, speed, direction, width, pressure, last_width):
+    def get_segment_rgb(self, speed, direction, width, pressure, last_width):
         intensity = (0.1 * - ((speed / 4) / 35)) + (1.2 * pressure / 255) + 0.5
         intensity = clamp(intensity)
         # using segment color not opacity because the dots interfere with each other.
         # Color must be 255 rgb
         segment_color = [min(int(abs(intensity - 1) * 255), 60)] * 3
-        return "rgb" + str(tuple(segment_color))
+        return tuple(segment_color)
+
+    def get_segment_widths(self, speed, direction, width, pressure):
+        return (0.5 + pressure / 255) + (width / 4) - 0.5 * ((speed / 4) / 50)
+
+    def get_segment_rgbs(self, speed, direction, width, pressure, last_width):
+        intensity = (0.1 * - ((speed / 4) / 35)) + (1.2 * pressure / 255) + 0.5
+        intensity = clamp_array(intensity)
+        grey = np.minimum((np.abs(intensity - 1) * 255).astype(int), 60)
+        return np.repeat(grey[:, None], 3, axis=1)
 
     # def get_segment_opacity(self, speed, direction, width, pressure, last_width):
     #     segment_opacity = (0.2 * - ((speed / 4) / 35)) + (0.8 * pressure / 255)
@@ -159,6 +266,10 @@ class Marker(Pen):
         segment_width = 0.9 * ((width / 4) - 0.4 * self.direction_to_tilt(direction)) + (0.1 * last_width)
         return segment_width
 
+    def get_segment_widths(self, speed, direction, width, pressure):
+        base = 0.9 * ((width / 4) - 0.4 * self.direction_to_tilt(direction))
+        return last_width_recurrence(base, 0.1)
+
 
 class Pencil(Pen):
     def __init__(self, base_width, base_color_id):
@@ -178,6 +289,17 @@ class Pencil(Pen):
         segment_opacity = clamp(segment_opacity) - 0.1
         return segment_opacity
 
+    def get_segment_widths(self, speed, direction, width, pressure):
+        segment_width = 0.7 * ((((0.8 * self.base_width) + (0.5 * pressure / 255)) * (width / 4))
+                               - (0.25 * power_array(self.direction_to_tilt(direction), 1.8))
+                               - (0.6 * (speed / 4) / 50))
+        max_width = self.base_width * 10
+        return np.where(segment_width < max_width, segment_width, max_width)
+
+    def get_segment_opacities(self, speed, direction, width, pressure, last_width):
+        segment_opacity = (0.1 * - ((speed / 4) / 35)) + (1 * pressure / 255)
+        return clamp_array(segment_opacity) - 0.1
+
 
 class MechanicalPencil(Pen):
     def __init__(self, base_width, base_color_id):
@@ -197,7 +319,7 @@ class Brush(Pen):
                                - (0.5 * self.direction_to_tilt(direction)) - ((speed / 4) / 50))  # + (0.2 * last_width)
         return segment_width
 
-    def get_segment_color(self, speed, direction, width, pressure, last_width):
+    def get_segment_rgb(self, speed, direction, width, pressure, last_width):
         intensity = ((pressure / 255) ** 1.5 - 0.2 * ((speed / 4) / 50)) * 1.5
         intensity = clamp(intensity)
         # using segment color not opacity because the dots interfere with each other.
@@ -207,7 +329,17 @@ class Brush(Pen):
                          int(rev_intensity * (255 - self.base_color[1])),
                          int(rev_intensity * (255 - self.base_color[2]))]
 
-        return "rgb" + str(tuple(segment_color))
+        return tuple(segment_color)
+
+    def get_segment_widths(self, speed, direction, width, pressure):
+        return 0.7 * (((1 + (1.4 * pressure / 255)) * (width / 4))
+                      - (0.5 * self.direction_to_tilt(direction)) - ((speed / 4) / 50))
+
+    def get_segment_rgbs(self, speed, direction, width, pressure, last_width):
+        intensity = (power_array(pressure / 255, 1.5) - 0.2 * ((speed / 4) / 50)) * 1.5
+        intensity = clamp_array(intensity)
+        rev_intensity = np.abs(intensity - 1)
+        return (rev_intensity[:, None] * (255 - np.array(self.base_color))).astype(int)
 
 
 class Highlighter(Pen):
@@ -249,3 +381,8 @@ class Calligraphy(Pen):
         segment_width = 0.9 * (((1 + pressure / 255) * (width / 4))
                                - 0.3 * self.direction_to_tilt(direction)) + (0.1 * last_width)
         return segment_width
+
+    def get_segment_widths(self, speed, direction, width, pressure):
+        base = 0.9 * (((1 + pressure / 255) * (width / 4))
+                      - 0.3 * self.direction_to_tilt(direction))
+        return last_width_recurrence(base, 0.1)
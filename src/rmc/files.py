@@ -0,0 +1,41 @@
+"""Reading and writing files safely, for the cache, `rmc watch` and `rmc index`."""
+
+import hashlib
+import os
+import tempfile
+import typing as tp
+from pathlib import Path
+
+
+def write_atomic(path: Path, data: bytes):
+    """Write `data` to `path` via a temporary file, so that readers never see a partly written file."""
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def file_hash(path: Path) -> str:
+    return hashlib.sha256(path.read_bytes()).hexdigest()
+
+
+def check_file(path: Path, st: os.stat_result,
+               known: tp.Optional[tp.Tuple[int, int, str]]) -> tp.Tuple[str, tp.Optional[str]]:
+    """Whether the file at `path`, with stat `st`, has changed since it was `(mtime_ns, size, sha256)`.
+
+    Returns `(status, sha256)`. The status is "unchanged" if the modification
+    time and size are the same, "touched" if they have changed but the
+    contents haven't, or otherwise (or if `known` is None) "changed". The
+    contents are only read if needed; `sha256` is their hash, or None if they
+    weren't read.
+    """
+    if known is not None and known[:2] == (st.st_mtime_ns, st.st_size):
+        return "unchanged", None
+    digest = file_hash(path)
+    if known is not None and known[2] == digest:
+        return "touched", digest
+    return "changed", digest
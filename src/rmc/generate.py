@@ -0,0 +1,228 @@
+"""Generate synthetic rm files, e.g. to test how conversions scale with large pages.
+
+The pages have layers of handwriting-like lines, optionally with root text
+and groups of lines anchored to its paragraphs, and are the same each time
+for the same options and seed. Blocks are written as they are generated, so
+pages of millions of points can be written without holding them in memory.
+
+The `generate` command is run as `rmc generate`.
+"""
+
+import io
+import itertools
+import typing as tp
+from uuid import UUID
+
+import click
+import numpy as np
+
+from rmscene import CrdtId, LwwValue, write_blocks
+from rmscene import scene_items as si
+from rmscene.crdt_sequence import CrdtSequence, CrdtSequenceItem
+from rmscene.scene_stream import (AuthorIdsBlock, Block, MigrationInfoBlock, PageInfoBlock, RootTextBlock,
+                                  SceneGroupItemBlock, SceneLineItemBlock, SceneTreeBlock, TreeNodeBlock)
+
+from .cli import setup_logging
+
+DEFAULT_TOOLS = (si.Pen.BALLPOINT_2, si.Pen.FINELINER_2, si.Pen.PENCIL_2, si.Pen.MARKER_2,
+                 si.Pen.CALIGRAPHY, si.Pen.PAINTBRUSH_2, si.Pen.HIGHLIGHTER_2)
+DEFAULT_COLORS = (si.PenColor.BLACK,)
+
+# Styles given to the paragraphs of the root text, in turn
+PARAGRAPH_STYLES = (si.ParagraphStyle.HEADING, si.ParagraphStyle.PLAIN, si.ParagraphStyle.PLAIN,
+                    si.ParagraphStyle.BULLET, si.ParagraphStyle.BULLET, si.ParagraphStyle.PLAIN)
+
+WORDS = ("the", "of", "and", "notes", "meeting", "page", "draft", "idea", "plan", "review", "list",
+         "remarkable", "tablet", "line", "ink", "summary", "question", "answer", "todo", "week")
+
+AUTHOR_UUID = UUID("495ba59f-c943-2b5c-b455-3682f6948906")
+
+# Anchor used by groups on pages without text, as on the tablet
+NO_TEXT_ANCHOR = CrdtId(0, 281474976710655)
+
+# Anchor settings as written by the tablet for handwriting next to text
+ANCHOR_TYPE = 2
+ANCHOR_THRESHOLD = 67.02755737304688
+ANCHOR_ORIGIN_X = -464.0
+
+
+def page_blocks(lines: int, points_per_line: int = 200, layers: int = 1, anchored_groups: int = 0,
+                paragraphs: int = 0, tools: tp.Sequence[si.Pen] = DEFAULT_TOOLS,
+                colors: tp.Sequence[si.PenColor] = DEFAULT_COLORS, seed: int = 0,
+                last_line_points: int | None = None) -> tp.Iterator[Block]:
+    """Generate the blocks of an rm file with `lines` lines of `points_per_line` points each.
+
+    If `last_line_points` is given, the last line has that many points
+    instead (see `split_points`). The lines are split between `layers` layers and `anchored_groups` groups,
+    which are anchored to the `paragraphs` paragraphs of the root text in
+    turn, or to the top of the page if there is no text. Lines are drawn with
+    each of `tools` and `colors` in turn. Line points are only generated as
+    each line's block is needed.
+    """
+    if layers < 1:
+        raise ValueError("Need at least one layer")
+    rng = np.random.default_rng(seed)
+    ids = (CrdtId(1, n) for n in itertools.count(100))
+
+    text = None
+    anchors = [NO_TEXT_ANCHOR]
+    if paragraphs:
+        text, anchors = _root_text(paragraphs, ids, np.random.default_rng([seed, 1]))
+
+    layer_ids = [CrdtId(0, 11 + 3 * k) for k in range(layers)]
+    groups = [(next(ids), layer_ids[k % layers], anchors[k % len(anchors)]) for k in range(anchored_groups)]
+
+    yield AuthorIdsBlock(author_uuids={1: AUTHOR_UUID})
+    yield MigrationInfoBlock(migration_id=CrdtId(1, 1), is_device=True)
+    chars = len("".join(text.items.values())) + 1 if text is not None else 0
+    yield PageInfoBlock(loads_count=1, merges_count=0, text_chars_count=chars, text_lines_count=paragraphs)
+    for layer_id in layer_ids:
+        yield SceneTreeBlock(tree_id=layer_id, node_id=CrdtId(0, 0), is_update=True, parent_id=CrdtId(0, 1))
+    for group_id, layer_id, _ in groups:
+        yield SceneTreeBlock(tree_id=group_id, node_id=CrdtId(0, 0), is_update=True, parent_id=layer_id)
+    if text is not None:
+        yield RootTextBlock(block_id=CrdtId(0, 0), value=text)
+
+    yield TreeNodeBlock(si.Group(node_id=CrdtId(0, 1)))
+    for k, layer_id in enumerate(layer_ids):
+        yield TreeNodeBlock(si.Group(node_id=layer_id, label=LwwValue(timestamp=CrdtId(0, 12 + 3 * k),
+                                                                      value=f"Layer {k + 1}")))
+    for group_id, _, anchor in groups:
+        yield TreeNodeBlock(si.Group(node_id=group_id,
+                                     anchor_id=LwwValue(timestamp=next(ids), value=anchor),
+                                     anchor_type=LwwValue(timestamp=next(ids), value=ANCHOR_TYPE),
+                                     anchor_threshold=LwwValue(timestamp=next(ids), value=ANCHOR_THRESHOLD),
+                                     anchor_origin_x=LwwValue(timestamp=next(ids), value=ANCHOR_ORIGIN_X)))
+
+    # Each group's children are a sequence, so each item follows the last one added to its parent
+    last_item = {}
+
+    def sequence_item(parent_id, item_id, value):
+        left_id = last_item.get(parent_id, CrdtId(0, 0))
+        last_item[parent_id] = item_id
+        return CrdtSequenceItem(item_id=item_id, left_id=left_id, right_id=CrdtId(0, 0), deleted_length=0,
+                                value=value)
+
+    for k, layer_id in enumerate(layer_ids):
+        yield SceneGroupItemBlock(parent_id=CrdtId(0, 1), item=sequence_item(CrdtId(0, 1), CrdtId(0, 13 + 3 * k),
+                                                                             layer_id))
+    for group_id, layer_id, _ in groups:
+        yield SceneGroupItemBlock(parent_id=layer_id, item=sequence_item(layer_id, next(ids), group_id))
+
+    parents = layer_ids + [group_id for group_id, _, _ in groups]
+    for i in range(lines):
+        parent_id = parents[i * len(parents) // lines]
+        anchored = parent_id not in layer_ids
+        n_points = last_line_points if i == lines - 1 and last_line_points is not None else points_per_line
+        line = _line(rng, i, n_points, anchored, tools[i % len(tools)], colors[i % len(colors)])
+        yield SceneLineItemBlock(parent_id=parent_id, item=sequence_item(parent_id, next(ids), line))
+
+
+def split_points(n_points: int, points_per_line: int) -> tp.Tuple[int, int | None]:
+    """Number of lines to make `n_points` points in all, and the number in the last line if it has fewer.
+
+    Lines have `points_per_line` points each, apart from the last one, which
+    has whatever is left over.
+    """
+    lines, remainder = divmod(n_points, points_per_line)
+    if remainder:
+        return lines + 1, remainder
+    return lines, None
+
+
+def _root_text(paragraphs: int, ids: tp.Iterator[CrdtId], rng) -> tp.Tuple[si.Text, tp.List[CrdtId]]:
+    """Root text with `paragraphs` paragraphs of random words, and the id of the first character of each."""
+    contents = [" ".join(rng.choice(WORDS, rng.integers(4, 16))).capitalize() for _ in range(paragraphs)]
+    value = "\n".join(contents)
+    text_id = next(ids)
+    # Each character has its own id, following on from the id of the item
+    char_ids = [CrdtId(1, text_id.part2 + n) for n in range(len(value))]
+    for _ in range(len(value) - 1):
+        next(ids)
+
+    starts = [0]
+    for content in contents[:-1]:
+        starts.append(starts[-1] + len(content) + 1)
+    # Paragraphs after the first are styled by the id of the newline before them
+    style_keys = [CrdtId(0, 0)] + [char_ids[start - 1] for start in starts[1:]]
+    styles = {key: LwwValue(timestamp=next(ids), value=PARAGRAPH_STYLES[n % len(PARAGRAPH_STYLES)])
+              for n, key in enumerate(style_keys)}
+
+    items = CrdtSequence([CrdtSequenceItem(item_id=text_id, left_id=CrdtId(0, 0), right_id=CrdtId(0, 0),
+                                           deleted_length=0, value=value)])
+    text = si.Text(items=items, styles=styles, pos_x=-468.0, pos_y=234.0, width=936.0)
+    return text, [char_ids[start] for start in starts]
+
+
+def _line(rng, i: int, n_points: int, anchored: bool, tool: si.Pen, color: si.PenColor) -> si.Line:
+    # A wiggly line across part of the page, one row of "writing" after
+    # another; lines in anchored groups are near their paragraph instead
+    x0 = rng.uniform(-600, 200)
+    y0 = -20 + (i % 2) * 28 if anchored else 100 + (i % 60) * 28
+    t = np.arange(n_points)
+    xs = x0 - (ANCHOR_ORIGIN_X if anchored else 0) + 2.0 * t
+    ys = y0 + 12 * np.sin(t / 3 + rng.uniform(0, 6)) + rng.normal(0, 1, n_points)
+    speeds = rng.integers(0, 80, n_points)
+    directions = rng.integers(0, 256, n_points)
+    widths = rng.integers(8, 30, n_points)
+    pressures = rng.integers(20, 255, n_points)
+    points = list(map(si.Point, xs.tolist(), ys.tolist(), speeds.tolist(), directions.tolist(),
+                      widths.tolist(), pressures.tolist()))
+    return si.Line(color=color, tool=tool, points=points, thickness_scale=2.0, starting_length=0.0)
+
+
+def write_page(fout: tp.BinaryIO, lines: int, **options):
+    """Write an rm file generated by `page_blocks` to binary stream `fout`."""
+    write_blocks(fout, page_blocks(lines, **options))
+
+
+def generate_page(lines: int, **options) -> bytes:
+    """The contents of an rm file generated by `page_blocks`."""
+    buf = io.BytesIO()
+    write_page(buf, lines, **options)
+    return buf.getvalue()
+
+
+def parse_names(enum_type, value: str | None, param) -> tp.Optional[tp.Tuple[tp.Any, ...]]:
+    """Parse comma-separated names of members of `enum_type` for option `param`."""
+    if value is None:
+        return None
+    try:
+        return tuple(enum_type[name.strip().upper()] for name in value.split(","))
+    except KeyError as e:
+        raise click.BadParameter(f"unknown name {e.args[0]}; choose from "
+                                 + ", ".join(member.name for member in enum_type), param=param)
+
+
+@click.command()
+@click.option('-v', '--verbose', count=True)
+@click.option("-o", "--output", type=click.Path(dir_okay=False), required=True, help="rm file to write")
+@click.option("-n", "--points", "n_points", type=click.IntRange(min=1), default=100_000, show_default=True,
+              help="Total number of points, split into lines of --points-per-line; the last line has any "
+                   "left over")
+@click.option("--points-per-line", type=click.IntRange(min=1), default=200, show_default=True)
+@click.option("--layers", type=click.IntRange(min=1), default=1, show_default=True)
+@click.option("--anchored-groups", type=click.IntRange(min=0), default=0, show_default=True,
+              help="Number of groups of lines anchored to paragraphs of the text")
+@click.option("--paragraphs", type=click.IntRange(min=0), default=0, show_default=True,
+              help="Number of paragraphs of root text")
+@click.option("--tools", callback=lambda ctx, param, value: parse_names(si.Pen, value, param),
+              metavar="PEN,...", help="Pens to draw lines with, in turn (default: a mix of pens)")
+@click.option("--colors", callback=lambda ctx, param, value: parse_names(si.PenColor, value, param),
+              metavar="COLOR,...", help="Colours to draw lines with, in turn (default: black)")
+@click.option("--seed", type=int, default=0, show_default=True, help="Random seed; the same seed gives the same file")
+def generate(verbose, output, n_points, points_per_line, layers, anchored_groups, paragraphs, tools, colors, seed):
+    """Generate a synthetic rm file with many lines, e.g. for load testing.
+
+    Lines are split evenly between the layers and anchored groups. Anchored
+    groups are anchored to each paragraph in turn, or to the top of the page
+    if there are no paragraphs. PEN and COLOR are names as in rmscene, e.g.
+    `--tools fineliner_2,highlighter_2 --colors black,blue`.
+    """
+    setup_logging(verbose)
+    lines, last_line_points = split_points(n_points, points_per_line)
+    with open(output, "wb") as fout:
+        write_page(fout, lines, points_per_line=points_per_line, layers=layers, anchored_groups=anchored_groups,
+                   paragraphs=paragraphs, tools=tools or DEFAULT_TOOLS, colors=colors or DEFAULT_COLORS,
+                   seed=seed, last_line_points=last_line_points)
+    click.echo(f"Wrote {n_points} points in {lines} lines to {output}", err=True)
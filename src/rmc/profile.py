@@ -0,0 +1,159 @@
+"""Time the stages of a conversion and count what was drawn.
+
+Instrumentation is off unless a `Profile` is active, in which case the
+exporters record the wall time of each stage (`stage`) and counts such as the
+number of lines and points drawn (`count`) into it:
+
+    with Profile() as profile:
+        convert_rm(path, "svg", fout)
+    print(profile.format_table())
+
+Stages can be nested, and are named by their path, e.g. `svg/draw`.
+"""
+
+import json
+import time
+import typing as tp
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+_active: ContextVar[tp.Optional["Profile"]] = ContextVar("rmc_profile", default=None)
+
+
+class Profile:
+    """Wall time of each stage of a conversion, and counters.
+
+    If `callback` is given, it is called with the name and duration (in
+    seconds) of each stage as it finishes.
+    """
+
+    def __init__(self, callback: tp.Callable[[str, float], tp.Any] | None = None):
+        self.callback = callback
+        # Total seconds and number of calls of each stage, in the order they started
+        self.stages: tp.Dict[str, tp.List[float]] = {}
+        self.counters: tp.Dict[str, int] = {}
+        self._path: tp.List[str] = []
+        self._tokens = []
+
+    def __enter__(self):
+        self._tokens.append(_active.set(self))
+        return self
+
+    def __exit__(self, *args):
+        _active.reset(self._tokens.pop())
+
+    @contextmanager
+    def stage(self, name: str):
+        """Time the code run within this context as stage `name`."""
+        self._path.append(name)
+        key = "/".join(self._path)
+        record = self.stages.setdefault(key, [0.0, 0])
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self._path.pop()
+            record[0] += elapsed
+            record[1] += 1
+            if self.callback is not None:
+                self.callback(key, elapsed)
+
+    def count(self, **counters: int):
+        """Add to each of `counters`."""
+        for name, n in counters.items():
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def merge(self, other: tp.Union["Profile", dict]):
+        """Add the times and counts of `other` (a `Profile` or from `to_dict`) to this one."""
+        if isinstance(other, Profile):
+            other = other.to_dict()
+        for key, value in other["stages"].items():
+            record = self.stages.setdefault(key, [0.0, 0])
+            record[0] += value["seconds"]
+            record[1] += value["calls"]
+        self.count(**other["counters"])
+
+    def to_dict(self) -> dict:
+        return {
+            "stages": {key: {"seconds": seconds, "calls": calls}
+                       for key, (seconds, calls) in self.stages.items()},
+            "counters": dict(self.counters),
+        }
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), indent=2)
+
+    def format_table(self) -> str:
+        """The stages and counters as a table, with nested stages indented."""
+        lines = [f"{'stage':32s} {'calls':>6s} {'seconds':>10s}"]
+        for key, (seconds, calls) in self.stages.items():
+            *parents, name = key.split("/")
+            lines.append(f"{'  ' * len(parents) + name:32s} {calls:6d} {seconds:10.4f}")
+        if self.counters:
+            lines.append("")
+            lines.append(f"{'counter':32s} {'value':>17s}")
+            for name, n in self.counters.items():
+                lines.append(f"{name:32s} {n:17d}")
+        return "\n".join(lines)
+
+
+def active() -> tp.Optional[Profile]:
+    """The active `Profile`, if any."""
+    return _active.get()
+
+
+@contextmanager
+def stage(name: str):
+    """Time the code within this context as stage `name` of the active profile."""
+    profile = _active.get()
+    if profile is None:
+        yield
+    else:
+        with profile.stage(name):
+            yield
+
+
+def count(**counters: int):
+    """Add to `counters` of the active profile."""
+    profile = _active.get()
+    if profile is not None:
+        profile.count(**counters)
+
+
+def counted_output(output):
+    """Wrap `output` to count the bytes written to it, if a profile is active."""
+    profile = _active.get()
+    if profile is None:
+        return output
+    return _CountedOutput(output, profile)
+
+
+class _CountedOutput:
+    """Pass writes on to `output`, counting `output_bytes`.
+
+    Data written again after seeking back (as when streaming SVG) is only
+    counted once.
+    """
+
+    def __init__(self, output, profile: Profile):
+        self._output = output
+        self._profile = profile
+        self._start = output.tell() if output.seekable() else 0
+        self._pos = self._end = 0
+
+    def __getattr__(self, name):
+        return getattr(self._output, name)
+
+    def write(self, data):
+        result = self._output.write(data)
+        self._pos += len(data.encode()) if isinstance(data, str) else len(data)
+        if self._pos > self._end:
+            self._profile.count(output_bytes=self._pos - self._end)
+            self._end = self._pos
+        return result
+
+    def seek(self, offset, whence=0):
+        position = self._output.seek(offset, whence)
+        self._pos = position - self._start
+        return position
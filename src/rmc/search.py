@@ -0,0 +1,345 @@
+"""Search the text and highlights of a library of rm files, for `rmc index` and `rmc search`.
+
+The paragraphs of each page's root text, and its highlights, are stored in a
+SQLite database with a full-text (FTS5) index, so that searches don't need to
+read the pages again. Updating the index only reads pages whose contents
+have changed since they were last indexed, and drops pages which no longer
+exist.
+
+Each result points back to its page, and to the paragraph (by number, and by
+the id of its first character, as in the anchors shown in Markdown output) or
+highlight (by item id) it was found in.
+"""
+
+import hashlib
+import json
+import logging
+import sqlite3
+import traceback
+import typing as tp
+from pathlib import Path
+
+import click
+
+from .cli import setup_logging
+from .files import check_file
+
+_logger = logging.getLogger(__name__)
+
+SCHEMA_VERSION = 2
+DEFAULT_INDEX = "rmc-index.db"
+DEFAULT_LIMIT = 20
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS pages (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS entries (
+    id INTEGER PRIMARY KEY,
+    page_id INTEGER NOT NULL REFERENCES pages (id),
+    kind TEXT NOT NULL,
+    paragraph INTEGER,
+    ref TEXT NOT NULL,
+    text TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_page ON entries (page_id);
+CREATE VIRTUAL TABLE IF NOT EXISTS entries_fts USING fts5(
+    text, content = 'entries', content_rowid = 'id', tokenize = 'unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries BEGIN
+    INSERT INTO entries_fts (rowid, text) VALUES (new.id, new.text);
+END;
+CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries BEGIN
+    INSERT INTO entries_fts (entries_fts, rowid, text) VALUES ('delete', old.id, old.text);
+END;
+"""
+
+
+class TextEntry(tp.NamedTuple):
+    """A piece of searchable text from a page."""
+
+    # "text" for a paragraph of the root text, or "highlight"
+    kind: str
+
+    text: str
+
+    # Number of the paragraph in the root text (from 1), or None for highlights
+    paragraph: int | None
+
+    # Id of the paragraph's first character, or of the highlight item, as "part1,part2"
+    ref: str
+
+
+class SearchHit(tp.NamedTuple):
+    path: str
+    kind: str
+    paragraph: int | None
+    ref: str
+
+    # The matching part of the text, with matches marked by `[` and `]`
+    snippet: str
+
+    def location(self) -> str:
+        if self.kind == "text":
+            return f"paragraph {self.paragraph} <<{self.ref}>>"
+        return f"highlight <<{self.ref}>>"
+
+
+def extract_text(tree) -> tp.List[TextEntry]:
+    """The paragraphs of the root text of `tree`, and its highlights, which aren't empty."""
+    from rmscene import scene_items as si
+    from .exporters.ndjson import format_id
+    from .exporters.layout import PageLayout
+
+    entries = []
+    doc = PageLayout(tree).text_document
+    if doc is not None:
+        for number, p in enumerate(doc.contents, 1):
+            text = str(p).strip()
+            if text:
+                # Not `p.start_id`, which is the newline before the paragraph (or 0,0 for the first)
+                first_id = next(char_id for s in p.contents for char_id in s.i)
+                entries.append(TextEntry("text", text, number, format_id(first_id)))
+
+    stack = [tree.root]
+    while stack:
+        group = stack.pop()
+        for item_id, child in reversed(group.children.items()):
+            if isinstance(child, si.Group):
+                stack.append(child)
+            elif isinstance(child, si.GlyphRange) and child.text.strip():
+                entries.append(TextEntry("highlight", child.text.strip(), None, format_id(item_id)))
+    return entries
+
+
+def extract_file(path: Path) -> tp.Tuple[str, tp.List[TextEntry], str | None]:
+    """`(sha256, entries, error)` for the rm file at `path`.
+
+    Errors reading the page are returned rather than raised, so that one bad
+    page doesn't stop the rest being indexed.
+    """
+    import io
+    from rmscene import read_tree
+
+    digest = ""
+    try:
+        data = path.read_bytes()
+        # Hashed as by `file_hash`, without reading the file again
+        digest = hashlib.sha256(data).hexdigest()
+        tree = read_tree(io.BytesIO(data))
+        return digest, extract_text(tree), None
+    except Exception as e:
+        return digest, [], "".join(traceback.format_exception_only(type(e), e)).strip()
+
+
+def fts_query(query: str) -> str:
+    """FTS5 query matching all the words of `query`, ignoring FTS5 syntax.
+
+    A `*` at the end of a word matches any word starting with it.
+    """
+    terms = []
+    for word in query.split():
+        prefix = word.endswith("*") and len(word) > 1
+        word = word.rstrip("*") if prefix else word
+        terms.append('"%s"%s' % (word.replace('"', '""'), "*" if prefix else ""))
+    return " ".join(terms)
+
+
+class IndexUpdate(tp.NamedTuple):
+    indexed: int
+    unchanged: int
+    removed: int
+    errors: tp.List[tp.Tuple[str, str]]
+
+
+class SearchIndex:
+    """Full-text index of rm files, stored in the SQLite database at `path`.
+
+    Can be used as a context manager, to close the database at the end.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.db = sqlite3.connect(self.path)
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.executescript(SCHEMA)
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if row is not None and row[0] != str(SCHEMA_VERSION):
+            _logger.warning("Index %s was made by a different version of rmc; building it again", self.path)
+            self.db.executescript("DROP TABLE IF EXISTS entries_fts; DROP TABLE IF EXISTS entries; DROP TABLE IF EXISTS pages; "
+                                  "DROP TABLE meta;" + SCHEMA)
+            row = None
+        if row is None:
+            with self.db:
+                self.db.execute("INSERT INTO meta VALUES ('version', ?)", (str(SCHEMA_VERSION),))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    def __len__(self):
+        return self.db.execute("SELECT count(*) FROM pages").fetchone()[0]
+
+    def update(self, paths: tp.Iterable[Path], workers: int | None = None) -> IndexUpdate:
+        """Index the rm files in `paths` (files, or directories to search for `.rm` files).
+
+        Pages are only read again if their modification time or size has
+        changed and their contents are different. Pages in the index which no
+        longer exist are removed. If `workers` is more than 1 (by default, the
+        number of CPUs), pages are read in that many processes.
+        """
+        found = {}
+        for path in paths:
+            path = Path(path)
+            files = sorted(path.rglob("*.rm")) if path.is_dir() else [path]
+            for file in files:
+                found[str(file.resolve())] = file.stat()
+
+        known = {row[0]: row[1:] for row in self.db.execute("SELECT path, id, mtime_ns, size, sha256 FROM pages")}
+        removed = [path for path in known if path not in found and not Path(path).exists()]
+
+        changed = []
+        unchanged = 0
+        touched = []
+        for path, st in found.items():
+            entry = known.get(path)
+            status, _ = check_file(Path(path), st, entry[1:] if entry is not None else None)
+            if status == "changed":
+                changed.append(path)
+                continue
+            if status == "touched":
+                # Modified time changed, but not the contents
+                touched.append((st.st_mtime_ns, st.st_size, entry[0]))
+            unchanged += 1
+
+        indexed = 0
+        errors = []
+        with self.db:
+            for path in removed:
+                self._delete(known[path][0])
+            self.db.executemany("UPDATE pages SET mtime_ns = ?, size = ? WHERE id = ?", touched)
+            for path, (digest, entries, error) in self._extract(changed, workers):
+                st = found[path]
+                entry = known.get(path)
+                if entry is not None:
+                    self._delete(entry[0])
+                page_id = self.db.execute(
+                    "INSERT INTO pages (path, mtime_ns, size, sha256, error) VALUES (?, ?, ?, ?, ?)",
+                    (path, st.st_mtime_ns, st.st_size, digest, error)).lastrowid
+                self.db.executemany(
+                    "INSERT INTO entries (page_id, kind, paragraph, ref, text) VALUES (?, ?, ?, ?, ?)",
+                    [(page_id, e.kind, e.paragraph, e.ref, e.text) for e in entries])
+                indexed += 1
+                if error is not None:
+                    # Only tried again once the page changes
+                    errors.append((path, error))
+        return IndexUpdate(indexed, unchanged, len(removed), errors)
+
+    def _delete(self, page_id: int):
+        self.db.execute("DELETE FROM entries WHERE page_id = ?", (page_id,))
+        self.db.execute("DELETE FROM pages WHERE id = ?", (page_id,))
+
+    @staticmethod
+    def _extract(paths: tp.List[str], workers: int | None):
+        """Iterate `(path, (sha256, entries, error))` for each of `paths`."""
+        if not paths:
+            return
+        if (workers is not None and workers <= 1) or len(paths) == 1:
+            for path in paths:
+                yield path, extract_file(Path(path))
+            return
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(extract_file, map(Path, paths), chunksize=16)
+            yield from zip(paths, results)
+
+    def search(self, query: str, limit: int | None = DEFAULT_LIMIT, raw: bool = False) -> tp.List[SearchHit]:
+        """Find the text matching `query`, best matches first.
+
+        `query` is a list of words to match, as in `fts_query`, or if `raw` is
+        true, an FTS5 query.
+        """
+        if not raw:
+            query = fts_query(query)
+        if not query:
+            return []
+        try:
+            rows = self.db.execute(
+                "SELECT pages.path, entries.kind, entries.paragraph, entries.ref,"
+                "       snippet(entries_fts, 0, '[', ']', '...', 12)"
+                " FROM entries_fts"
+                " JOIN entries ON entries.id = entries_fts.rowid"
+                " JOIN pages ON pages.id = entries.page_id"
+                " WHERE entries_fts MATCH ? ORDER BY rank LIMIT ?",
+                (query, -1 if limit is None else limit))
+            return [SearchHit(*row) for row in rows]
+        except sqlite3.OperationalError as e:
+            raise ValueError(f"Invalid search query {query!r}: {e}") from e
+
+
+index_option = click.option(
+    "--index", "index_path", type=click.Path(dir_okay=False), envvar="RMC_INDEX", default=DEFAULT_INDEX,
+    show_default=True, help="Index database file [env: RMC_INDEX]")
+
+
+@click.command()
+@click.option('-v', '--verbose', count=True)
+@index_option
+@click.option("-j", "--jobs", type=click.IntRange(min=1),
+              help="Number of worker processes (default: number of CPUs)")
+@click.argument("paths", type=click.Path(exists=True), nargs=-1, required=True)
+@click.pass_context
+def index(ctx, verbose, index_path, jobs, paths):
+    """Add the text and highlights of rm files in PATHS to the search index.
+
+    PATHS can be files, or directories which are searched for `.rm` files.
+    Only pages which are new or have changed are read, and pages which no
+    longer exist are removed from the index.
+    """
+    setup_logging(verbose)
+    with SearchIndex(Path(index_path)) as search_index:
+        result = search_index.update([Path(p) for p in paths], workers=jobs)
+        total = len(search_index)
+    for path, error in result.errors:
+        click.echo(f"FAILED {path}: {error}", err=True)
+    click.echo(f"Indexed {result.indexed} pages ({result.unchanged} unchanged, {result.removed} removed, "
+               f"{len(result.errors)} failed); {total} pages in {index_path}", err=True)
+    ctx.exit(1 if result.errors else 0)
+
+
+@click.command()
+@index_option
+@click.option("-n", "--limit", type=click.IntRange(min=1), default=DEFAULT_LIMIT, show_default=True,
+              help="Maximum number of results")
+@click.option("--fts", "raw", is_flag=True, help="QUERY is an SQLite FTS5 query, e.g. 'apple OR pear'")
+@click.option("--json", "as_json", is_flag=True, help="Write each result as a line of JSON")
+@click.argument("query", nargs=-1, required=True)
+def search(index_path, limit, raw, as_json, query):
+    """Search the index for text and highlights containing all the words of QUERY.
+
+    A `*` at the end of a word matches any word starting with it. Build the
+    index first with `rmc index`.
+    """
+    if not Path(index_path).exists():
+        raise click.ClickException(f"No index at {index_path}; create it with `rmc index`")
+    with SearchIndex(Path(index_path)) as search_index:
+        try:
+            hits = search_index.search(" ".join(query), limit, raw)
+        except ValueError as e:
+            raise click.UsageError(str(e))
+    for hit in hits:
+        if as_json:
+            click.echo(json.dumps(hit._asdict()))
+        else:
+            click.echo(f"{hit.path}: {hit.location()}: {hit.snippet}")
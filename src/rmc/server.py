@@ -0,0 +1,386 @@
+"""Convert rm files sent over HTTP, for `rmc serve`.
+
+Starting Python and importing the exporters takes much longer than converting
+a typical page, so a long-running server is much faster than running `rmc`
+once per page. Conversions run in a pool of worker processes, started when the
+server starts. Requests wait in a queue of limited size for a free worker;
+when the queue is full, new requests are refused with status 503 so that
+clients can back off.
+
+The server listens on a TCP port or a Unix socket, and handles:
+
+- `POST /convert?to=FORMAT`: convert the rm file in the request body. The
+  query can also set `dpi`, `simplify`, `viewport`, `pdf_engine` and
+  `points`, as for the command line.
+- `GET /health`: whether the server is running.
+- `GET /metrics`: counts of requests, cache hits, bytes and time spent, as
+  JSON.
+
+The `serve` command is run as `rmc serve`.
+"""
+
+import json
+import logging
+import signal
+import socketserver
+import threading
+import time
+import traceback
+import typing as tp
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlsplit
+
+import click
+
+from .batch import WorkerPool
+from .cache import DEFAULT_MAX_SIZE, RenderCache, rmc_version
+from .cli import POINTS_MODES, RM_FORMATS, cache_key, convert_rm_to_bytes, parse_numbers, setup_logging, viewport_extents
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_PORT = 8123
+
+DEFAULT_MAX_REQUEST_SIZE = 64 * 1024 * 1024
+
+# Seconds to wait for a conversion
+DEFAULT_TIMEOUT = 120.0
+
+CONTENT_TYPES = {
+    "svg": "image/svg+xml",
+    "pdf": "application/pdf",
+    "png": "image/png",
+    "markdown": "text/markdown; charset=utf-8",
+}
+
+
+class ServiceBusy(RuntimeError):
+    """All workers are busy and the queue of waiting requests is full."""
+
+
+def parse_query(query: str) -> tp.Tuple[str, dict]:
+    """Target format and conversion options from the query string of a request.
+
+    Raises `ValueError` if they are not valid.
+    """
+    params = {key: values[-1] for key, values in parse_qs(query).items()}
+    to = params.pop("to", None)
+    if to is None:
+        raise ValueError("missing 'to' parameter")
+    if to not in RM_FORMATS:
+        raise ValueError(f"unknown format {to!r}")
+
+    options = {}
+    for name in ("dpi", "simplify"):
+        if name in params:
+            options[name] = _parse_numbers(params.pop(name), 1, name)[0]
+            if not options[name] > 0:
+                raise ValueError(f"{name} must be positive")
+    if "viewport" in params:
+        if to not in ("svg", "png"):
+            raise ValueError("viewport only supports svg and png output")
+        options["viewport"] = viewport_extents(_parse_numbers(params.pop("viewport"), 4, "viewport"))
+    if "pdf_engine" in params:
+        options["pdf_engine"] = params.pop("pdf_engine")
+        if options["pdf_engine"] not in ("native", "inkscape"):
+            raise ValueError("pdf_engine must be 'native' or 'inkscape'")
+    if "points" in params:
+        options["points"] = params.pop("points")
+        if options["points"] not in POINTS_MODES:
+            raise ValueError("points must be one of " + ", ".join(POINTS_MODES))
+    if params:
+        raise ValueError("unknown parameters: " + ", ".join(sorted(params)))
+    return to, options
+
+
+def _parse_numbers(value: str, n: int, name: str) -> tp.Tuple[float, ...]:
+    # As for the command line options, but reporting errors as for the rest of the query
+    try:
+        return parse_numbers(value, n, None)
+    except click.BadParameter as e:
+        raise ValueError(f"invalid {name}: {e.message}") from None
+
+
+class ConversionService:
+    """Run conversions in a pool of `workers` processes (default: number of CPUs).
+
+    Up to `queue_size` requests (default: 2 per worker) can wait for a worker;
+    beyond that, `convert` raises `ServiceBusy`. If a `cache` is given,
+    outputs are reused from it; it is only used by this process, and the
+    workers are only given the conversions which aren't cached.
+    """
+
+    def __init__(self, workers: int | None = None, queue_size: int | None = None,
+                 timeout: float = DEFAULT_TIMEOUT, cache: RenderCache | None = None):
+        # Workers are started now, rather than when the first requests arrive
+        self._pool = WorkerPool(workers, queue_size, eager=True)
+        self.workers = self._pool.workers
+        self.queue_size = self._pool.queue_size
+        self.timeout = timeout
+        self.cache = cache
+        self._slots = threading.BoundedSemaphore(self._pool.max_pending)
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+        self._stats = dict(requests=0, converted=0, failed=0, rejected=0, timed_out=0, in_flight=0,
+                           cache_hits=0, cache_misses=0, bytes_in=0, bytes_out=0, seconds=0.0)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _count(self, **counts):
+        with self._lock:
+            for name, n in counts.items():
+                self._stats[name] += n
+
+    def convert(self, data: bytes, to: str, options: dict) -> bytes:
+        """Convert rm file contents `data` to format `to` with `options`, in a worker.
+
+        Raises `ServiceBusy` if the queue is full, `TimeoutError` if the
+        conversion takes too long, or the conversion's exception if it fails.
+        """
+        self._count(requests=1, bytes_in=len(data))
+        key = None
+        if self.cache is not None:
+            key = cache_key(self.cache, data, to, **options)
+            result = self.cache.get(key)
+            if result is not None:
+                self._count(converted=1, cache_hits=1, bytes_out=len(result))
+                return result
+            self._count(cache_misses=1)
+
+        if not self._slots.acquire(blocking=False):
+            self._count(rejected=1)
+            raise ServiceBusy("too many requests waiting")
+
+        start = time.perf_counter()
+        self._count(in_flight=1)
+        executor = self._pool.executor()
+        try:
+            future = executor.submit(convert_rm_to_bytes, data, to, name="request", **options)
+        except BrokenProcessPool:
+            self._release()
+            self._pool.replace(executor)
+            raise
+        # Keep the slot until the worker has finished, even if we stop waiting
+        future.add_done_callback(self._release)
+
+        try:
+            result = future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            self._count(timed_out=1)
+            raise TimeoutError(f"conversion took more than {self.timeout} s")
+        except BrokenProcessPool:
+            self._count(failed=1)
+            self._pool.replace(executor)
+            raise
+        except Exception:
+            self._count(failed=1)
+            raise
+        if key is not None:
+            self.cache.put(key, result)
+        self._count(converted=1, bytes_out=len(result), seconds=time.perf_counter() - start)
+        return result
+
+    def _release(self, future: Future | None = None):
+        self._count(in_flight=-1)
+        self._slots.release()
+
+    def metrics(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+        return dict(version=rmc_version(),
+                    uptime=time.monotonic() - self._started,
+                    workers=self.workers,
+                    queue_size=self.queue_size,
+                    **stats)
+
+    def close(self):
+        self._pool.close()
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """Handle requests to convert rm files, and for the server's status."""
+
+    protocol_version = "HTTP/1.1"
+    server_version = f"rmc/{rmc_version()}"
+
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        if path == "/health":
+            self._send_json(HTTPStatus.OK, {"status": "ok"})
+        elif path == "/metrics":
+            self._send_json(HTTPStatus.OK, self.server.service.metrics())
+        else:
+            self._send_error(HTTPStatus.NOT_FOUND, f"no such path {path}")
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        if url.path != "/convert":
+            self._send_error(HTTPStatus.NOT_FOUND, f"no such path {url.path}")
+            return
+
+        try:
+            to, options = parse_query(url.query)
+        except ValueError as e:
+            self._send_error(HTTPStatus.BAD_REQUEST, str(e))
+            return
+
+        try:
+            length = int(self.headers["Content-Length"])
+        except TypeError:
+            self._send_error(HTTPStatus.LENGTH_REQUIRED, "Content-Length is required")
+            return
+        except ValueError:
+            length = -1
+        if length < 0:
+            # The body can't be read, so the connection can't be reused
+            self.close_connection = True
+            self._send_error(HTTPStatus.BAD_REQUEST, "invalid Content-Length")
+            return
+        if length > self.server.max_request_size:
+            self.close_connection = True
+            self._send_error(HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+                             f"request is larger than {self.server.max_request_size} bytes")
+            return
+        data = self.rfile.read(length)
+
+        try:
+            result = self.server.service.convert(data, to, options)
+        except ServiceBusy as e:
+            self._send_error(HTTPStatus.SERVICE_UNAVAILABLE, str(e), {"Retry-After": "1"})
+        except TimeoutError as e:
+            self._send_error(HTTPStatus.GATEWAY_TIMEOUT, str(e))
+        except BrokenProcessPool:
+            self._send_error(HTTPStatus.INTERNAL_SERVER_ERROR, "worker process died")
+        except Exception as e:
+            _logger.debug("Failed to convert request", exc_info=True)
+            message = "".join(traceback.format_exception_only(type(e), e)).strip()
+            self._send_error(HTTPStatus.UNPROCESSABLE_ENTITY, message)
+        else:
+            self._send(HTTPStatus.OK, result, CONTENT_TYPES.get(to, "text/plain; charset=utf-8"))
+
+    def _send(self, status: HTTPStatus, body: bytes, content_type: str, headers: dict | None = None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status: HTTPStatus, value, headers: dict | None = None):
+        self._send(status, (json.dumps(value) + "\n").encode(), "application/json", headers)
+
+    def _send_error(self, status: HTTPStatus, message: str, headers: dict | None = None):
+        self._send_json(status, {"error": message}, headers)
+
+    def address_string(self):
+        # Clients of a Unix socket have no address
+        return self.client_address[0] if self.client_address else "unix"
+
+    def log_message(self, format, *args):
+        _logger.info("%s %s", self.address_string(), format % args)
+
+
+class _ServiceServer:
+    """Server attributes used by `RequestHandler`."""
+
+    daemon_threads = True
+    service: ConversionService
+    max_request_size: int
+
+
+class HTTPServer(_ServiceServer, ThreadingHTTPServer):
+    pass
+
+
+class UnixHTTPServer(_ServiceServer, socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    def server_bind(self):
+        # Replace a socket left behind by a previous server
+        Path(self.server_address).unlink(missing_ok=True)
+        super().server_bind()
+
+    def server_close(self):
+        super().server_close()
+        Path(self.server_address).unlink(missing_ok=True)
+
+
+def make_server(service: ConversionService, host: str = "127.0.0.1", port: int = DEFAULT_PORT,
+                socket_path: str | None = None,
+                max_request_size: int = DEFAULT_MAX_REQUEST_SIZE) -> socketserver.BaseServer:
+    """Make a server for `service`, on `socket_path` if given, otherwise on `host` and `port`."""
+    if socket_path is not None:
+        server = UnixHTTPServer(socket_path, RequestHandler)
+    else:
+        server = HTTPServer((host, port), RequestHandler)
+    server.service = service
+    server.max_request_size = max_request_size
+    return server
+
+
+def server_url(server: socketserver.BaseServer) -> str:
+    """Where `server` is listening, for messages."""
+    if isinstance(server, UnixHTTPServer):
+        return server.server_address
+    return "http://%s:%d" % server.server_address[:2]
+
+
+def serve_forever(server: socketserver.BaseServer):
+    """Serve requests until interrupted or terminated."""
+    # Stop cleanly on SIGTERM as well as Ctrl-C
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+@click.command()
+@click.option('-v', '--verbose', count=True)
+@click.option("--host", default="127.0.0.1", show_default=True, help="Address to listen on")
+@click.option("--port", type=click.IntRange(0, 65535), default=DEFAULT_PORT, show_default=True,
+              help="TCP port to listen on")
+@click.option("--socket", "socket_path", type=click.Path(dir_okay=False),
+              help="Listen on this Unix socket instead of a TCP port")
+@click.option("-j", "--jobs", type=click.IntRange(min=1),
+              help="Number of worker processes (default: number of CPUs)")
+@click.option("--queue-size", type=click.IntRange(min=0),
+              help="Number of requests which can wait for a worker; any more are refused (default: 2 per worker)")
+@click.option("--max-size", type=click.IntRange(min=1), default=DEFAULT_MAX_REQUEST_SIZE // 2**20,
+              show_default=True, help="Largest rm file accepted, in MB")
+@click.option("--timeout", type=click.FloatRange(min=0, min_open=True), default=DEFAULT_TIMEOUT,
+              show_default=True, help="Seconds to wait for a conversion before giving up")
+@click.option("--cache-dir", type=click.Path(file_okay=False), envvar="RMC_CACHE_DIR",
+              help="Reuse converted pages from this cache directory [env: RMC_CACHE_DIR]")
+@click.option("--cache-size", type=click.IntRange(min=0), default=DEFAULT_MAX_SIZE // 2**20, show_default=True,
+              help="Maximum size of the cache in MB; least recently used pages are removed")
+def serve(verbose, host, port, socket_path, jobs, queue_size, max_size, timeout, cache_dir, cache_size):
+    """Convert rm files sent over HTTP.
+
+    Python start-up, imports and worker processes are only paid for once, so
+    this is faster than running `rmc` for each page. POST the contents of an
+    rm file to `/convert?to=FORMAT`, e.g.
+
+        curl --data-binary @page.rm "http://localhost:8123/convert?to=svg"
+
+    The query can also set `dpi`, `simplify`, `viewport`, `pdf_engine` and
+    `points`, as for `rmc convert`. `/health` and `/metrics` report the server's status.
+    """
+    setup_logging(verbose)
+    cache = None
+    if cache_dir is not None:
+        cache = RenderCache(Path(cache_dir), max_size=cache_size * 2**20)
+
+    with ConversionService(workers=jobs, queue_size=queue_size, timeout=timeout, cache=cache) as service:
+        server = make_server(service, host=host, port=port, socket_path=socket_path,
+                             max_request_size=max_size * 2**20)
+        click.echo(f"Listening on {server_url(server)} with {service.workers} workers", err=True)
+        serve_forever(server)
@@ -0,0 +1,189 @@
+"""Spatial index of the lines in a scene tree.
+
+Finds the lines within a rectangle, or nearest to a point, without looking at
+every line. Lines are indexed by their extents on the page -- in screen units,
+including the anchor offsets of the groups containing them -- in an R-tree
+which is packed once, when the index is built, using the Sort-Tile-Recursive
+method.
+"""
+
+import heapq
+import itertools
+import math
+import typing as tp
+
+import numpy as np
+
+from rmscene import SceneTree
+from rmscene import scene_items as si
+
+from .exporters.geometry import LineGeometry
+from .exporters.layout import Extents, PageLayout, shift_extents
+
+# Maximum number of children of each node of the tree
+NODE_SIZE = 16
+
+
+class IndexEntry(tp.NamedTuple):
+    """A line in a `StrokeIndex`."""
+
+    line: si.Line
+
+    # Extents of the line on the page, as (x_min, x_max, y_min, y_max)
+    extents: Extents
+
+    # Offset of the line's points on the page, from the groups containing it
+    offset: tp.Tuple[float, float]
+
+    # The line's packed points, if known
+    geometry: LineGeometry | None = None
+
+    def coords(self) -> np.ndarray:
+        """The line's points on the page, as an array of shape (n, 2)."""
+        geometry = self.geometry if self.geometry is not None else LineGeometry.from_points(self.line.points)
+        return geometry.coords() + self.offset
+
+
+class StrokeIndex:
+    """R-tree of `IndexEntry`s, for finding lines by position on the page.
+
+    Build one for a tree using `StrokeIndex.from_tree`. Queries take time
+    roughly proportional to the log of the number of lines, plus the number
+    of results.
+    """
+
+    def __init__(self, entries: tp.Sequence[IndexEntry], node_size: int = NODE_SIZE):
+        self.node_size = node_size
+        boxes = np.array([entry.extents for entry in entries], dtype=float).reshape(-1, 4)
+        order = _str_order(boxes, node_size)
+        self.entries = [entries[i] for i in order]
+
+        # Each level holds the extents of its nodes, and for nodes above the
+        # entries, the start and number of their children in the level below.
+        # The top level is the children of the (implicit) root.
+        boxes = boxes[order]
+        starts = counts = None
+        self._levels = [(boxes, starts, counts)]
+        while len(boxes) > node_size:
+            starts = np.arange(0, len(boxes), node_size)
+            counts = np.minimum(node_size, len(boxes) - starts)
+            boxes = np.column_stack([
+                np.minimum.reduceat(boxes[:, 0], starts),
+                np.maximum.reduceat(boxes[:, 1], starts),
+                np.minimum.reduceat(boxes[:, 2], starts),
+                np.maximum.reduceat(boxes[:, 3], starts),
+            ])
+            order = _str_order(boxes, node_size)
+            boxes, starts, counts = boxes[order], starts[order], counts[order]
+            self._levels.append((boxes, starts, counts))
+
+    @classmethod
+    def from_tree(cls, tree: SceneTree, layout: PageLayout | None = None,
+                  node_size: int = NODE_SIZE) -> "StrokeIndex":
+        """Index the lines of `tree`.
+
+        If the tree's `layout` is given, the lines already packed for it are reused.
+        """
+        if layout is None:
+            layout = PageLayout(tree)
+        lines = layout.lines
+        entries = []
+        for line in lines.lines:
+            line_extents = lines.extents(line)
+            if line_extents is not None:
+                geometry = lines.geometry(line)
+                entries.append(IndexEntry(line, shift_extents(line_extents, *geometry.offset),
+                                          geometry.offset, geometry))
+        return cls(entries, node_size)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def query(self, rect: Extents, margin: float = 0) -> tp.List[IndexEntry]:
+        """Entries whose extents overlap `rect` (or are within `margin` of it)."""
+        boxes, _, _ = self._levels[-1]
+        nodes = np.flatnonzero(_overlaps(boxes, rect, margin))
+        for level in range(len(self._levels) - 1, 0, -1):
+            _, starts, counts = self._levels[level]
+            children = _ranges(starts[nodes], counts[nodes])
+            boxes, _, _ = self._levels[level - 1]
+            nodes = children[_overlaps(boxes[children], rect, margin)]
+        return [self.entries[i] for i in nodes.tolist()]
+
+    def nearest(self, x: float, y: float, k: int = 1,
+                max_distance: float = math.inf) -> tp.List[tp.Tuple[float, IndexEntry]]:
+        """The `k` entries nearest to point `(x, y)`, as `(distance, entry)`, nearest first.
+
+        Distances are to the lines themselves, not just their extents. Only
+        entries within `max_distance` are returned.
+        """
+        results = []
+        counter = itertools.count()
+        heap = []
+
+        def push(level, nodes):
+            boxes, _, _ = self._levels[level]
+            for distance, node in zip(_box_distances(boxes[nodes], x, y).tolist(), nodes.tolist()):
+                if distance <= max_distance:
+                    heapq.heappush(heap, (distance, next(counter), level, node, False))
+
+        push(len(self._levels) - 1, np.arange(len(self._levels[-1][0])))
+        while heap and len(results) < k:
+            distance, _, level, node, exact = heapq.heappop(heap)
+            if level > 0:
+                _, starts, counts = self._levels[level]
+                push(level - 1, np.arange(starts[node], starts[node] + counts[node]))
+            elif exact:
+                results.append((distance, self.entries[node]))
+            else:
+                # The line is at least as far away as its extents, so check
+                # its actual distance and put it back in the queue
+                distance = _line_distance(self.entries[node].coords(), x, y)
+                if distance <= max_distance:
+                    heapq.heappush(heap, (distance, next(counter), level, node, True))
+        return results
+
+
+def _str_order(boxes: np.ndarray, node_size: int) -> np.ndarray:
+    """Sort-Tile-Recursive order of `boxes`: vertical slices, each sorted by y."""
+    n = len(boxes)
+    if n <= node_size:
+        return np.arange(n)
+    centre_x = boxes[:, 0] + boxes[:, 1]
+    centre_y = boxes[:, 2] + boxes[:, 3]
+    slice_size = math.ceil(math.sqrt(math.ceil(n / node_size))) * node_size
+    by_x = np.argsort(centre_x, kind="stable")
+    return np.concatenate([
+        s[np.argsort(centre_y[s], kind="stable")]
+        for s in np.split(by_x, range(slice_size, n, slice_size))
+    ])
+
+
+def _ranges(starts: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    """Concatenated `range(start, start + count)` for each start and count."""
+    ends = np.cumsum(counts)
+    return np.repeat(starts - ends + counts, counts) + np.arange(ends[-1] if len(ends) else 0)
+
+
+def _overlaps(boxes: np.ndarray, rect: Extents, margin: float) -> np.ndarray:
+    x_min, x_max, y_min, y_max = rect
+    return ((boxes[:, 0] - margin <= x_max) & (x_min - margin <= boxes[:, 1])
+            & (boxes[:, 2] - margin <= y_max) & (y_min - margin <= boxes[:, 3]))
+
+
+def _box_distances(boxes: np.ndarray, x: float, y: float) -> np.ndarray:
+    dx = np.maximum(np.maximum(boxes[:, 0] - x, x - boxes[:, 1]), 0)
+    dy = np.maximum(np.maximum(boxes[:, 2] - y, y - boxes[:, 3]), 0)
+    return np.hypot(dx, dy)
+
+
+def _line_distance(coords: np.ndarray, x: float, y: float) -> float:
+    """Distance from `(x, y)` to the polyline `coords`."""
+    if len(coords) == 1:
+        return float(np.hypot(*(coords[0] - (x, y))))
+    a = coords[:-1]
+    ab = coords[1:] - a
+    ap = (x, y) - a
+    length2 = np.einsum("ij,ij->i", ab, ab)
+    t = np.clip(np.einsum("ij,ij->i", ap, ab) / np.where(length2 > 0, length2, 1), 0, 1)
+    return float(np.hypot(*(ap - t[:, None] * ab).T).min())
@@ -0,0 +1,275 @@
+"""Keep the outputs for a directory of rm files up to date, for `rmc watch`.
+
+The directory is scanned for changes every few seconds. A page is converted
+again when its modification time or size has changed and its contents are
+different, but only once it has not been written to for a short time, so that
+a page which is still being synced is only converted once it is complete.
+Outputs of pages which have been deleted are removed.
+
+A manifest in the output directory records each page which has been
+converted, so that after a restart only pages which have changed since are
+converted again.
+"""
+
+import json
+import logging
+import os
+import signal
+import stat
+import time
+import typing as tp
+from pathlib import Path
+
+import click
+
+from .batch import (DEFAULT_NAME_TEMPLATE, NAME_FIELDS, BatchResult, WorkerPool, convert_batch, duplicate_outputs,
+                    output_path, template_fields)
+from .cache import rmc_version
+from .cli import FORMAT_EXTENSIONS, RM_FORMATS, setup_logging
+from .files import check_file, write_atomic
+
+_logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = ".rmc-watch.json"
+MANIFEST_VERSION = 1
+
+# Seconds between scans of the directory
+DEFAULT_INTERVAL = 2.0
+
+# Seconds since a page was last written before it is converted
+DEFAULT_DEBOUNCE = 2.0
+
+
+class Watcher:
+    """Convert the rm files in `directory` to each of `formats` in `output_dir`, when they change.
+
+    Outputs are written in the same subdirectories as their inputs, named by
+    `name_template` as in batch mode, but without `index`, since pages come
+    and go and so have no fixed order to number them by. Pages are converted once they have not
+    been modified for `debounce` seconds. `options` are passed on to
+    `convert_rm_targets`.
+
+    Raises `ValueError` if `name_template` would give several outputs the
+    same filename, and so does `update` if it would for the pages found.
+    """
+
+    def __init__(self, directory: Path, output_dir: Path, formats: tp.Sequence[str],
+                 name_template: str = DEFAULT_NAME_TEMPLATE, debounce: float = DEFAULT_DEBOUNCE,
+                 manifest_path: Path | None = None, **options):
+        unknown = template_fields(name_template) - set(NAME_FIELDS)
+        if unknown:
+            raise ValueError("Unknown fields in name template: " + ", ".join(sorted(unknown)))
+        self.directory = Path(directory)
+        self.output_dir = Path(output_dir)
+        self.formats = list(formats)
+        self.name_template = name_template
+        self.debounce = debounce
+        self.options = options
+        # Formats with the same extension are written to the same file, if the template has no `ext`
+        self.check_outputs(["page.rm"])
+        self.manifest_path = self.output_dir / MANIFEST_NAME if manifest_path is None else Path(manifest_path)
+        # Outputs are only reused if they were made in the same way
+        self.settings = json.loads(json.dumps({
+            "formats": self.formats,
+            "name_template": name_template,
+            "options": options,
+            "version": rmc_version(),
+        }, sort_keys=True, default=str))
+        # State of each page converted, by path relative to `directory`
+        self.entries: tp.Dict[str, dict] = self._load_manifest()
+
+    def _load_manifest(self) -> tp.Dict[str, dict]:
+        try:
+            manifest = json.loads(self.manifest_path.read_text())
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            _logger.warning("Could not read manifest %s (%s), converting all pages again", self.manifest_path, e)
+            return {}
+        if manifest.get("version") != MANIFEST_VERSION or manifest.get("settings") != self.settings:
+            _logger.info("Conversion settings have changed, converting all pages again")
+            return {}
+        return manifest["files"]
+
+    def save_manifest(self):
+        """Write the manifest, replacing the old one only once it is complete."""
+        self.manifest_path.parent.mkdir(parents=True, exist_ok=True)
+        data = json.dumps({"version": MANIFEST_VERSION, "settings": self.settings, "files": self.entries},
+                          indent=1, sort_keys=True)
+        write_atomic(self.manifest_path, data.encode())
+
+    def scan(self) -> tp.Dict[str, os.stat_result]:
+        """Find the rm files in the directory, by path relative to it."""
+        found = {}
+        for path in self.directory.rglob("*.rm"):
+            try:
+                st = path.stat()
+            except FileNotFoundError:
+                continue
+            if stat.S_ISREG(st.st_mode):
+                found[path.relative_to(self.directory).as_posix()] = st
+        return found
+
+    def targets(self, page: str) -> tp.List[tp.Tuple[str, Path]]:
+        """`(to, output)` for each format to convert `page` to."""
+        input = self.directory / page
+        output_dir = self.output_dir / Path(page).parent
+        return [(to, output_path(input, output_dir, FORMAT_EXTENSIONS.get(to, to), self.name_template))
+                for to in self.formats]
+
+    def check_outputs(self, pages: tp.Iterable[str]):
+        """Raise `ValueError` if any of `pages` would be converted to the same output file."""
+        duplicates = duplicate_outputs((page, self.targets(page)) for page in pages)
+        if duplicates:
+            raise ValueError("Name template gives the same output filename for several pages or formats: "
+                             + ", ".join(map(str, duplicates)))
+
+    def changes(self, now: float | None = None) -> tp.Tuple[tp.List[str], tp.List[str]]:
+        """Pages which have changed and are ready to convert, and pages which have been deleted."""
+        if now is None:
+            now = time.time()
+        found = self.scan()
+        changed = []
+        for page, st in sorted(found.items()):
+            entry = self.entries.get(page)
+            if entry is not None and (entry["mtime_ns"], entry["size"]) == (st.st_mtime_ns, st.st_size):
+                # Looked at again (and its contents hashed) by `update` if not
+                continue
+            if now - st.st_mtime < self.debounce:
+                # Still being written; look again next time
+                continue
+            changed.append(page)
+        deleted = [page for page in self.entries if page not in found]
+        return changed, deleted
+
+    def update(self, workers: int | None = None, executor=None) -> tp.List[BatchResult]:
+        """Convert pages which have changed, and remove the outputs of deleted pages.
+
+        Conversions are run as by `convert_batch`. Returns the results of
+        the conversions.
+        """
+        changed, deleted = self.changes()
+        # Before anything is written or removed, so that pages can't replace each other's outputs
+        self.check_outputs(sorted((set(self.entries) - set(deleted)) | set(changed)))
+        for page in deleted:
+            for output in self.entries.pop(page)["outputs"]:
+                (self.output_dir / output).unlink(missing_ok=True)
+            _logger.info("Removed outputs of deleted page %s", page)
+
+        jobs = []
+        states = {}
+        for page in changed:
+            path = self.directory / page
+            entry = self.entries.get(page)
+            try:
+                st = path.stat()
+                status, digest = check_file(path, st, (entry["mtime_ns"], entry["size"], entry["sha256"])
+                                            if entry is not None else None)
+            except FileNotFoundError:
+                continue
+            if status != "changed":
+                # Modified time changed, but not the contents
+                entry.update(mtime_ns=st.st_mtime_ns, size=st.st_size)
+                continue
+            states[path] = (page, st, digest)
+            jobs.append((path, self.targets(page)))
+
+        results = list(convert_batch(jobs, workers=workers, executor=executor, **self.options)) if jobs else []
+        for result in results:
+            page, st, digest = states[result.input]
+            self.entries[page] = {
+                "mtime_ns": st.st_mtime_ns,
+                "size": st.st_size,
+                "sha256": digest,
+                "outputs": [output.relative_to(self.output_dir).as_posix()
+                            for output in result.outputs if result.error is None],
+                # Failed pages are only tried again once they change
+                "error": result.error,
+            }
+
+        if changed or deleted:
+            self.save_manifest()
+        return results
+
+
+@click.command()
+@click.option('-v', '--verbose', count=True)
+@click.option("-t", "--to", metavar="FORMAT", required=True,
+              help="Format to convert to; several comma-separated formats can be given")
+@click.option("-d", "--output-dir", type=click.Path(file_okay=False), required=True,
+              help="Directory to write outputs to, in the same subdirectories as the inputs")
+@click.option("--name-template", default=DEFAULT_NAME_TEMPLATE, show_default=True,
+              help="Output filename template; fields: {stem}, {name}, {parent}, {ext}")
+@click.option("-j", "--jobs", type=click.IntRange(min=1),
+              help="Number of worker processes (default: number of CPUs)")
+@click.option("--pdf-engine", type=click.Choice(["native", "inkscape"]), default="native", show_default=True,
+              help="Write PDF directly, or by converting SVG with Inkscape")
+@click.option("--dpi", type=click.FloatRange(min=0, min_open=True),
+              help="Resolution of PNG output (default: 72, one pixel per pt)")
+@click.option("--simplify", type=click.FloatRange(min=0, min_open=True), metavar="TOL",
+              help="Simplify strokes, dropping points which move them by less than TOL (in pt)")
+@click.option("--interval", type=click.FloatRange(min=0, min_open=True), default=DEFAULT_INTERVAL,
+              show_default=True, help="Seconds between checks for changed pages")
+@click.option("--debounce", type=click.FloatRange(min=0), default=DEFAULT_DEBOUNCE, show_default=True,
+              help="Only convert pages which haven't been written to for this many seconds")
+@click.option("--once", is_flag=True, help="Convert the pages which have changed, then exit")
+@click.argument("directory", type=click.Path(exists=True, file_okay=False))
+@click.pass_context
+def watch(ctx, verbose, to, output_dir, name_template, jobs, pdf_engine, dpi, simplify, interval, debounce, once,
+          directory):
+    """Convert rm files in DIRECTORY as they change.
+
+    Only pages which are new or have changed are converted, and outputs of
+    deleted pages are removed. A manifest in the output directory records
+    the pages converted, so that after a restart only pages which have
+    changed since are converted again.
+    """
+    setup_logging(verbose)
+    formats = to.split(",")
+    for f in formats:
+        if f not in RM_FORMATS:
+            raise click.UsageError("Unknown format %s" % f)
+
+    try:
+        watcher = Watcher(Path(directory), Path(output_dir), formats, name_template, debounce,
+                          pdf_engine=pdf_engine, dpi=dpi, simplify=simplify)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint="--name-template")
+
+    def update(executor=None) -> int:
+        try:
+            results = watcher.update(workers=jobs, executor=executor)
+        except ValueError as e:
+            raise click.BadParameter(str(e), param_hint="--name-template")
+        for result in results:
+            if result.error is not None:
+                click.echo(f"FAILED {result.input}: {result.error}", err=True)
+            else:
+                click.echo(f"Converted {result.input} ({result.duration:.2f} s)", err=True)
+        return sum(1 for r in results if r.error is not None)
+
+    if once:
+        # Don't wait for pages which are still being written
+        watcher.debounce = 0
+        ctx.exit(1 if update() else 0)
+
+    # Keep the worker processes for the next change, rather than starting new ones
+    from concurrent.futures.process import BrokenProcessPool
+    pool = WorkerPool(jobs)
+
+    # Stop cleanly on SIGTERM as well as Ctrl-C
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    click.echo(f"Watching {directory} for changes", err=True)
+    try:
+        while True:
+            executor = pool.executor()
+            try:
+                update(executor)
+            except BrokenProcessPool:
+                # The pages are converted again next time, as they weren't recorded
+                pool.replace(executor)
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pool.close()